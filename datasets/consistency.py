@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+
+# Geometric consistency check of the depth fusion (eval.py, tools/filter_fusion.py) for all source views of a
+# reference view at once. The reference pixels are projected into every source view with the reference depth,
+# back projected with the source depth sampled there, and compared with the reference pixel and depth.
+# This is the per view reproject_with_depth / check_geometric_consistency of the fusion scripts stacked over the
+# source views: the reference 3D points, the matrix inverses and the relative transforms are computed once instead
+# of once per source view, the projections are batched matmuls over the source views, and the image is processed
+# in blocks of rows so that the float64 intermediates of all source views stay in cache.
+# The arithmetic of each pixel is the same (float64 points, float32 remap coordinates and depths), so the masks and
+# reprojected depths are identical to the per view code.
+
+# reference pixels per block (about 2x faster than whole images with 10 source views at 400x296 and 6 at 800x592)
+PIXEL_BLOCK = 2048
+
+
+# project the reference pixels of rows [y0, y0 + rows) into the source views, then project back
+# depth_ref: [rows * W] float32 depths of those pixels, x_ref, y_ref: [rows * W] int64 pixel coordinates,
+# depths_src: S source depth maps [H, W], cameras: inverted and relative matrices of check_geometric_consistency_views
+# returns the reprojected depth, x and y in the reference view and x and y in the source views, all [S, rows * W]
+def reproject_with_depth_views(depth_ref, x_ref, y_ref, depths_src, intrinsics_ref, intrinsics_ref_inv,
+                               intrinsics_src, intrinsics_src_inv, ref_to_src, src_to_ref, rows):
+    num_src = len(depths_src)
+    ones = np.ones_like(x_ref)
+    src_ones = np.broadcast_to(ones, (num_src, 1, ones.shape[0]))
+    ## step1. project reference pixels to the source views
+    # reference 3D space, shared by the source views
+    xyz_ref = np.matmul(intrinsics_ref_inv, np.vstack((x_ref, y_ref, ones)) * depth_ref)
+    # source 3D space, [S, 3, N]
+    xyz_src = np.matmul(ref_to_src, np.vstack((xyz_ref, ones)))[:, :3]
+    # source view x, y
+    K_xyz_src = np.matmul(intrinsics_src, xyz_src)
+    xy_src = K_xyz_src[:, :2] / K_xyz_src[:, 2:3]
+
+    ## step2. reproject the source view points with source view depth estimation
+    # find the depth estimation of the source views
+    x_src = xy_src[:, 0].astype(np.float32)
+    y_src = xy_src[:, 1].astype(np.float32)
+    sampled_depth_src = np.stack([cv2.remap(depth_src, x.reshape([rows, -1]), y.reshape([rows, -1]),
+                                            interpolation=cv2.INTER_LINEAR).reshape([-1])
+                                  for depth_src, x, y in zip(depths_src, x_src, y_src)])
+
+    # source 3D space
+    # NOTE that we should use sampled source-view depth_here to project back
+    xyz_src = np.matmul(intrinsics_src_inv, np.concatenate((xy_src, src_ones), 1) * sampled_depth_src[:, None])
+    # reference 3D space
+    xyz_reprojected = np.matmul(src_to_ref, np.concatenate((xyz_src, src_ones), 1))[:, :3]
+    # source view x, y, depth
+    depth_reprojected = xyz_reprojected[:, 2].astype(np.float32)
+    K_xyz_reprojected = np.matmul(intrinsics_ref, xyz_reprojected)
+    xy_reprojected = K_xyz_reprojected[:, :2] / K_xyz_reprojected[:, 2:3]
+    x_reprojected = xy_reprojected[:, 0].astype(np.float32)
+    y_reprojected = xy_reprojected[:, 1].astype(np.float32)
+
+    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
+
+
+# depth_ref: [H, W], depths_src: S source depth maps [H, W], intrinsics_ref: [3, 3], extrinsics_ref: [4, 4],
+# intrinsics_src: [S, 3, 3], extrinsics_src: [S, 4, 4]
+# returns the masks of the reference pixels consistent with each source view (|p_reproj-p_1| < dist_thresh and
+# |d_reproj-d_1| / d_1 < relative_depth_thresh), the reprojected depths (0 where not consistent) and x and y of the
+# reference pixels in each source view, all [S, H, W]
+def check_geometric_consistency_views(depth_ref, intrinsics_ref, extrinsics_ref, depths_src, intrinsics_src,
+                                      extrinsics_src, dist_thresh=1, relative_depth_thresh=0.01):
+    num_src = len(depths_src)
+    width, height = depth_ref.shape[1], depth_ref.shape[0]
+    mask = np.empty([num_src, height * width], dtype=bool)
+    depth_reprojected = np.empty([num_src, height * width], dtype=np.float32)
+    x2d_src = np.empty([num_src, height * width], dtype=np.float32)
+    y2d_src = np.empty([num_src, height * width], dtype=np.float32)
+    if num_src > 0:
+        cameras = (intrinsics_ref, np.linalg.inv(intrinsics_ref), intrinsics_src, np.linalg.inv(intrinsics_src),
+                   np.matmul(extrinsics_src, np.linalg.inv(extrinsics_ref)),
+                   np.matmul(extrinsics_ref, np.linalg.inv(extrinsics_src)))
+        # reference view x, y
+        x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
+        x_ref, y_ref, depth_ref = x_ref.reshape([-1]), y_ref.reshape([-1]), depth_ref.reshape([-1])
+        block_rows = max(1, PIXEL_BLOCK // width)
+        for y0 in range(0, height, block_rows):
+            rows = min(block_rows, height - y0)
+            block = slice(y0 * width, (y0 + rows) * width)
+            block_depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src[:, block], y2d_src[:, block] = \
+                reproject_with_depth_views(depth_ref[block], x_ref[block], y_ref[block], depths_src, *cameras, rows)
+            # check |p_reproj-p_1| < 1
+            dist = np.sqrt((x2d_reprojected - x_ref[block]) ** 2 + (y2d_reprojected - y_ref[block]) ** 2)
+
+            # check |d_reproj-d_1| / d_1 < 0.01
+            depth_diff = np.abs(block_depth_reprojected - depth_ref[block])
+            relative_depth_diff = depth_diff / depth_ref[block]
+
+            mask[:, block] = np.logical_and(dist < dist_thresh, relative_depth_diff < relative_depth_thresh)
+            block_depth_reprojected[~mask[:, block]] = 0
+            depth_reprojected[:, block] = block_depth_reprojected
+
+    shape = [num_src, height, width]
+    return mask.reshape(shape), depth_reprojected.reshape(shape), x2d_src.reshape(shape), y2d_src.reshape(shape)
+
+
+# depth averaged over the reference view and its consistent source views, and the number of consistent source views
+# of each pixel, summed in the order of the source views like the per view loops of the fusion scripts
+def average_consistent_depth(depth_ref, masks, depths_reprojected):
+    geo_mask_sum = 0
+    depth_sum = 0
+    for mask, depth_reprojected in zip(masks, depths_reprojected):
+        geo_mask_sum += mask.astype(np.int32)
+        depth_sum = depth_sum + depth_reprojected
+    return (depth_sum + depth_ref) / (geo_mask_sum + 1), geo_mask_sum
@@ -3,7 +3,9 @@ import re
 import sys
 
 
-def read_pfm(filename):
+# mmap: map the payload instead of reading it, the returned array is a flipped read-only view on the file
+# contiguous: return a native-endian C-contiguous copy, the only copy made when mmap is enabled
+def read_pfm(filename, mmap=False, contiguous=False):
     file = open(filename, 'rb')
     color = None
     width = None
@@ -32,12 +34,19 @@ def read_pfm(filename):
     else:
         endian = '>'  # big-endian
 
-    data = np.fromfile(file, endian + 'f')
     shape = (height, width, 3) if color else (height, width)
+    if mmap:
+        offset = file.tell()
+        file.close()
+        data = np.memmap(filename, dtype=endian + 'f', mode='r', offset=offset, shape=shape)
+    else:
+        data = np.fromfile(file, endian + 'f')
+        file.close()
+        data = np.reshape(data, shape)
 
-    data = np.reshape(data, shape)
     data = np.flipud(data)
-    file.close()
+    if contiguous:
+        data = np.array(data, dtype=np.float32, order='C')
     return data, scale
 
 
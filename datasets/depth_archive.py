@@ -0,0 +1,212 @@
+import json
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+from PIL import Image
+from datasets.data_io import read_pfm
+
+# Single file per scan holding the depth maps, confidence maps and masks of every view.
+# Layout: MAGIC | record | record | ... | json index | footer (index offset, MAGIC)
+# Records are looked up through the index, so any view can be read without touching the others.
+# Keys follow the folder layout without extension: 'depth_est/00000012', 'confidence/00000012', 'mask/00000012_final'
+MAGIC = b'MVSARC01'
+FOOTER = struct.Struct('<Q8s')
+ARCHIVE_NAME = 'archive.mvsa'
+
+
+# depth_est: float16, confidence: uint8 in [0, 1] * 255, mask: uint8 0/1
+def quantize(kind, array):
+    if kind == 'depth_est':
+        return np.ascontiguousarray(array, dtype=np.float16)
+    elif kind == 'confidence':
+        return np.round(np.clip(array, 0, 1) * 255).astype(np.uint8)
+    elif kind == 'mask':
+        return np.ascontiguousarray(array, dtype=np.bool_).view(np.uint8)
+    else:
+        raise ValueError('unknown archive record kind {}'.format(kind))
+
+
+def dequantize(kind, array):
+    if kind == 'depth_est':
+        return array.astype(np.float32)
+    elif kind == 'confidence':
+        return array.astype(np.float32) / 255.
+    else:
+        return array.view(np.bool_)
+
+
+def read_index(file):
+    file_size = file.seek(0, os.SEEK_END)
+    file.seek(file_size - FOOTER.size)
+    index_offset, magic = FOOTER.unpack(file.read(FOOTER.size))
+    if magic != MAGIC:
+        raise Exception('Not a depth archive or the archive was not closed.')
+    file.seek(index_offset)
+    index = json.loads(file.read(file_size - FOOTER.size - index_offset).decode('utf-8'))
+    return index, index_offset
+
+
+def write_index(file, index):
+    index_offset = file.tell()
+    file.write(json.dumps(index).encode('utf-8'))
+    file.write(FOOTER.pack(index_offset, MAGIC))
+
+
+# copy the payloads of records [(key, entry, file), ...] to the end of dst, returns their index in dst
+def copy_records(dst, records):
+    index = {}
+    for key, entry, src in records:
+        src.seek(entry['offset'])
+        index[key] = dict(entry, offset=dst.tell())
+        dst.write(src.read(entry['nbytes']))
+    return index
+
+
+class DepthArchiveWriter(object):
+    # Records are written to filename + '.tmp', which replaces filename in close(): until then filename stays a
+    # valid archive with its previous records, also while it is read (tools/mmp.py writes the archive it reads).
+    # mode 'a': the records of an existing archive are kept unless their key is put again, close() copies them.
+    # mode 'w': an existing archive is replaced.
+    # A key put twice leaves its first payload as dead bytes in the temp file, close() then writes the records
+    # into a new file instead.
+    def __init__(self, filename, compress=False, mode='a'):
+        if mode not in ('a', 'w'):
+            raise ValueError('unknown archive mode {}'.format(mode))
+        self.filename = filename
+        self.temp_filename = filename + '.tmp'
+        self.compress = compress
+        self.lock = threading.Lock()
+        # bytes of payloads no longer in the index
+        self.dead_bytes = 0
+        self.base = None
+        self.base_index = {}
+        if mode == 'a' and os.path.exists(filename):
+            self.base = open(filename, 'rb')
+            self.base_index = read_index(self.base)[0]
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.file = open(self.temp_filename, 'w+b')
+        self.file.write(MAGIC)
+        self.index = {}
+
+    def put(self, key, array):
+        kind = key.split('/')[0]
+        data = quantize(kind, array)
+        payload = data.tobytes()
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+        with self.lock:
+            if key in self.index:
+                self.dead_bytes += self.index[key]['nbytes']
+            offset = self.file.tell()
+            self.file.write(payload)
+            self.index[key] = {'offset': offset, 'nbytes': len(payload), 'dtype': data.dtype.str,
+                               'shape': list(data.shape), 'compressed': self.compress}
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            # previous records that were not put again
+            records = [(key, entry, self.base) for key, entry in self.base_index.items() if key not in self.index]
+            if self.dead_bytes > 0:
+                compact_filename = self.filename + '.compact'
+                with open(compact_filename, 'wb') as compact:
+                    compact.write(MAGIC)
+                    index = copy_records(compact, [(key, entry, self.file) for key, entry in self.index.items()] +
+                                         records)
+                    write_index(compact, index)
+                self.file.close()
+                os.remove(self.temp_filename)
+                os.replace(compact_filename, self.filename)
+            else:
+                self.file.seek(0, os.SEEK_END)
+                self.index.update(copy_records(self.file, records))
+                write_index(self.file, self.index)
+                self.file.close()
+                os.replace(self.temp_filename, self.filename)
+            self.file = None
+            if self.base is not None:
+                self.base.close()
+                self.base = None
+
+    # drop the records put since the writer was opened, filename is left as it was
+    def abort(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.file = None
+            os.remove(self.temp_filename)
+            if self.base is not None:
+                self.base.close()
+                self.base = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class DepthArchive(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.index = read_index(self.file)[0]
+        self.lock = threading.Lock()
+
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    # records are always decoded into a new array, contiguous is accepted for DepthFolder compatibility
+    def get(self, key, contiguous=True):
+        entry = self.index[key]
+        with self.lock:
+            self.file.seek(entry['offset'])
+            payload = self.file.read(entry['nbytes'])
+        if entry['compressed']:
+            payload = zlib.decompress(payload)
+        data = np.frombuffer(payload, dtype=entry['dtype']).reshape(entry['shape'])
+        return dequantize(key.split('/')[0], data)
+
+    def close(self):
+        self.file.close()
+
+
+# the per-view pfm/png files written without an archive, read through the same interface
+class DepthFolder(object):
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def path(self, key):
+        ext = '.png' if key.startswith('mask/') else '.pfm'
+        return os.path.join(self.folder, key + ext)
+
+    # contiguous=False returns the flipped read-only view of read_pfm(mmap=True)
+    def get(self, key, contiguous=True):
+        if key.startswith('mask/'):
+            return np.array(Image.open(self.path(key))) > 0
+        return read_pfm(self.path(key), mmap=True, contiguous=contiguous)[0]
+
+    def close(self):
+        pass
+
+
+# read from folder/archive_name when it exists, from the pfm/png files otherwise
+def open_depth_source(folder, archive_name=ARCHIVE_NAME):
+    archive_filename = os.path.join(folder, archive_name)
+    if os.path.exists(archive_filename):
+        return DepthArchive(archive_filename)
+    return DepthFolder(folder)
@@ -3,11 +3,13 @@ import numpy as np
 import os
 from PIL import Image
 from datasets.data_io import *
+from datasets.manifest import get_manifest
+from datasets.image_cache import SharedImageCache, load_cached
 
 
 # the DTU dataset preprocessed by Yao Yao (only for training)
 class MVSDataset(Dataset):
-    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=False, origin_size=False, light_idx=-1, image_scale=0.25, **kwargs):
+    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=False, origin_size=False, light_idx=-1, image_scale=0.25, img_cache_mb=0, uint8_imgs=False, **kwargs):
         super(MVSDataset, self).__init__()
         self.datapath = datapath
         self.listfile = listfile
@@ -19,62 +21,68 @@ class MVSDataset(Dataset):
         self.origin_size = origin_size
         self.light_idx=light_idx
         self.image_scale = image_scale
+        # uint8 images, scaled to 0~1 by the model on the compute device
+        self.uint8_imgs = uint8_imgs
+        # decoded images shared by the DataLoader workers, created before they are forked
+        self.img_cache = SharedImageCache(img_cache_mb * 2 ** 20) if img_cache_mb > 0 else None
         print('dataset: inverse_depth {}, origin_size {}, light_idx:{}, image_scale:{}'.format(self.inverse_depth, self.origin_size, self.light_idx, self.image_scale))
         
         assert self.mode in ["train", "val", "test"]
         self.metas = self.build_list()
 
     def build_list(self):
-        metas = []
         with open(self.listfile) as f:
             scans = f.readlines()
             scans = [line.rstrip() for line in scans]
 
-        # scans
-        for scan in scans:
-            pair_file = "Cameras/pair.txt"
-            # read the pair file
-            with open(os.path.join(self.datapath, pair_file)) as f:
-                num_viewpoint = int(f.readline())
-                # viewpoints (49)
-                for view_idx in range(num_viewpoint):
-                    ref_view = int(f.readline().rstrip())
-                    src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
-                    # light conditions 0-6
-                    if self.light_idx == -1:
-                        for light_idx in range(7):
-                            metas.append((scan, light_idx, ref_view, src_views))
-                    else:
-                        metas.append((scan, self.light_idx, ref_view, src_views))
+        # all scans share the same cameras and pair file
+        self.manifest = get_manifest(os.path.join(self.datapath, 'Cameras/train'),
+                                     os.path.join(self.datapath, 'Cameras/pair.txt'))
+        # scans x viewpoints (49) x light conditions 0-6
+        lights = list(range(7)) if self.light_idx == -1 else [self.light_idx]
+        metas = self.manifest.metas(scans, lights)
         print("dataset", self.mode, "metas:", len(metas))
         return metas
 
     def __len__(self):
         return len(self.metas)
 
-    def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
-        # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale
+    # cameras are parsed once per process by the manifest
+    def read_cam(self, vid):
+        intrinsics, extrinsics, depth_min, depth_interval, _ = self.manifest.camera(vid)
+        depth_interval = depth_interval * self.interval_scale
         return intrinsics, extrinsics, depth_min, depth_interval
 
+    def decode_img(self, filename):
+        return np.array(Image.open(filename))
+
     def read_img(self, filename):
-        img = Image.open(filename)
         # scale 0~255 to 0~1
-        np_img = np.array(img, dtype=np.float32) / 255.
+        np_img = self.decode_img(filename).astype(np.float32) / 255.
         return np_img
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
-        
+        return read_pfm(filename, mmap=True, contiguous=True)[0]
+
+    def depth_filename(self, scan, vid):
+        return os.path.join(self.datapath, 'Depths/{}_train/depth_map_{:0>4}.pfm'.format(scan, vid))
+
+    # image of a view under one light condition, float32 in [0, 1] (uint8 if uint8_imgs), [H, W, 3]
+    def load_img(self, scan, vid, light_idx):
+        # NOTE that the id in image file names is from 1 to 49 (not 0~48)
+        img_filename = os.path.join(self.datapath,
+                                    'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
+        img = load_cached(self.img_cache, (scan, vid, light_idx, 0), self.decode_img, img_filename)
+        if self.uint8_imgs:
+            return img
+        # scale 0~255 to 0~1
+        return img.astype(np.float32) / 255.
+
+    # ground truth depth of a view, float32 [H/4, W/4]
+    def load_depth(self, scan, vid):
+        return self.read_depth(self.depth_filename(scan, vid))
+
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
@@ -88,18 +96,10 @@ class MVSDataset(Dataset):
         depth_values = None
         proj_matrices = []
         for i, vid in enumerate(view_ids):
-            # NOTE that the id in image file names is from 1 to 49 (not 0~48)
-            img_filename = os.path.join(self.datapath,
-                                        'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
-            
-            depth_filename = os.path.join(self.datapath, 'Depths/{}_train/depth_map_{:0>4}.pfm'.format(scan, vid))
-            mask_filename = os.path.join(self.datapath, 'Depths/{}_train/depth_visual_{:0>4}.png'.format(scan, vid))
-            proj_mat_filename = os.path.join(self.datapath, 'Cameras/train/{:0>8}_cam.txt').format(vid)
             if i == 0:
-                depth_name = depth_filename
-            #print('debug in dtu_yao', i, depth_filename)
-            imgs.append(self.read_img(img_filename))
-            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename)
+                depth_name = self.depth_filename(scan, vid)
+            imgs.append(self.load_img(scan, vid, light_idx))
+            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam(vid)
 
             # multiply intrinsics and extrinsics to get projection matrix
             proj_mat = extrinsics.copy()
@@ -118,8 +118,7 @@ class MVSDataset(Dataset):
                                             dtype=np.float32) # the set is [)
                     depth_end = depth_interval * self.ndepths + depth_min
                 
-                #mask = self.read_img(mask_filename)
-                depth = self.read_depth(depth_filename)
+                depth = self.load_depth(scan, vid)
                 mask = np.array((depth > depth_min+depth_interval) & (depth < depth_min+(self.ndepths-2)*depth_interval), dtype=np.float32)
 
         imgs = np.stack(imgs).transpose([0, 3, 1, 2])
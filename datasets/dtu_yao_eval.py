@@ -3,11 +3,16 @@ import numpy as np
 import os
 from PIL import Image
 from datasets.data_io import *
+from datasets.manifest import get_manifest
+from datasets.image_cache import SharedImageCache, load_cached
+
+# image size of the downsampled pyramid levels, before cropping
+PYRAMID_SIZES = {1: (800, 600), 2: (400, 300)}
 
 
 # the DTU dataset preprocessed by Yao Yao (only for training)
 class MVSDataset(Dataset):
-    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=True, pyramid=0, **kwargs):
+    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=True, pyramid=0, img_cache_mb=0, uint8_imgs=False, pyramid_levels=None, pyramid_resample='bilinear', jpeg_draft=False, **kwargs):
         super(MVSDataset, self).__init__()
         self.datapath = datapath
         self.listfile = listfile
@@ -17,8 +22,20 @@ class MVSDataset(Dataset):
         self.interval_scale = interval_scale
         self.inverse_depth = inverse_depth
         self.pyramid = pyramid
-
-        print('dataset: inverse_depth {}'.format(self.inverse_depth), 'pyramid: {}'.format(self.pyramid))
+        # decode each image once and return every level in pyramid_levels, e.g. [0, 1, 2], in one sample
+        self.pyramid_levels = pyramid_levels
+        # 'bilinear': PIL bilinear resize as in the single level runs, 'area': PIL box reduce (faster)
+        self.pyramid_resample = pyramid_resample
+        # decode JPEGs of levels 1 and 2 directly at 1/2 or 1/4 resolution (DCT scaling)
+        self.jpeg_draft = jpeg_draft
+        # uint8 images, scaled to 0~1 by the model on the compute device
+        self.uint8_imgs = uint8_imgs
+        # decoded images shared by the DataLoader workers, created before they are forked
+        self.img_cache = SharedImageCache(img_cache_mb * 2 ** 20) if img_cache_mb > 0 else None
+
+        print('dataset: inverse_depth {}'.format(self.inverse_depth), 'pyramid: {}'.format(self.pyramid),
+              'pyramid_levels: {}'.format(self.pyramid_levels))
+        assert self.pyramid_resample in ['bilinear', 'area']
         assert self.mode == "test"
         self.metas = self.build_list()
 
@@ -29,107 +46,154 @@ class MVSDataset(Dataset):
             scans = [line.rstrip() for line in scans]
 
         # scans
+        self.manifests = {}
         for scan in scans:
-            pair_file = "{}/pair.txt".format(scan)
-            # read the pair file
-            with open(os.path.join(self.datapath, pair_file)) as f:
-                num_viewpoint = int(f.readline())
-                # viewpoints (49)
-                for view_idx in range(num_viewpoint):
-                    ref_view = int(f.readline().rstrip())
-                    src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
-                    metas.append((scan, ref_view, src_views))
+            self.manifests[scan] = get_manifest(os.path.join(self.datapath, '{}/cams'.format(scan)),
+                                                os.path.join(self.datapath, '{}/pair.txt'.format(scan)))
+            # viewpoints (49)
+            for ref_view, src_views in self.manifests[scan].pairs():
+                metas.append((scan, ref_view, src_views))
         print("dataset", self.mode, "metas:", len(metas))
         return metas
 
     def __len__(self):
         return len(self.metas)
 
-    def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    # cameras are parsed once per process by the manifest
+    def read_cam(self, scan, vid):
+        intrinsics, extrinsics, depth_min, depth_interval, _ = self.manifests[scan].camera(vid)
         intrinsics[:2, :] /= 4
-        # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale
+        depth_interval = depth_interval * self.interval_scale
         return intrinsics, extrinsics, depth_min, depth_interval
 
-    def read_img(self, filename):
+    # resize a decoded PIL image to a pyramid level
+    def resize_img(self, img, pyramid):
+        if pyramid not in PYRAMID_SIZES:
+            return img
+        size = PYRAMID_SIZES[pyramid]
+        if img.size == size:
+            # already decoded at this size by draft
+            return img
+        if self.pyramid_resample == 'area':
+            return img.reduce(img.size[0] // size[0])
+        return img.resize(size, Image.BILINEAR)
+
+    def open_img(self, filename, pyramid):
         img = Image.open(filename)
-        if self.pyramid == 0:
-            # scale 0~255 to 0~1
-            np_img = np.array(img, dtype=np.float32) / 255.
+        if self.jpeg_draft and pyramid in PYRAMID_SIZES:
+            # the decoder picks the smallest 1/2^k scale that is still >= the requested size,
+            # resize_img then only has to handle the remaining difference
+            img.draft('RGB', PYRAMID_SIZES[pyramid])
+        return img
+
+    # decoded uint8 image resized to the pyramid level
+    def decode_img(self, filename):
+        return np.array(self.resize_img(self.open_img(filename, self.pyramid), self.pyramid))
+
+    # decoded uint8 images of several pyramid levels, the JPEG is decoded only once
+    def decode_pyramid(self, filename, levels):
+        # decoded at the resolution of the largest level
+        img = self.open_img(filename, min(levels))
+        img.load()
+        return {pyramid: np.array(self.resize_img(img, pyramid)) for pyramid in levels}
+
+    # crop a decoded image and scale 0~255 to 0~1 (kept uint8 if uint8_imgs)
+    def normalize_img(self, np_img, pyramid=None):
+        if pyramid is None:
+            pyramid = self.pyramid
+        if pyramid == 0:
             # assert np_img.shape[:2] == (1200, 1600)
             # # crop to (1184, 1600)
             np_img = np_img[:-16, :]  # do not need to modify intrinsics if cropping the bottom part
-        elif self.pyramid == 1:
-            img = img.resize((800, 600), Image.BILINEAR)
-            # scale 0~255 to 0~1
-            np_img = np.array(img, dtype=np.float32) / 255.
+        elif pyramid == 1:
             assert np_img.shape[:2] == (600, 800)
             # crop to (600, 800) using -24
             np_img = np_img[:-24, :]
-        elif self.pyramid == 2:
-            img = img.resize((400, 300), Image.BILINEAR)
-            # scale 0~255 to 0~1
-            np_img = np.array(img, dtype=np.float32) / 255.
+        elif pyramid == 2:
             assert np_img.shape[:2] == (300, 400)
             # crop to (600, 800) using -24
             np_img = np_img[:-12, :-16]  # do not need to modify intrinsics if cropping the bottom part
         else:
             print("Wrong pyramid")
 
-        return np_img
+        if self.uint8_imgs:
+            return np_img
+        return np_img.astype(np.float32) / 255.
+
+    def read_img(self, filename):
+        return self.normalize_img(self.decode_img(filename))
+
+    def img_filename(self, scan, vid):
+        return os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
+
+    def load_img(self, scan, vid):
+        return self.normalize_img(load_cached(self.img_cache, (scan, vid, -1, self.pyramid), self.decode_img,
+                                              self.img_filename(scan, vid)))
+
+    # {pyramid: image} for every level in pyramid_levels
+    def load_pyramid(self, scan, vid):
+        np_imgs = {}
+        if self.img_cache is not None:
+            for pyramid in self.pyramid_levels:
+                np_imgs[pyramid] = self.img_cache.get((scan, vid, -1, pyramid))
+        missing = sorted(pyramid for pyramid in self.pyramid_levels if np_imgs.get(pyramid) is None)
+        if missing:
+            decoded = self.decode_pyramid(self.img_filename(scan, vid), missing)
+            for pyramid in missing:
+                if self.img_cache is not None:
+                    self.img_cache.put((scan, vid, -1, pyramid), decoded[pyramid])
+                np_imgs[pyramid] = decoded[pyramid]
+        return {pyramid: self.normalize_img(np_imgs[pyramid], pyramid) for pyramid in self.pyramid_levels}
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, mmap=True, contiguous=True)[0]
+
+    def build_depth_values(self, depth_min, depth_interval):
+        if self.inverse_depth: #slice inverse depth
+            print('inverse depth')
+            depth_end = depth_interval * self.ndepths + depth_min
+            depth_values = np.linspace(1.0 / depth_min, 1.0 / depth_end, self.ndepths, endpoint=False)
+            depth_values = 1.0 / depth_values
+            depth_values = depth_values.astype(np.float32)
+        else:
+            depth_values = np.arange(depth_min, depth_interval * self.ndepths + depth_min, depth_interval,
+                                    dtype=np.float32) # the set is [)
+        return depth_values
+
+    # multiply intrinsics (scaled to the pyramid level) and extrinsics to get projection matrix
+    def proj_matrix(self, intrinsics, extrinsics, pyramid):
+        intrinsics = intrinsics.copy()
+        # To scale
+        if pyramid == 1:
+            intrinsics[:2, :] /= 2
+        elif pyramid == 2:
+            intrinsics[:2, :] /= 4
+        proj_mat = extrinsics.copy()
+        proj_mat[:3, :4] = np.matmul(intrinsics, proj_mat[:3, :4])
+        return proj_mat
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
         scan, ref_view, src_views = meta
         # use only the reference view and first nviews-1 source views
         view_ids = [ref_view] + src_views[:self.nviews - 1]
+        filename = scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"
+
+        if self.pyramid_levels is not None:
+            return self.get_pyramid_item(scan, view_ids, filename)
 
         imgs = []
-        mask = None
-        depth = None
         depth_values = None
         proj_matrices = []
 
         for i, vid in enumerate(view_ids):
-            img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
-            proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
-
-            imgs.append(self.read_img(img_filename))
-            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename)
-
-            # multiply intrinsics and extrinsics to get projection matrix
-             # To scale 
-            if self.pyramid == 1:
-                intrinsics[:2, :] /= 2
-            elif self.pyramid == 2:
-                intrinsics[:2, :] /= 4
-            proj_mat = extrinsics.copy()
-            proj_mat[:3, :4] = np.matmul(intrinsics, proj_mat[:3, :4])
-            proj_matrices.append(proj_mat)
+            imgs.append(self.load_img(scan, vid))
+            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam(scan, vid)
+            proj_matrices.append(self.proj_matrix(intrinsics, extrinsics, self.pyramid))
 
             if i == 0:  # reference view: old version to delete
-                if self.inverse_depth: #slice inverse depth
-                    print('inverse depth')
-                    depth_end = depth_interval * self.ndepths + depth_min
-                    depth_values = np.linspace(1.0 / depth_min, 1.0 / depth_end, self.ndepths, endpoint=False)
-                    depth_values = 1.0 / depth_values
-                    depth_values = depth_values.astype(np.float32)
-                else:
-                    depth_values = np.arange(depth_min, depth_interval * self.ndepths + depth_min, depth_interval,
-                                            dtype=np.float32) # the set is [)
-                    depth_end = depth_interval * self.ndepths + depth_min
+                depth_values = self.build_depth_values(depth_min, depth_interval)
 
         imgs = np.stack(imgs).transpose([0, 3, 1, 2])
         proj_matrices = np.stack(proj_matrices)
@@ -137,5 +201,30 @@ class MVSDataset(Dataset):
         return {"imgs": imgs,
                 "proj_matrices": proj_matrices,
                 "depth_values": depth_values,
-                "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"}
+                "view_ids": np.array(view_ids),
+                "filename": filename}
 
+    # one sample with every level in pyramid_levels: {"pyramid": {level: {"imgs", "proj_matrices", "depth_values"}}}
+    def get_pyramid_item(self, scan, view_ids, filename):
+        imgs = {pyramid: [] for pyramid in self.pyramid_levels}
+        proj_matrices = {pyramid: [] for pyramid in self.pyramid_levels}
+        depth_values = None
+
+        for i, vid in enumerate(view_ids):
+            for pyramid, img in self.load_pyramid(scan, vid).items():
+                imgs[pyramid].append(img)
+            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam(scan, vid)
+            for pyramid in self.pyramid_levels:
+                proj_matrices[pyramid].append(self.proj_matrix(intrinsics, extrinsics, pyramid))
+
+            if i == 0:  # reference view
+                depth_values = self.build_depth_values(depth_min, depth_interval)
+
+        levels = {}
+        for pyramid in self.pyramid_levels:
+            levels[pyramid] = {"imgs": np.stack(imgs[pyramid]).transpose([0, 3, 1, 2]),
+                               "proj_matrices": np.stack(proj_matrices[pyramid]),
+                               "depth_values": depth_values.copy()}
+        return {"pyramid": levels,
+                "view_ids": np.array(view_ids),
+                "filename": filename}
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+from datasets.dtu_yao import MVSDataset as DTUDataset
+
+# DTU training set pre-decoded by tools/pack_dtu.py, one shard folder per scan:
+#   {shard_path}/{scan}_train/imgs.npy    uint8 [num_views, 7 lights, H, W, 3]
+#   {shard_path}/{scan}_train/depths.npy  float16 (or float32) [num_views, H/4, W/4]
+# The shards are memory-mapped, a sample only slices the views it uses, no PNG/PFM decoding.
+IMGS_NAME = 'imgs.npy'
+DEPTHS_NAME = 'depths.npy'
+
+
+def shard_folder(shard_path, scan):
+    return os.path.join(shard_path, '{}_train'.format(scan))
+
+
+# same samples as dtu_yao.MVSDataset, select with --dataset dtu_yao_shard
+class MVSDataset(DTUDataset):
+    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=False, origin_size=False, light_idx=-1, image_scale=0.25, shard_path=None, **kwargs):
+        self.shard_path = shard_path if shard_path is not None else os.path.join(datapath, 'Shards')
+        # scan -> (imgs, depths) memmaps, opened lazily in each DataLoader worker
+        self.shards = {}
+        super(MVSDataset, self).__init__(datapath, listfile, mode, nviews, ndepths, interval_scale, inverse_depth,
+                                         origin_size, light_idx, image_scale, **kwargs)
+
+    def get_shard(self, scan):
+        if scan not in self.shards:
+            folder = shard_folder(self.shard_path, scan)
+            if not os.path.exists(os.path.join(folder, IMGS_NAME)):
+                raise Exception('no shard for {} in {}, run tools/pack_dtu.py first'.format(scan, self.shard_path))
+            self.shards[scan] = (np.load(os.path.join(folder, IMGS_NAME), mmap_mode='r'),
+                                 np.load(os.path.join(folder, DEPTHS_NAME), mmap_mode='r'))
+        return self.shards[scan]
+
+    def load_img(self, scan, vid, light_idx):
+        imgs = self.get_shard(scan)[0]
+        if self.uint8_imgs:
+            return np.array(imgs[vid, light_idx])
+        # scale 0~255 to 0~1
+        return imgs[vid, light_idx].astype(np.float32) / 255.
+
+    def load_depth(self, scan, vid):
+        depths = self.get_shard(scan)[1]
+        return depths[vid].astype(np.float32)
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+# Decoded depth maps, confidences and cameras of the views of one scan in the depth fusion (eval.py,
+# tools/filter_fusion.py). The depth map of a view is used as the reference and as a source of up to 10 other
+# views. Through the cache it is read (decoded from the archive, upsampled by filter_fusion.py) once per scan, as
+# long as it is not evicted: the least recently used entries are dropped beyond capacity_bytes, and an entry larger
+# than capacity_bytes is not kept (capacity_bytes=0 disables the cache).
+# The cached arrays are shared by all the reference views that use them and are made read-only.
+class FusionCache(object):
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = int(capacity_bytes)
+        # key -> (value, nbytes)
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # the value of key, load() on a miss: an array or a tuple of arrays
+    # keep=False returns the loaded value without caching it, for the data used only once per scan
+    def get(self, key, load, keep=True):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key][0]
+        self.misses += 1
+        value = load()
+        arrays = value if isinstance(value, tuple) else (value,)
+        nbytes = sum(array.nbytes for array in arrays)
+        if not keep or nbytes > self.capacity_bytes:
+            return value
+        for array in arrays:
+            array.setflags(write=False)
+        while self.nbytes + nbytes > self.capacity_bytes:
+            self.nbytes -= self.cache.popitem(last=False)[1][1]
+            self.evictions += 1
+        self.cache[key] = (value, nbytes)
+        self.nbytes += nbytes
+        return value
+
+    def clear(self):
+        self.cache.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / max(1, self.hits + self.misses), 'cached_mb': self.nbytes / 1024 / 1024}
@@ -0,0 +1,106 @@
+import hashlib
+import mmap
+import multiprocessing
+import numpy as np
+
+# shared header, int64 entries
+HITS, MISSES, EVICTIONS, TICK, SLOT_BYTES = range(5)
+HEADER_SIZE = 8
+# one row per slot, key 0 marks an empty slot
+SLOT_DTYPE = np.dtype([('key', '<u8'), ('tick', '<i8'), ('shape', '<i4', (3,)), ('ndim', '<i4')])
+
+
+def key_hash(key):
+    digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest()
+    return max(1, int.from_bytes(digest, 'little'))
+
+
+# Decoded uint8 images shared by all DataLoader workers of a dataset, keyed by (scan, view, light, pyramid level).
+# The buffer is an anonymous shared mmap created in the main process. Workers forked by the DataLoader inherit it
+# together with the lock, so an image decoded by one worker is a hit for every other worker.
+# The capacity is split into equal slots, sized by the first image stored unless slot_bytes is given;
+# larger images are not cached. The least recently used slot is evicted when the cache is full.
+class SharedImageCache(object):
+    def __init__(self, capacity_bytes, slot_bytes=0, max_slots=4096):
+        self.capacity_bytes = int(capacity_bytes)
+        self.max_slots = max_slots
+        self.lock = multiprocessing.Lock()
+        header_bytes = HEADER_SIZE * 8
+        table_bytes = max_slots * SLOT_DTYPE.itemsize
+        self.data_offset = header_bytes + table_bytes
+        # pages are only committed when written, a large capacity costs nothing until it is filled
+        self.buffer = mmap.mmap(-1, self.data_offset + self.capacity_bytes)
+        self.header = np.frombuffer(self.buffer, dtype=np.int64, count=HEADER_SIZE)
+        self.table = np.frombuffer(self.buffer, dtype=SLOT_DTYPE, count=max_slots, offset=header_bytes)
+        self.header[SLOT_BYTES] = slot_bytes
+
+    # the mmap only survives fork, a worker started with spawn gets an empty cache of its own
+    def __reduce__(self):
+        return self.__class__, (0,)
+
+    def num_slots(self):
+        slot_bytes = int(self.header[SLOT_BYTES])
+        if slot_bytes == 0:
+            return 0
+        return min(self.max_slots, self.capacity_bytes // slot_bytes)
+
+    def slot(self, row):
+        slot_bytes = int(self.header[SLOT_BYTES])
+        return np.frombuffer(self.buffer, dtype=np.uint8, count=slot_bytes, offset=self.data_offset + row * slot_bytes)
+
+    # copy of the cached image, None on a miss
+    def get(self, key):
+        h = key_hash(key)
+        with self.lock:
+            rows = np.flatnonzero(self.table['key'][:self.num_slots()] == h)
+            if len(rows) == 0:
+                self.header[MISSES] += 1
+                return None
+            row = rows[0]
+            self.header[HITS] += 1
+            self.header[TICK] += 1
+            self.table['tick'][row] = self.header[TICK]
+            shape = tuple(self.table['shape'][row][:self.table['ndim'][row]])
+            return self.slot(row)[:int(np.prod(shape))].reshape(shape).copy()
+
+    # returns False if the image was not cached (larger than a slot or no capacity)
+    def put(self, key, image):
+        assert image.dtype == np.uint8 and image.ndim <= 3
+        image = np.ascontiguousarray(image)
+        h = key_hash(key)
+        with self.lock:
+            if self.header[SLOT_BYTES] == 0:
+                self.header[SLOT_BYTES] = image.nbytes
+            num_slots = self.num_slots()
+            if image.nbytes > self.header[SLOT_BYTES] or num_slots == 0:
+                return False
+            keys = self.table['key'][:num_slots]
+            if (keys == h).any():
+                # decoded concurrently by another worker
+                return True
+            empty = np.flatnonzero(keys == 0)
+            if len(empty) > 0:
+                row = empty[0]
+            else:
+                row = np.argmin(self.table['tick'][:num_slots])
+                self.header[EVICTIONS] += 1
+            self.slot(row)[:image.nbytes] = image.reshape(-1)
+            self.header[TICK] += 1
+            self.table[row] = (h, self.header[TICK], image.shape + (1,) * (3 - image.ndim), image.ndim)
+            return True
+
+    def stats(self):
+        hits, misses = int(self.header[HITS]), int(self.header[MISSES])
+        return {'hits': hits, 'misses': misses, 'evictions': int(self.header[EVICTIONS]),
+                'hit_rate': hits / max(1, hits + misses), 'slots': self.num_slots()}
+
+
+# decode(filename) through the cache, or directly when cache is None
+def load_cached(cache, key, decode, filename):
+    if cache is None:
+        return decode(filename)
+    img = cache.get(key)
+    if img is None:
+        img = decode(filename)
+        cache.put(key, img)
+    return img
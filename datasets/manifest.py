@@ -0,0 +1,178 @@
+import os
+import zipfile
+import numpy as np
+
+# Cameras and view pairs of a scan parsed once into contiguous arrays.
+# The arrays are cached in a binary sidecar (.manifest.npz) in the camera folder, which is rebuilt
+# when the pair file or any camera file has a different mtime than when it was written.
+SIDECAR_NAME = '.manifest.npz'
+MANIFEST_VERSION = 1
+
+# per process cache, filled before the DataLoader forks its workers
+_manifests = {}
+
+
+# read one camera file: intrinsics, extrinsics and line 11 (depth_min, depth_interval[, depth_num, depth_max])
+def read_cam_file(filename):
+    with open(filename) as f:
+        lines = f.readlines()
+        lines = [line.rstrip() for line in lines]
+    # extrinsics: line [1,5), 4x4 matrix
+    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
+    # intrinsics: line [7-10), 3x3 matrix
+    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    depth_params = lines[11].split()
+    depth_min = float(depth_params[0])
+    depth_interval = float(depth_params[1])
+    depth_max = float(depth_params[3]) if len(depth_params) > 3 else np.nan
+    return intrinsics, extrinsics, depth_min, depth_interval, depth_max
+
+
+# read a pair file, [(ref_view1, [src_view1-1, ...], [score1-1, ...]), ...]
+def read_pair_file(filename):
+    data = []
+    with open(filename) as f:
+        num_viewpoint = int(f.readline())
+        for view_idx in range(num_viewpoint):
+            ref_view = int(f.readline().rstrip())
+            line = f.readline().rstrip().split()
+            src_views = [int(x) for x in line[1::2]]
+            scores = [float(x) for x in line[2::2]]
+            data.append((ref_view, src_views, scores))
+    return data
+
+
+class ScanManifest(object):
+    def __init__(self, cam_dir, pair_file, cam_name='{:0>8}_cam.txt'):
+        self.cam_dir = cam_dir
+        self.pair_file = pair_file
+        self.cam_name = cam_name
+        self.sidecar = os.path.join(cam_dir, SIDECAR_NAME)
+
+        arrays = self.load()
+        if arrays is None:
+            arrays = self.build()
+            self.save(arrays)
+        for key, value in arrays.items():
+            setattr(self, key, value)
+
+        # view id -> row in the camera arrays, -1 if the view has no camera
+        self.cam_row = np.full(self.view_ids.max() + 1, -1, dtype=np.int64)
+        self.cam_row[self.view_ids] = np.arange(len(self.view_ids))
+
+    def cam_files(self, view_ids):
+        return [os.path.join(self.cam_dir, self.cam_name.format(vid)) for vid in view_ids]
+
+    def stat_mtimes(self, view_ids):
+        return np.array([os.stat(filename).st_mtime_ns for filename in [self.pair_file] + self.cam_files(view_ids)],
+                        dtype=np.int64)
+
+    def build(self):
+        pairs = read_pair_file(self.pair_file)
+        num_src = np.array([len(src_views) for _, src_views, _ in pairs], dtype=np.int32)
+        ref_views = np.array([ref_view for ref_view, _, _ in pairs], dtype=np.int32)
+        # source views and scores padded with -1 to the longest list
+        src_views = np.full((len(pairs), max(num_src.max(), 1)), -1, dtype=np.int32)
+        src_scores = np.full(src_views.shape, -1, dtype=np.float32)
+        for i, (_, views, scores) in enumerate(pairs):
+            src_views[i, :len(views)] = views
+            src_scores[i, :len(scores)] = scores
+
+        view_ids = np.unique(np.concatenate([ref_views, src_views[src_views >= 0]])).astype(np.int32)
+        cams = [read_cam_file(filename) for filename in self.cam_files(view_ids)]
+        return {'view_ids': view_ids,
+                'intrinsics': np.stack([cam[0] for cam in cams]),
+                'extrinsics': np.stack([cam[1] for cam in cams]),
+                'depth_params': np.array([cam[2:] for cam in cams], dtype=np.float64),  # depth_min, interval, max
+                'ref_views': ref_views,
+                'src_views': src_views,
+                'src_scores': src_scores,
+                'num_src': num_src,
+                'mtimes': self.stat_mtimes(view_ids)}
+
+    def load(self):
+        if not os.path.exists(self.sidecar):
+            return None
+        try:
+            with np.load(self.sidecar) as data:
+                arrays = {key: data[key] for key in data.files}
+            if int(arrays.pop('version')) != MANIFEST_VERSION:
+                return None
+            if str(arrays.pop('pair_file')) != os.path.abspath(self.pair_file):
+                return None
+            if not np.array_equal(arrays['mtimes'], self.stat_mtimes(arrays['view_ids'])):
+                return None
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # unreadable or truncated sidecar, rebuilt
+            return None
+        return arrays
+
+    def save(self, arrays):
+        tmp_file = '{}.{}.tmp'.format(self.sidecar, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, version=MANIFEST_VERSION, pair_file=os.path.abspath(self.pair_file), **arrays)
+            os.replace(tmp_file, self.sidecar)
+        except OSError:
+            # read-only dataset folder, keep the in-memory manifest only
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    # intrinsics, extrinsics, depth_min, depth_interval, depth_max (nan if not in the camera file)
+    # the matrices are copies, callers may rescale them in place
+    def camera(self, view):
+        row = self.cam_row[view]
+        if row < 0:
+            raise KeyError('no camera for view {} in {}'.format(view, self.cam_dir))
+        depth_min, depth_interval, depth_max = self.depth_params[row]
+        return self.intrinsics[row].copy(), self.extrinsics[row].copy(), float(depth_min), float(depth_interval), float(depth_max)
+
+    # [(ref_view1, [src_view1-1, ...]), (ref_view2, [src_view2-1, ...]), ...]
+    def pairs(self):
+        return [(int(ref_view), self.src_views[i, :self.num_src[i]].tolist()) for i, ref_view in enumerate(self.ref_views)]
+
+    # [[score1-1, ...], [score2-1, ...], ...]
+    def scores(self):
+        return [self.src_scores[i, :self.num_src[i]].tolist() for i in range(len(self.ref_views))]
+
+    # training samples of the scans: every (scan, ref_view) under every light in lights
+    def metas(self, scans, lights):
+        num_pairs, num_lights = len(self.ref_views), len(lights)
+        metas = np.zeros(len(scans) * num_pairs * num_lights, dtype=meta_dtype(self.src_views.shape[1]))
+        pair_idx = np.tile(np.repeat(np.arange(num_pairs), num_lights), len(scans))
+        metas['scan'] = np.repeat(np.arange(len(scans)), num_pairs * num_lights)
+        metas['light'] = np.tile(lights, len(scans) * num_pairs)
+        metas['ref_view'] = self.ref_views[pair_idx]
+        metas['num_src'] = self.num_src[pair_idx]
+        metas['src_views'] = self.src_views[pair_idx]
+        return MetaIndex(scans, metas)
+
+
+def meta_dtype(max_src):
+    return np.dtype([('scan', '<i2'), ('light', '<i1'), ('ref_view', '<i2'), ('num_src', '<i2'),
+                     ('src_views', '<i2', (max_src,))])
+
+
+# Samples of a dataset as one structured array and a scan name table, instead of a list of tuples of lists.
+# The arrays hold no python objects, so the pages forked into the DataLoader workers are never written
+# by refcounting and stay shared with the main process.
+# metas[idx] returns (scan, light_idx, ref_view, src_views) like the list it replaces.
+class MetaIndex(object):
+    def __init__(self, scans, metas):
+        self.scans = np.array(scans, dtype=np.str_)
+        self.metas = metas
+
+    def __len__(self):
+        return len(self.metas)
+
+    def __getitem__(self, idx):
+        meta = self.metas[idx]
+        return (str(self.scans[meta['scan']]), int(meta['light']), int(meta['ref_view']),
+                meta['src_views'][:meta['num_src']].tolist())
+
+
+def get_manifest(cam_dir, pair_file, cam_name='{:0>8}_cam.txt'):
+    key = (os.path.abspath(cam_dir), os.path.abspath(pair_file), cam_name)
+    if key not in _manifests:
+        _manifests[key] = ScanManifest(cam_dir, pair_file, cam_name)
+    return _manifests[key]
@@ -0,0 +1,115 @@
+import atexit
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from PIL import Image
+from datasets.data_io import save_pfm
+
+
+# save a uint8 or bool image as png, bool masks are stored as 0/255
+def save_png(filename, image):
+    if image.dtype == np.bool_:
+        image = image.astype(np.uint8) * 255
+    Image.fromarray(image).save(filename)
+
+
+# Write depth/confidence/mask arrays in background threads so that the model does not wait on disk.
+# The sink takes ownership of the submitted arrays: do not modify them after submitting.
+# At most max_pending writes are in flight, submit() blocks when the queue is full (backpressure).
+# The first failed write is re-raised in the caller thread by the next submit(), flush() or close().
+class OutputSink(object):
+    def __init__(self, num_workers=4, max_pending=32):
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.made_dirs = set()
+        self.error = None
+        self.closed = False
+        # flush on exit, also when the main loop is left by an exception
+        atexit.register(self.close)
+
+    def makedirs(self, dirname):
+        if dirname in self.made_dirs:
+            return
+        os.makedirs(dirname, exist_ok=True)
+        with self.lock:
+            self.made_dirs.add(dirname)
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e if isinstance(e, IOError) else IOError('background write failed: {}'.format(e))
+        finally:
+            self.slots.release()
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    # run func(*args) in the background
+    def submit(self, func, *args):
+        self.check_error()
+        assert not self.closed, 'OutputSink is closed'
+        self.slots.acquire()
+        if self.executor is None:
+            self.run(func, args)
+            self.check_error()
+            return
+        try:
+            future = self.executor.submit(self.run, func, args)
+        except Exception:
+            # run never gets to release the slot, e.g. after the executor was shut down
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def write_file(self, save_func, filename, image):
+        try:
+            self.makedirs(os.path.dirname(filename))
+            save_func(filename, image)
+        except Exception as e:
+            raise IOError('failed to write {}: {}'.format(filename, e))
+
+    def save_pfm(self, filename, image):
+        self.submit(self.write_file, save_pfm, filename, image)
+
+    def save_png(self, filename, image):
+        self.submit(self.write_file, save_png, filename, image)
+
+    # block until every submitted write is on disk
+    def flush(self):
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        self.check_error()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
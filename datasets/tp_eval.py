@@ -3,11 +3,13 @@ import numpy as np
 import os
 from PIL import Image
 from datasets.data_io import *
+from datasets.manifest import get_manifest
+from datasets.image_cache import SharedImageCache, load_cached
 
 
 # Test Tanks and Temper Dataset
 class MVSDataset(Dataset):
-    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=True, **kwargs):
+    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=True, pyramid=0, img_cache_mb=0, uint8_imgs=False, **kwargs):
         super(MVSDataset, self).__init__()
         self.datapath = datapath
         self.listfile = listfile
@@ -16,6 +18,13 @@ class MVSDataset(Dataset):
         self.ndepths = ndepths
         self.interval_scale = interval_scale
         self.inverse_depth = inverse_depth
+        # the images are used at their original size (bottom cropped), no pyramid levels
+        if pyramid != 0 or kwargs.get('pyramid_levels') is not None:
+            raise Exception('tp_eval supports pyramid 0 only')
+        # uint8 images, scaled to 0~1 by the model on the compute device
+        self.uint8_imgs = uint8_imgs
+        # decoded images shared by the DataLoader workers, created before they are forked
+        self.img_cache = SharedImageCache(img_cache_mb * 2 ** 20) if img_cache_mb > 0 else None
 
         print('dataset: inverse_depth {}'.format(self.inverse_depth))
         assert self.mode == "test"
@@ -28,53 +37,46 @@ class MVSDataset(Dataset):
             scans = [line.rstrip() for line in scans]
 
         # scans
+        self.manifests = {}
         for scan in scans:
-            pair_file = "{}/pair.txt".format(scan)
-            # read the pair file
-            with open(os.path.join(self.datapath, pair_file)) as f:
-                num_viewpoint = int(f.readline())
-                # viewpoints (49)
-                for view_idx in range(num_viewpoint):
-                    ref_view = int(f.readline().rstrip())
-                    src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
-                    metas.append((scan, ref_view, src_views))
+            self.manifests[scan] = get_manifest(os.path.join(self.datapath, '{}/cams'.format(scan)),
+                                                os.path.join(self.datapath, '{}/pair.txt'.format(scan)))
+            # viewpoints (49)
+            for ref_view, src_views in self.manifests[scan].pairs():
+                metas.append((scan, ref_view, src_views))
         print("dataset", self.mode, "metas:", len(metas))
         return metas
 
     def __len__(self):
         return len(self.metas)
 
-    def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    # cameras are parsed once per process by the manifest
+    def read_cam(self, scan, vid):
+        intrinsics, extrinsics, depth_min, depth_interval, depth_max = self.manifests[scan].camera(vid)
         intrinsics[:2, :] /= 4
-        # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
-        depth_max = float(lines[11].split()[3])
-        #if depth_min < 0.105:
-        #    depth_min = 0.106
-        depth_interval = float(lines[11].split()[1])
-        #if depth_interval < 0.0066:
-        #    depth_interval = 0.0066
-        depth_interval = depth_interval * self.interval_scale 
-        # depth_interval = float(lines[11].split()[1]) * self.interval_scale
+        depth_interval = depth_interval * self.interval_scale
         return intrinsics, extrinsics, depth_min, depth_interval, depth_max
 
-    def read_img(self, filename):
-        img = Image.open(filename)
-        np_img = np.array(img, dtype=np.float32) / 255.
+    def decode_img(self, filename):
+        return np.array(Image.open(filename))
+
+    def normalize_img(self, np_img):
         np_img = np_img[:-24, :]  # do not need to modify intrinsics if cropping the bottom part
+        if self.uint8_imgs:
+            return np_img
+        # scale 0~255 to 0~1
+        return np_img.astype(np.float32) / 255.
 
-        return np_img
+    def read_img(self, filename):
+        return self.normalize_img(self.decode_img(filename))
+
+    def load_img(self, scan, vid):
+        img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
+        return self.normalize_img(load_cached(self.img_cache, (scan, vid, -1, 0), self.decode_img, img_filename))
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, mmap=True, contiguous=True)[0]
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
@@ -89,11 +91,8 @@ class MVSDataset(Dataset):
         proj_matrices = []
 
         for i, vid in enumerate(view_ids):
-            img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
-            proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
-
-            imgs.append(self.read_img(img_filename))
-            intrinsics, extrinsics, depth_min, depth_interval, depth_max = self.read_cam_file(proj_mat_filename)
+            imgs.append(self.load_img(scan, vid))
+            intrinsics, extrinsics, depth_min, depth_interval, depth_max = self.read_cam(scan, vid)
 
             # multiply intrinsics and extrinsics to get projection matrix
             proj_mat = extrinsics.copy()
@@ -117,4 +116,5 @@ class MVSDataset(Dataset):
         return {"imgs": imgs,
                 "proj_matrices": proj_matrices,
                 "depth_values": depth_values,
+                "view_ids": np.array(view_ids),
                 "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"}
\ No newline at end of file
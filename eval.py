@@ -15,6 +15,11 @@ from models import *
 from utils import *
 import sys
 from datasets.data_io import read_pfm, save_pfm
+from datasets.output_sink import OutputSink
+from datasets.depth_archive import DepthArchive, DepthArchiveWriter, open_depth_source
+from datasets.manifest import get_manifest
+from datasets.consistency import check_geometric_consistency_views, average_consistent_depth
+from datasets.fusion_cache import FusionCache
 import cv2
 from plyfile import PlyData, PlyElement
 from PIL import Image
@@ -48,7 +53,8 @@ parser.add_argument('--syncbn', help='True or False flag, input should be either
     type=ast.literal_eval, default=False)
 
 parser.add_argument('--light_idx', type=int, default=3, help='select while in test')
-parser.add_argument('--cost_aggregation', type=int, default=0, help='cost aggregation method, default: 0')
+parser.add_argument('--cost_aggregation', type=int, default=0, help='cost aggregation method, default: 0, 100: group-wise correlation')
+parser.add_argument('--gwc_groups', type=int, default=8, help='channel groups of the group-wise correlation cost volume (cost_aggregation 100)')
 parser.add_argument('--view_num', type=int, default=3, help='training view num setting')
 parser.add_argument('--ngpu', type=int, default=4, help='gpu size')
 
@@ -64,14 +70,41 @@ parser.add_argument('--numdepth', type=int, default=192, help='the number of dep
 parser.add_argument('--interval_scale', type=float, default=1.06, help='the depth interval scale')
 
 parser.add_argument('--pyramid', type=int, default=0, help='process the pyramid scale of origin image')
+parser.add_argument('--pyramid_levels', default=None, help='pyramid levels computed in one run, e.g. 0,1,2 (dtu_yao_eval), overrides --pyramid')
+parser.add_argument('--pyramid_resample', default='bilinear', choices=['bilinear', 'area'], help='downsampling of the pyramid levels')
+parser.add_argument('--jpeg_draft', help='True or False flag, input should be either "True" or "False". Decode JPEGs of pyramid 1 and 2 at reduced resolution',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--feature_cache_views', type=int, default=0, help='keep the 2D features of this many views to reuse them across samples of a scan, 0 disables')
 
 parser.add_argument('--loadckpt', default=None, help='load a specific checkpoint')
 parser.add_argument('--outdir', default='./outputs', help='output dir')
 parser.add_argument('--display', action='store_true', help='display depth images and masks')
+parser.add_argument('--fusion_cache_mb', type=int, default=1024, help='keep the depth maps and cameras of a scan read by the fusion in an LRU cache of this size (MB), 0 disables')
+parser.add_argument('--archive', help='True or False flag, input should be either "True" or "False".',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--archive_compress', help='True or False flag, input should be either "True" or "False".',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--num_writers', type=int, default=4, help='background threads writing depth/confidence/mask files, 0 writes synchronously')
+parser.add_argument('--img_cache_mb', type=int, default=0, help='decoded images shared by the data loader workers (MB), 0 disables the cache')
+parser.add_argument('--uint8_imgs', help='True or False flag, input should be either "True" or "False". Load images as uint8 and scale them on the GPU',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--batch_views', help='True or False flag, input should be either "True" or "False". Extract features and warp all views in batched calls',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--depth_chunk', type=int, default=0, help='build the cost volume this many depth hypotheses at a time to bound memory, 0 builds it at once')
+parser.add_argument('--tile_memory_mb', type=int, default=0, help='run warping, regularization and regression on spatial tiles sized to this memory budget (MB), 0 processes the whole image')
+parser.add_argument('--fused_regression', help='True or False flag, input should be either "True" or "False". Regress depth and confidence over depth chunks without the probability volume',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--cascade_depths', type=int, default=0, help='two stage inference with this many hypotheses per pass (a multiple of 8), the second one narrowed per pixel, 0 disables')
+parser.add_argument('--tile_halo', type=int, default=32, help='overlap of the spatial tiles in feature pixels, a multiple of 8')
+parser.add_argument('--channels_last_3d', help='True or False flag, input should be either "True" or "False". Run the cost volumes and the 3D regularization network in the channels_last_3d memory format',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--fold_bn', help='True or False flag, input should be either "True" or "False". Fold the BatchNorm layers into the preceding convolutions after loading the checkpoint',
+    type=ast.literal_eval, default=False)
 
 # parse arguments and check
 args = parser.parse_args()
 print_args(args)
+pyramid_levels = [int(pyramid) for pyramid in args.pyramid_levels.split(',')] if args.pyramid_levels else None
 
 model_name = str.split(args.loadckpt, '/')[-2] + '_' + str.split(args.loadckpt, '/')[-1]
 save_dir = os.path.join(args.outdir, model_name)
@@ -79,15 +112,12 @@ if not os.path.exists(save_dir):
         print('save dir', save_dir)
         os.makedirs(save_dir)
 
-# read intrinsics and extrinsics
-def read_camera_parameters(filename):
-    with open(filename) as f:
-        lines = f.readlines()
-        lines = [line.rstrip() for line in lines]
-    # extrinsics: line [1,5), 4x4 matrix
-    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-    # intrinsics: line [7-10), 3x3 matrix
-    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+# writes outputs in the background while the next sample is processed
+output_sink = OutputSink(args.num_writers)
+
+# read intrinsics and extrinsics from the scan manifest
+def read_camera_parameters(manifest, view):
+    intrinsics, extrinsics = manifest.camera(view)[:2]
     # TODO: assume the feature is 1/4 of the original image size
     intrinsics[:2, :] /= 4
     return intrinsics, extrinsics
@@ -113,32 +143,24 @@ def save_mask(filename, mask):
     Image.fromarray(mask).save(filename)
 
 
-# read a pair file, [(ref_view1, [src_view1-1, ...]), (ref_view2, [src_view2-1, ...]), ...]
-def read_pair_file(filename):
-    data = []
-    with open(filename) as f:
-        num_viewpoint = int(f.readline())
-        # 49 viewpoints
-        for view_idx in range(num_viewpoint):
-            ref_view = int(f.readline().rstrip())
-            src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
-            data.append((ref_view, src_views))
-    return data
-
-
 # run MVS model to save depth maps and confidence maps
 def save_depth():
     # dataset, dataloader
     MVSDataset = find_dataset_def(args.dataset)
     
-    test_dataset = MVSDataset(args.testpath, args.testlist, "test", 5, args.numdepth, args.interval_scale, args.inverse_depth, args.pyramid)
+    test_dataset = MVSDataset(args.testpath, args.testlist, "test", 5, args.numdepth, args.interval_scale, args.inverse_depth, args.pyramid, img_cache_mb=args.img_cache_mb, uint8_imgs=args.uint8_imgs,
+                              pyramid_levels=pyramid_levels, pyramid_resample=args.pyramid_resample,
+                              jpeg_draft=args.jpeg_draft)
     TestImgLoader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_workers=4, drop_last=False)
 
     # model
     if args.model == 'mvsnet':
         print('use MVSNet')
         model = MVSNet(refine=args.refine, fea_net=args.fea_net, cost_net=args.cost_net,
-                refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation, dp_ratio=args.dp_ratio)
+                refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation, dp_ratio=args.dp_ratio, batch_views=args.batch_views,
+                depth_chunk=args.depth_chunk, tile_memory_mb=args.tile_memory_mb, tile_halo=args.tile_halo,
+                fused_regression=args.fused_regression, cascade_depths=args.cascade_depths,
+                channels_last_3d=args.channels_last_3d, gwc_groups=args.gwc_groups)
     else: 
         print('input pre-defined model')
     model = nn.DataParallel(model)
@@ -149,7 +171,36 @@ def save_depth():
     state_dict = torch.load(args.loadckpt)
     model.load_state_dict(state_dict['model'])
     model.eval()
+    if args.fold_bn:
+        print('fold BatchNorm into the convolutions')
+        fold_batchnorm(model)
+    # features of each view computed once per scan instead of once per sample
+    engine = ScanInferenceEngine(model, args.feature_cache_views) if args.feature_cache_views > 0 else None
     
+    # one archive per scan and pyramid level, instead of one pfm file per view
+    archive_writers = {}
+
+    # save depth maps and confidence maps of one pyramid level
+    def save_outputs(filenames, outputs, pyramid):
+        for filename, depth_est, photometric_confidence in zip(filenames, outputs["depth"],
+                                                               outputs["photometric_confidence"]):
+            if args.archive:
+                scan, _, view_name = filename.split('/')
+                archive_filename = os.path.join(save_dir, scan, 'archive_{}.mvsa'.format(pyramid))
+                if archive_filename not in archive_writers:
+                    archive_writers[archive_filename] = DepthArchiveWriter(archive_filename, args.archive_compress, mode='w')
+                writer = archive_writers[archive_filename]
+                output_sink.submit(writer.put, 'depth_est/' + view_name.format(''), depth_est.squeeze())
+                output_sink.submit(writer.put, 'confidence/' + view_name.format(''), photometric_confidence.squeeze())
+                continue
+            depth_filename = os.path.join(save_dir, filename.format('depth_est_{}'.format(pyramid), '.pfm'))
+            confidence_filename = os.path.join(save_dir, filename.format('confidence_{}'.format(pyramid), '.pfm'))
+            # save depth maps
+            print(depth_est.shape)
+            output_sink.save_pfm(depth_filename, depth_est.squeeze())
+            # save confidence maps
+            output_sink.save_pfm(confidence_filename, photometric_confidence.squeeze())
+
     count = -1
     total_time = 0
     with torch.no_grad():
@@ -157,97 +208,43 @@ def save_depth():
             count += 1
             print('process', sample['filename'])
             sample_cuda = tocuda(sample)
-            print(sample_cuda["imgs"].shape)
-            time_s = time.time()
-            outputs = model(sample_cuda["imgs"], sample_cuda["proj_matrices"], sample_cuda["depth_values"])
-            one_time = time.time() - time_s
-            total_time += one_time
-            print('one forward: ', one_time)
+            # with --pyramid_levels every level of the sample is run, otherwise only --pyramid
+            if pyramid_levels is not None:
+                levels = [(pyramid, sample_cuda["pyramid"][pyramid]) for pyramid in pyramid_levels]
+            else:
+                levels = [(args.pyramid, sample_cuda)]
+            for pyramid, level_cuda in levels:
+                print(level_cuda["imgs"].shape)
+                time_s = time.time()
+                if engine is not None:
+                    keys = [[(filename.split('/')[0], vid, pyramid) for vid in view_ids]
+                            for filename, view_ids in zip(sample["filename"], sample["view_ids"].tolist())]
+                    outputs = engine(level_cuda["imgs"], level_cuda["proj_matrices"], level_cuda["depth_values"], keys)
+                else:
+                    outputs = model(level_cuda["imgs"], level_cuda["proj_matrices"], level_cuda["depth_values"])
+                one_time = time.time() - time_s
+                total_time += one_time
+                print('one forward: ', one_time)
+
+                if 'High' in args.fea_net  and 'Coarse2Fine' in args.cost_net:
+                    tmp_outputs = {}
+                    for key, value in outputs.items():
+                        tmp_outputs[key] = value[0]
+                    outputs = tmp_outputs
+                outputs = tensor2numpy(outputs)
+                save_outputs(sample["filename"], outputs, pyramid)
             if count % 50 == 0:
                 print('avg time:', total_time / 50) 
                 total_time = 0
-                
-            if 'High' in args.fea_net  and 'Coarse2Fine' in args.cost_net:
-                tmp_outputs = {}
-                for key, value in outputs.items():
-                    tmp_outputs[key] = value[0]
-                outputs = tmp_outputs
-            outputs = tensor2numpy(outputs)
-            del sample_cuda
+            del sample_cuda, levels
             print('Iter {}/{}'.format(batch_idx, len(TestImgLoader)))
-            filenames = sample["filename"]
-
-            # save depth maps and confidence maps
-            for filename, depth_est, photometric_confidence in zip(filenames, outputs["depth"],
-                                                                   outputs["photometric_confidence"]):
-                depth_filename = os.path.join(save_dir, filename.format('depth_est_{}'.format(args.pyramid), '.pfm'))
-                confidence_filename = os.path.join(save_dir, filename.format('confidence_{}'.format(args.pyramid), '.pfm'))
-                os.makedirs(depth_filename.rsplit('/', 1)[0], exist_ok=True)
-                os.makedirs(confidence_filename.rsplit('/', 1)[0], exist_ok=True)
-                # save depth maps
-                print(depth_est.shape)
-                save_pfm(depth_filename, depth_est.squeeze())
-                # save confidence maps
-                save_pfm(confidence_filename, photometric_confidence.squeeze())
-
-
-# project the reference point cloud into the source view, then project back
-def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    ## step1. project reference pixels to the source view
-    # reference view x, y
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    x_ref, y_ref = x_ref.reshape([-1]), y_ref.reshape([-1])
-    # reference 3D space
-    xyz_ref = np.matmul(np.linalg.inv(intrinsics_ref),
-                        np.vstack((x_ref, y_ref, np.ones_like(x_ref))) * depth_ref.reshape([-1]))
-    # source 3D space
-    xyz_src = np.matmul(np.matmul(extrinsics_src, np.linalg.inv(extrinsics_ref)),
-                        np.vstack((xyz_ref, np.ones_like(x_ref))))[:3]
-    # source view x, y
-    K_xyz_src = np.matmul(intrinsics_src, xyz_src)
-    xy_src = K_xyz_src[:2] / K_xyz_src[2:3]
-
-    ## step2. reproject the source view points with source view depth estimation
-    # find the depth estimation of the source view
-    x_src = xy_src[0].reshape([height, width]).astype(np.float32)
-    y_src = xy_src[1].reshape([height, width]).astype(np.float32)
-    sampled_depth_src = cv2.remap(depth_src, x_src, y_src, interpolation=cv2.INTER_LINEAR)
-    # mask = sampled_depth_src > 0
-
-    # source 3D space
-    # NOTE that we should use sampled source-view depth_here to project back
-    xyz_src = np.matmul(np.linalg.inv(intrinsics_src),
-                        np.vstack((xy_src, np.ones_like(x_ref))) * sampled_depth_src.reshape([-1]))
-    # reference 3D space
-    xyz_reprojected = np.matmul(np.matmul(extrinsics_ref, np.linalg.inv(extrinsics_src)),
-                                np.vstack((xyz_src, np.ones_like(x_ref))))[:3]
-    # source view x, y, depth
-    depth_reprojected = xyz_reprojected[2].reshape([height, width]).astype(np.float32)
-    K_xyz_reprojected = np.matmul(intrinsics_ref, xyz_reprojected)
-    xy_reprojected = K_xyz_reprojected[:2] / K_xyz_reprojected[2:3]
-    x_reprojected = xy_reprojected[0].reshape([height, width]).astype(np.float32)
-    y_reprojected = xy_reprojected[1].reshape([height, width]).astype(np.float32)
-
-    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
-
-
-def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src, y2d_src = reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref,
-                                                     depth_src, intrinsics_src, extrinsics_src)
-    # check |p_reproj-p_1| < 1
-    dist = np.sqrt((x2d_reprojected - x_ref) ** 2 + (y2d_reprojected - y_ref) ** 2)
-
-    # check |d_reproj-d_1| / d_1 < 0.01
-    depth_diff = np.abs(depth_reprojected - depth_ref)
-    relative_depth_diff = depth_diff / depth_ref
-
-    mask = np.logical_and(dist < 1, relative_depth_diff < 0.01)
-    depth_reprojected[~mask] = 0
-
-    return mask, depth_reprojected, x2d_src, y2d_src
+    output_sink.flush()
+    for writer in archive_writers.values():
+        writer.close()
+    if engine is not None:
+        print('feature cache:', engine.stats())
+    if test_dataset.img_cache is not None:
+        print('image cache:', test_dataset.img_cache.stats())
 
 
 def filter_depth(scan_folder, out_folder, plyfilename):
@@ -257,56 +254,52 @@ def filter_depth(scan_folder, out_folder, plyfilename):
     vertexs = []
     vertex_colors = []
 
-    pair_data = read_pair_file(pair_file)
+    manifest = get_manifest(os.path.join(scan_folder, 'cams'), pair_file)
+    pair_data = manifest.pairs()
     nviews = len(pair_data)
+    # depth and confidence from archive_{pyramid}.mvsa when eval wrote one, from pfm files otherwise
+    depth_source = open_depth_source(out_folder, 'archive_{}.mvsa'.format(args.pyramid))
+    # each depth map and camera is read once per scan, not again as a source view of the other views
+    fusion_cache = FusionCache(args.fusion_cache_mb * 1024 * 1024)
+    archive_masks = {}
     # TODO: hardcode size
     # used_mask = [np.zeros([296, 400], dtype=np.bool) for _ in range(nviews)]
 
     # for each reference view and the corresponding source views
     for ref_view, src_views in pair_data:
         # load the camera parameters
-        ref_intrinsics, ref_extrinsics = read_camera_parameters(
-            os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)))
+        ref_intrinsics, ref_extrinsics = fusion_cache.get(('cam', ref_view), lambda: read_camera_parameters(manifest, ref_view))
         # load the reference image
         ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)))
         # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(ref_view)))[0]
-        # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}.pfm'.format(ref_view)))[0]
+        ref_depth_est = fusion_cache.get(('depth_est', ref_view), lambda: depth_source.get('depth_est/{:0>8}'.format(ref_view)))
+        # load the photometric mask of the reference view, only read for the reference view
+        confidence = fusion_cache.get(('confidence', ref_view),
+                                      lambda: depth_source.get('confidence/{:0>8}'.format(ref_view), contiguous=False), keep=False)
         photo_mask = confidence > 0.8
 
-        all_srcview_depth_ests = []
-        all_srcview_x = []
-        all_srcview_y = []
-        all_srcview_geomask = []
-
-        # compute the geometric mask
-        geo_mask_sum = 0
-        for src_view in src_views:
-            # camera parameters of the source view
-            src_intrinsics, src_extrinsics = read_camera_parameters(
-                os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)))
-            # the estimated depth of the source view
-            src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(src_view)))[0]
-
-            geo_mask, depth_reprojected, x2d_src, y2d_src = check_geometric_consistency(ref_depth_est, ref_intrinsics, ref_extrinsics,
-                                                                      src_depth_est,
-                                                                      src_intrinsics, src_extrinsics)
-            geo_mask_sum += geo_mask.astype(np.int32)
-            all_srcview_depth_ests.append(depth_reprojected)
-            all_srcview_x.append(x2d_src)
-            all_srcview_y.append(y2d_src)
-            all_srcview_geomask.append(geo_mask)
-
-        depth_est_averaged = (sum(all_srcview_depth_ests) + ref_depth_est) / (geo_mask_sum + 1)
+        # camera parameters and estimated depths of the source views
+        src_cameras = [fusion_cache.get(('cam', src_view), lambda: read_camera_parameters(manifest, src_view))
+                       for src_view in src_views]
+        src_depth_ests = [fusion_cache.get(('depth_est', src_view), lambda: depth_source.get('depth_est/{:0>8}'.format(src_view)))
+                          for src_view in src_views]
+
+        # compute the geometric mask, all source views at once
+        all_srcview_geomask, all_srcview_depth_ests, all_srcview_x, all_srcview_y = check_geometric_consistency_views(
+            ref_depth_est, ref_intrinsics, ref_extrinsics, src_depth_ests,
+            np.array([camera[0] for camera in src_cameras]), np.array([camera[1] for camera in src_cameras]))
+        del src_depth_ests
+
+        depth_est_averaged, geo_mask_sum = average_consistent_depth(ref_depth_est, all_srcview_geomask, all_srcview_depth_ests)
         # at least 3 source views matched
         geo_mask = geo_mask_sum >= 3
         final_mask = np.logical_and(photo_mask, geo_mask)
 
-        os.makedirs(os.path.join(out_folder, "mask"), exist_ok=True)
-        save_mask(os.path.join(out_folder, "mask/{:0>8}_photo.png".format(ref_view)), photo_mask)
-        save_mask(os.path.join(out_folder, "mask/{:0>8}_geo.png".format(ref_view)), geo_mask)
-        save_mask(os.path.join(out_folder, "mask/{:0>8}_final.png".format(ref_view)), final_mask)
+        for mask_name, mask in [('photo', photo_mask), ('geo', geo_mask), ('final', final_mask)]:
+            if isinstance(depth_source, DepthArchive):
+                archive_masks['mask/{:0>8}_{}'.format(ref_view, mask_name)] = mask
+            else:
+                output_sink.save_png(os.path.join(out_folder, "mask/{:0>8}_{}.png".format(ref_view, mask_name)), mask)
 
         print("processing {}, ref-view{:0>2}, photo/geo/final-mask:{}/{}/{}".format(scan_folder, ref_view,
                                                                                     photo_mask.mean(),
@@ -343,6 +336,15 @@ def filter_depth(scan_folder, out_folder, plyfilename):
         #     src_x = all_srcview_x[idx].astype(np.int)
         #     used_mask[src_view][src_y[src_mask], src_x[src_mask]] = True
 
+    depth_source.close()
+    print('fusion cache:', fusion_cache.stats())
+    fusion_cache.clear()
+    # masks are appended to the archive the depth maps were read from
+    if archive_masks:
+        with DepthArchiveWriter(depth_source.filename) as writer:
+            for key, mask in archive_masks.items():
+                writer.put(key, mask)
+
     vertexs = np.concatenate(vertexs, axis=0)
     vertex_colors = np.concatenate(vertex_colors, axis=0)
     vertexs = np.array([tuple(v) for v in vertexs], dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
@@ -377,3 +379,5 @@ if __name__ == '__main__':
             out_folder = os.path.join(save_dir, scan)
             # step2. filter saved depth maps with photometric confidence maps and geometric constraints
             filter_depth(scan_folder, out_folder, os.path.join(save_dir, 'mvsnet{:0>3}_l3.ply'.format(scan_id)))
+
+    output_sink.close()
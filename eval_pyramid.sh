@@ -25,6 +25,8 @@ do
 name=testPoint_${data}_g${n}_b${batch}_${model}_inversecv_${fea_net}_${cost_net}_id${inverse_depth}_sb${syncbn}_os${origin_size}_ca${cost_aggregation}_rf${refine}_sd${save_depth}_fu${fusion}_${part}_ckpt${idx}
 echo $name
 echo 'process light'${light_idx}
+# the three levels can also be computed by one process that decodes every image once:
+# python -u eval.py ... --pyramid_levels=0,1,2
 CUDA_VISIBLE_DEVICES=0 python -u eval.py \
         --dataset=dtu_yao_eval \
         --model=$model \
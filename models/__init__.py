@@ -1,2 +1,3 @@
 #from models.mvsnet import MVSNet, mvsnet_loss, mvsnet_loss_l1norm, mvsnet_loss_divby_interval
-from models.vamvsnet import *
\ No newline at end of file
+from models.vamvsnet import *
+from models.inference import ScanInferenceEngine
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+
+# concatenate the features of several samples along the batch dimension
+def cat_features(features_list):
+    if isinstance(features_list[0], (list, tuple)):
+        return [torch.cat(scale_features, 0) for scale_features in zip(*features_list)]
+    return torch.cat(features_list, 0)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+# Runs MVSNet over the samples of a scan with the 2D features of each view kept in a bounded LRU cache:
+# a view used by several samples (as reference or source view) goes through the feature network once.
+# The feature nets normalize each image on its own (BatchNorm in eval mode or GroupNorm), so the cached
+# features are the ones MVSNet.forward would compute. Only for inference, call it under torch.no_grad().
+class ScanInferenceEngine(object):
+    def __init__(self, model, max_views=16):
+        self.model = model.module if isinstance(model, nn.DataParallel) else model
+        self.max_views = max_views
+        # (scan, view, pyramid) -> features of one view, batch size 1
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.feature_time = 0.0
+
+    def extract(self, img):
+        synchronize(img.device)
+        time_s = time.time()
+        features = self.model.extract_features(img.unsqueeze(0))
+        synchronize(img.device)
+        self.feature_time += time.time() - time_s
+        return features
+
+    # imgs: [B, V, 3, H, W], proj_matrices: [B, V, 4, 4], depth_values: [B, D]
+    # keys: [B][V] cache keys of the views, e.g. (scan, view, pyramid)
+    def __call__(self, imgs, proj_matrices, depth_values, keys):
+        batch, num_views = imgs.shape[0], imgs.shape[1]
+        # features of this batch, not evicted until the batch is done
+        batch_features = {}
+        for b in range(batch):
+            for v in range(num_views):
+                key = keys[b][v]
+                if key in batch_features:
+                    self.hits += 1
+                elif key in self.cache:
+                    self.cache.move_to_end(key)
+                    batch_features[key] = self.cache[key]
+                    self.hits += 1
+                else:
+                    batch_features[key] = self.extract(imgs[b, v])
+                    self.misses += 1
+        features = [cat_features([batch_features[keys[b][v]] for b in range(batch)]) for v in range(num_views)]
+
+        for key, value in batch_features.items():
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.max_views:
+            self.cache.popitem(last=False)
+
+        return self.model.forward_features(features, proj_matrices, depth_values)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        avg_time = self.feature_time / max(1, self.misses)
+        return {'feature_runs': self.misses, 'feature_hits': self.hits, 'feature_time': self.feature_time,
+                'feature_time_saved': avg_time * self.hits}
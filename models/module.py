@@ -1,6 +1,12 @@
+import functools
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+# non-reentrant checkpointing where available (PyTorch >= 1.11)
+CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
 
 class ConvBnReLU(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, pad=1):
@@ -100,6 +106,40 @@ class deConvGnReLU(nn.Module):
         return F.relu(self.gn(self.conv(x)), inplace=True)
 
 
+# Activation checkpointing of the encoder and decoder of the 3D regularization networks (train.py --checkpoint_3d):
+# a checkpointed stage keeps only its inputs for backward and runs its forward again during backward.
+class CheckpointStages(object):
+    # subset of ('encoder', 'decoder'), set by MVSNet
+    checkpoint_stages = ()
+
+    def stage(self, name, function, *inputs):
+        if name not in self.checkpoint_stages or not self.training or not torch.is_grad_enabled():
+            return function(*inputs)
+        return checkpoint(recompute_without_stats(function, self), *inputs, **CHECKPOINT_KWARGS)
+
+
+# function for torch.utils.checkpoint: the runs after the first one (in backward) use the batch statistics
+# again but do not update the BatchNorm running statistics of module a second time
+def recompute_without_stats(function, module):
+    calls = []
+
+    def run(*inputs):
+        if not calls:
+            calls.append(True)
+            return function(*inputs)
+        norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+        for m in norms:
+            m.momentum = 0.0
+        try:
+            return function(*inputs)
+        finally:
+            for m, (momentum, num_batches_tracked) in zip(norms, saved):
+                m.momentum = momentum
+                m.num_batches_tracked.copy_(num_batches_tracked)
+    return run
+
+
 class ConvGnReLU3D(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, pad=1, group_channel=8):
         super(ConvGnReLU3D, self).__init__()
@@ -182,30 +222,141 @@ class Hourglass3d(nn.Module):
         return dconv1
 
 
-def homo_warping(src_fea, src_proj, ref_proj, depth_values):
-    # src_fea: [B, C, H, W]
-    # src_proj: [B, 4, 4]
-    # ref_proj: [B, 4, 4]
-    # depth_values: [B, Ndepth] # TODO: B, 1
-    # out: [B, C, Ndepth, H, W]
-    batch, channels = src_fea.shape[0], src_fea.shape[1]
-    num_depth = depth_values.shape[1]
-    height, width = src_fea.shape[2], src_fea.shape[3]
-    
+# Inference pass (eval.py --fold_bn): every BatchNorm (also the SyncBN converted ones) that directly follows a Conv or
+# ConvTranspose, 2D or 3D, in ConvBn/ConvBnReLU/ConvBn3D/ConvBnReLU3D or in a nn.Sequential (deConvBnReLU, convbn,
+# conv3d, the deconvs of the 3D U-Nets), is folded into the weights and bias of the convolution and replaced by
+# nn.Identity. The model is changed in place and returned, its state_dict no longer loads into an unfolded model.
+def fold_batchnorm(model):
+    if model.training:
+        raise Exception('fold BatchNorm into the convolutions in eval mode only')
+    for module in list(model.modules()):
+        if isinstance(module, (ConvBnReLU, ConvBn, ConvBnReLU3D, ConvBn3D)):
+            if foldable(module.conv, module.bn):
+                fold_conv_bn(module.conv, module.bn)
+                module.bn = nn.Identity()
+        elif isinstance(module, nn.Sequential):
+            children = list(module.named_children())
+            for (_, conv), (name, bn) in zip(children[:-1], children[1:]):
+                if foldable(conv, bn):
+                    fold_conv_bn(conv, bn)
+                    setattr(module, name, nn.Identity())
+    return model
+
+
+def foldable(conv, bn):
+    return isinstance(conv, nn.modules.conv._ConvNd) and isinstance(bn, nn.modules.batchnorm._BatchNorm) \
+        and bn.running_mean is not None and conv.out_channels == bn.num_features
+
+
+# bn(conv(x)) = conv(x) * scale + shift per output channel, computed in float64
+def fold_conv_bn(conv, bn):
+    with torch.no_grad():
+        scale = 1.0 / torch.sqrt(bn.running_var.double() + bn.eps)
+        shift = -bn.running_mean.double() * scale
+        if bn.affine:
+            scale = scale * bn.weight.double()
+            shift = shift * bn.weight.double() + bn.bias.double()
+        if conv.bias is not None:
+            shift = shift + conv.bias.double() * scale
+
+        weight = conv.weight.double()
+        kernel_dims = [1] * (weight.dim() - 2)
+        if conv.transposed:
+            # [in_channels, out_channels / groups, k...], the output channels of group g are g * out/groups + j
+            groups = conv.groups
+            weight = weight.view(groups, weight.shape[0] // groups, *weight.shape[1:])
+            weight = (weight * scale.view(groups, 1, -1, *kernel_dims)).view(conv.weight.shape)
+        else:
+            # [out_channels, in_channels / groups, k...]
+            weight = weight * scale.view(-1, 1, *kernel_dims)
+        conv.weight.copy_(weight)
+        if conv.bias is None:
+            conv.bias = nn.Parameter(shift.to(conv.weight.dtype))
+        else:
+            conv.bias.copy_(shift)
+
+
+# Conv3d with a 1x1x1 kernel that runs as a matmul over the channels on channels_last_3d inputs and keeps that layout.
+# The convolution itself is more than 10x slower on channels_last_3d inputs on CPU (prob heads).
+class PointwiseConv3d(nn.Conv3d):
+    def forward(self, x):
+        if not x.is_contiguous(memory_format=torch.channels_last_3d):
+            return super(PointwiseConv3d, self).forward(x)
+        # [B, C, D, H, W] stored as [B, D, H, W, C]
+        y = F.linear(x.permute(0, 2, 3, 4, 1), self.weight.view(self.out_channels, self.in_channels), self.bias)
+        return y.permute(0, 4, 1, 2, 3)
+
+
+# 3D network for channels_last_3d inputs (MVSNet channels_last_3d): the 1x1x1 Conv3d layers become PointwiseConv3d
+# with the same parameters, and the weights of the convolutions are converted to channels_last_3d. In place.
+def to_channels_last_3d(network):
+    for module in list(network.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is nn.Conv3d and child.kernel_size == (1, 1, 1) and child.stride == (1, 1, 1) \
+                    and child.padding == (0, 0, 0) and child.groups == 1:
+                pointwise = PointwiseConv3d(child.in_channels, child.out_channels, 1, bias=child.bias is not None)
+                pointwise.weight, pointwise.bias = child.weight, child.bias
+                setattr(module, name, pointwise)
+    return network.to(memory_format=torch.channels_last_3d)
+
+
+# pixel coordinates [3, H*W] (x, y, 1) of a feature size, shared by all warping calls. The grids of the last
+# PIXEL_GRID_CACHE_SIZE (height, width, device) are kept: the scales of a few image sizes, tiles slice the grid of
+# the whole feature map (region_grid).
+PIXEL_GRID_CACHE_SIZE = 16
+
+
+@functools.lru_cache(maxsize=PIXEL_GRID_CACHE_SIZE)
+def pixel_grid(height, width, device):
+    with torch.no_grad():
+        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=device),
+                               torch.arange(0, width, dtype=torch.float32, device=device)])
+        y, x = y.contiguous(), x.contiguous()
+        y, x = y.view(height * width), x.view(height * width)
+        return torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
+
+
+# pixel coordinates [3, h*w] of the region (y0, x0, h, w) of a height x width feature map, None for all pixels
+def region_grid(height, width, region, device):
+    xyz = pixel_grid(height, width, device)
+    if region is None:
+        return xyz
+    y0, x0, h, w = region
+    return xyz.view(3, height, width)[:, y0:y0 + h, x0:x0 + w].reshape(3, h * w)
+
+
+# rotation [B, 3, 3] and translation [B, 3, 1] from the reference camera to the source camera
+def relative_projection(src_proj, ref_proj):
     with torch.no_grad():
         proj = torch.matmul(src_proj, torch.inverse(ref_proj))
         rot = proj[:, :3, :3]  # [B,3,3]
         trans = proj[:, :3, 3:4]  # [B,3,1]
+    return rot, trans
 
-        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=src_fea.device),
-                               torch.arange(0, width, dtype=torch.float32, device=src_fea.device)])
-        y, x = y.contiguous(), x.contiguous()
-        y, x = y.view(height * width), x.view(height * width)
-        xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
-        xyz = torch.unsqueeze(xyz, 0).repeat(batch, 1, 1)  # [B, 3, H*W]
+
+# depth_values [B, D] or per pixel [B, D, H, W] (or broadcastable to it) as [B, 1, D, 1] or [B, 1, D, H*W].
+# Hypotheses shared by all pixels ([B, D], [B, D, 1, 1]) keep the broadcast over the pixels.
+def depth_grid(depth_values, height, width):
+    batch, num_depth = depth_values.shape[0], depth_values.shape[1]
+    if depth_values.dim() == 2 or depth_values.shape[2:] == (1, 1):
+        return depth_values.reshape(batch, 1, num_depth, 1)
+    return depth_values.expand(batch, num_depth, height, width).reshape(batch, 1, num_depth, height * width)
+
+
+# sample src_fea at the projections of the reference pixels xyz [3, h*w] at every depth,
+# out_size: (h, w) of the reference pixels, the size of src_fea by default
+def warp_by_projection(src_fea, rot, trans, xyz, depth_values, out_size=None):
+    # depth_values: [B, Ndepth] or per pixel [B, Ndepth, h, w] (see depth_grid)
+    # out: [B, C, Ndepth, h, w]
+    batch, channels = src_fea.shape[0], src_fea.shape[1]
+    num_depth = depth_values.shape[1]
+    height, width = src_fea.shape[2], src_fea.shape[3]
+    out_height, out_width = out_size if out_size is not None else (height, width)
+
+    with torch.no_grad():
         rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
-        rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, num_depth, 1) * depth_values.view(batch, 1, num_depth,
-                                                                                            1)  # [B, 3, Ndepth, H*W]
+        # broadcast over the depths instead of repeating rot_xyz
+        rot_depth_xyz = rot_xyz.unsqueeze(2) * depth_grid(depth_values, out_height, out_width)  # [B, 3, Ndepth, H*W]
         proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1, 1)  # [B, 3, Ndepth, H*W]
         proj_xyz[:,2:3,:,:][proj_xyz[:, 2:3, :, :] == 0] += 0.0001 # WHY BUG
         proj_xy = proj_xyz[:, :2, :, :] / proj_xyz[:, 2:3, :, :]  # [B, 2, Ndepth, H*W]
@@ -213,26 +364,159 @@ def homo_warping(src_fea, src_proj, ref_proj, depth_values):
         proj_y_normalized = proj_xy[:, 1, :, :] / ((height - 1) / 2) - 1
         proj_xy = torch.stack((proj_x_normalized, proj_y_normalized), dim=3)  # [B, Ndepth, H*W, 2]
         grid = proj_xy
-    warped_src_fea = F.grid_sample(src_fea, grid.view(batch, num_depth * height, width, 2), mode='bilinear',
+    warped_src_fea = F.grid_sample(src_fea, grid.view(batch, num_depth * out_height, out_width, 2), mode='bilinear',
                                    padding_mode='zeros')
-    warped_src_fea = warped_src_fea.view(batch, channels, num_depth, height, width)
+    warped_src_fea = warped_src_fea.view(batch, channels, num_depth, out_height, out_width)
     
     warped_src_fea = warped_src_fea.type(torch.float32)
     return warped_src_fea
 
 
+def homo_warping(src_fea, src_proj, ref_proj, depth_values):
+    # src_fea: [B, C, H, W]
+    # src_proj: [B, 4, 4]
+    # ref_proj: [B, 4, 4]
+    # depth_values: [B, Ndepth], or per pixel [B, Ndepth, H, W] (or broadcastable to it)
+    # out: [B, C, Ndepth, H, W]
+    rot, trans = relative_projection(src_proj, ref_proj)
+    xyz = pixel_grid(src_fea.shape[2], src_fea.shape[3], src_fea.device)
+    return warp_by_projection(src_fea, rot, trans, xyz, depth_values)
+
+
+# all source views in one call, identical to homo_warping on each source view
+def homo_warping_views(src_feas, src_projs, ref_proj, depth_values):
+    # src_feas: [B, N, C, H, W]
+    # src_projs: [B, N, 4, 4]
+    # ref_proj: [B, 4, 4]
+    # depth_values: [B, Ndepth], or per pixel [B, Ndepth, H, W] (or broadcastable to it)
+    # out: [B, N, C, Ndepth, H, W]
+    return WarpingContext(ref_proj, torch.unbind(src_projs, 1)).warp_views(src_feas, depth_values)
+
+
+# The warping state shared by all source views and scales of one forward pass: the relative projection of each
+# (source view, scale) is computed once, the pixel grids come from the per size cache.
+# Scaled projections are built as in the coarse-to-fine branch (first 3 rows * scale), so the warped
+# volumes are identical to homo_warping on the scaled projection matrices.
+# With a region (y0, x0, h, w) of the scale 1 feature map, only the reference pixels of that region
+# (scaled at the other scales) are warped, see MVSNet.forward_tiled.
+class WarpingContext(object):
+    def __init__(self, ref_proj, src_projs, region=None, projections=None):
+        # ref_proj: [B, 4, 4], src_projs: [src_proj1, ...] each [B, 4, 4]
+        self.ref_proj = ref_proj
+        self.src_projs = src_projs
+        self.region = region
+        self.projections = projections if projections is not None else {}
+
+    # same cameras restricted to region, the relative projections are shared
+    def tile(self, region):
+        return WarpingContext(self.ref_proj, self.src_projs, region, self.projections)
+
+    # reference pixels [3, h*w] and their (h, w) at scale, for a feature map of height x width
+    def grid(self, height, width, scale, device):
+        if self.region is None:
+            return pixel_grid(height, width, device), None
+        region = tuple(int(v * scale) for v in self.region)
+        return region_grid(height, width, region, device), region[2:]
+
+    def scaled(self, proj, scale):
+        if scale == 1:
+            return proj
+        proj = proj.clone()
+        proj[:, :3, :4] = proj[:, :3, :4] * scale
+        return proj
+
+    # rotation and translation from the reference view to source view idx at scale
+    def relative_projection(self, idx, scale=1):
+        key = (idx, scale)
+        if key not in self.projections:
+            self.projections[key] = relative_projection(self.scaled(self.src_projs[idx], scale),
+                                                        self.scaled(self.ref_proj, scale))
+        return self.projections[key]
+
+    # warped volume [B, C, Ndepth, H, W] of source view idx
+    def warp(self, src_fea, idx, depth_values, scale=1):
+        rot, trans = self.relative_projection(idx, scale)
+        xyz, out_size = self.grid(src_fea.shape[2], src_fea.shape[3], scale, src_fea.device)
+        return warp_by_projection(src_fea, rot, trans, xyz, depth_values, out_size)
+
+    # warped volumes [B, N, C, Ndepth, H, W] of all source views in one grid_sample call, src_feas: [B, N, C, H, W]
+    def warp_views(self, src_feas, depth_values, scale=1):
+        batch, num_src = src_feas.shape[0], src_feas.shape[1]
+        projections = [self.relative_projection(idx, scale) for idx in range(num_src)]
+        rot = torch.stack([rot for rot, _ in projections], 1).flatten(0, 1)
+        trans = torch.stack([trans for _, trans in projections], 1).flatten(0, 1)
+        xyz, out_size = self.grid(src_feas.shape[3], src_feas.shape[4], scale, src_feas.device)
+        depth_values = depth_values.unsqueeze(1).expand(batch, num_src, *depth_values.shape[1:]).flatten(0, 1)
+        warped_src_feas = warp_by_projection(src_feas.flatten(0, 1), rot, trans, xyz, depth_values, out_size)
+        return warped_src_feas.view(batch, num_src, *warped_src_feas.shape[1:])
+
+
+# sum and squared sum over the views of the reference volume and the warped source volumes, without gradient
+def warped_moments(warping, depth_values, scale, ref_feature, src_features, square=True):
+    num_depth = depth_values.shape[1]
+    volume_sum = ref_feature.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
+    volume_sq_sum = volume_sum ** 2 if square else None
+    for idx, src_fea in enumerate(src_features):
+        warped_volume = warping.warp(src_fea, idx, depth_values, scale)
+        volume_sum += warped_volume
+        if square:
+            volume_sq_sum += warped_volume.pow_(2)
+        del warped_volume
+    return volume_sum, volume_sq_sum
+
+
+# Variance cost volume [B, C, Ndepth, H, W] of the reference feature and the source features warped by a
+# WarpingContext, for training with less memory. Autograd would keep the warped volume of every source view
+# (and the grid_sample inputs) for backward, here only the features are kept: backward warps the source views
+# again, once for the mean volume and once per view for its gradient, d variance / d x = 2 / N * (x - mean).
+# Same forward as the variance aggregation of MVSNet, gradients up to float rounding.
+class WarpedVariance(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, warping, depth_values, scale, ref_feature, *src_features):
+        ctx.warping, ctx.scale = warping, scale
+        ctx.save_for_backward(depth_values, ref_feature, *src_features)
+        num_views = len(src_features) + 1
+        volume_sum, volume_sq_sum = warped_moments(warping, depth_values, scale, ref_feature, src_features)
+        return volume_sq_sum.div_(num_views).sub_(volume_sum.div_(num_views).pow_(2))
+
+    @staticmethod
+    def backward(ctx, grad_variance):
+        depth_values, ref_feature, *src_features = ctx.saved_tensors
+        num_views = len(src_features) + 1
+        with torch.no_grad():
+            volume_mean = warped_moments(ctx.warping, depth_values, ctx.scale, ref_feature, src_features,
+                                         square=False)[0].div_(num_views)
+            grad_volume = grad_variance * (2.0 / num_views)
+            grad_ref = None
+            if ctx.needs_input_grad[3]:
+                grad_ref = ((ref_feature.unsqueeze(2) - volume_mean) * grad_volume).sum(2)
+        grad_srcs = []
+        for idx, src_fea in enumerate(src_features):
+            if not ctx.needs_input_grad[4 + idx]:
+                grad_srcs.append(None)
+                continue
+            with torch.enable_grad():
+                src_fea = src_fea.detach().requires_grad_()
+                warped_volume = ctx.warping.warp(src_fea, idx, depth_values, ctx.scale)
+                grad_warped = (warped_volume.detach() - volume_mean).mul_(grad_volume)
+                grad_srcs.append(torch.autograd.grad(warped_volume, src_fea, grad_warped)[0])
+            del warped_volume, grad_warped
+        return (None, None, None, grad_ref) + tuple(grad_srcs)
+
+
 # Without gradient for Testing to save some memory
 def homo_warping2(src_fea, src_proj, ref_proj, depth_values):
     # src_fea: [B, C, H, W]
     # src_proj: [B, 4, 4]
     # ref_proj: [B, 4, 4]
-    # depth_values: [B, Ndepth]
+    # depth_values: [B, Ndepth], or per pixel [B, Ndepth, H, W] (or broadcastable to it)
     # out: [B, C, Ndepth, H, W]
     batch, channels = src_fea.shape[0], src_fea.shape[1]
     num_depth = depth_values.shape[1]
     height, width = src_fea.shape[2], src_fea.shape[3]
 
     warped_src_fea = src_fea.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
+    depth_values = depth_grid(depth_values, height, width)  # [B, 1, Ndepth, 1] or [B, 1, Ndepth, H*W]
 
     with torch.no_grad():
         proj = torch.matmul(src_proj, torch.inverse(ref_proj))
@@ -248,7 +532,7 @@ def homo_warping2(src_fea, src_proj, ref_proj, depth_values):
         rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
 
         for i in range(num_depth):
-            rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, 1, 1) * depth_values[:,i].view(batch, 1, 1, 1)  # [B, 3, 1, H*W]
+            rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, 1, 1) * depth_values[:, :, i:i + 1]  # [B, 3, 1, H*W]
             # print('rot_depth_xyz: ', np.shape(rot_depth_xyz))
             proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1, 1)  # [B, 3, 1, H*W]
             # print('proj_xyz: ', np.shape(proj_xyz))
@@ -267,7 +551,7 @@ def homo_warping3(src_fea, src_proj, ref_proj, depth_values):
     # src_fea: [B, C, H, W]
     # src_proj: [B, 4, 4]
     # ref_proj: [B, 4, 4]
-    # depth_values: [B, 1]
+    # depth_values: [B, 1], or per pixel [B, 1, H, W] (e.g. a depth map)
     # out: [B, C, H, W]
     batch, channels = src_fea.shape[0], src_fea.shape[1]
     height, width = src_fea.shape[2], src_fea.shape[3]
@@ -287,7 +571,7 @@ def homo_warping3(src_fea, src_proj, ref_proj, depth_values):
         xyz = torch.unsqueeze(xyz, 0).repeat(batch, 1, 1)  # [B, 3, H*W]
         rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
 
-        rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, 1, 1) * (depth_values.view(batch, 1, 1, 1))  # [B, 3, 1, H*W]
+        rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, 1, 1) * depth_grid(depth_values, height, width)  # [B, 3, 1, H*W]
         # print('rot_depth_xyz: ', np.shape(rot_depth_xyz))
         proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1, 1)  # [B, 3, 1, H*W]
         # print('proj_xyz: ', np.shape(proj_xyz))
@@ -303,14 +587,99 @@ def homo_warping3(src_fea, src_proj, ref_proj, depth_values):
     return warped_src_fea
 
 
+# depth_values [D], [B, D] or per pixel [B, D, H, W] as a tensor broadcastable against [B, D, H, W]
+def depth_volume(depth_values):
+    if depth_values.dim() <= 2:
+        return depth_values.view(*depth_values.shape, 1, 1)
+    return depth_values
+
+
 # p: probability volume [B, D, H, W]
-# depth_values: discrete depth values [B, D]
+# depth_values: discrete depth values [B, D], or per pixel [B, D, H, W] (or broadcastable to it, e.g. [B, D, 1, 1])
 def depth_regression(p, depth_values):
-    depth_values = depth_values.view(*depth_values.shape, 1, 1)
+    depth_values = depth_volume(depth_values)
     depth = torch.sum(p * depth_values, 1)
     return depth
 
 
+# Softmax depth regression and 4-bin photometric confidence of a cost volume without the probability volume,
+# for inference. One pass over chunks of depth keeps an online softmax (running max and normalizer) with the
+# expected depth and the expected depth index, the confidence (probability of the bins index-1 .. index+2)
+# then gathers only 4 values of the cost volume. Same result as softmax + depth_regression + avg_pool3d/gather
+# up to float rounding (an expected index right at an integer may fall on the other side).
+def fused_depth_regression(cost_reg, depth_values, chunk=32):
+    # cost_reg: [B, Ndepth, H, W], the probability is softmax(-cost_reg)
+    # depth_values: [B, Ndepth] or [B, Ndepth, H, W]
+    # out: depth [B, H, W], photometric_confidence [B, H, W]
+    num_depth = cost_reg.shape[1]
+    logit_max, normalizer, depth_sum, index_sum = None, None, None, None
+    for start in range(0, num_depth, chunk):
+        logits = -cost_reg[:, start:start + chunk]
+        chunk_values = depth_volume(depth_values[:, start:start + chunk])
+        chunk_index = torch.arange(start, start + logits.shape[1], device=logits.device,
+                                   dtype=logits.dtype).view(1, -1, 1, 1)
+        chunk_max = logits.max(1)[0]
+        if logit_max is None:
+            new_max = chunk_max
+        else:
+            new_max = torch.max(logit_max, chunk_max)
+        exp = torch.exp(logits - new_max.unsqueeze(1))
+        chunk_sum, chunk_depth, chunk_index = exp.sum(1), (exp * chunk_values).sum(1), (exp * chunk_index).sum(1)
+        del exp
+        if logit_max is None:
+            normalizer, depth_sum, index_sum = chunk_sum, chunk_depth, chunk_index
+        else:
+            rescale = torch.exp(logit_max - new_max)
+            normalizer = normalizer * rescale + chunk_sum
+            depth_sum = depth_sum * rescale + chunk_depth
+            index_sum = index_sum * rescale + chunk_index
+        logit_max = new_max
+    depth = depth_sum / normalizer
+
+    with torch.no_grad():
+        depth_index = (index_sum / normalizer).long()
+        photometric_confidence = torch.zeros_like(normalizer)
+        for offset in range(-1, 3):
+            index = depth_index + offset
+            valid = (index >= 0) & (index < num_depth)
+            logits = -torch.gather(cost_reg, 1, index.clamp(0, num_depth - 1).unsqueeze(1)).squeeze(1)
+            photometric_confidence += torch.exp(logits - logit_max) * valid.to(logits.dtype)
+        photometric_confidence /= normalizer
+    return depth, photometric_confidence
+
+
+# hypotheses of a coarser scale: every step-th depth, per pixel hypotheses also every step-th pixel
+def subsample_depth_values(depth_values, step):
+    if depth_values.dim() == 2:
+        return depth_values[:, ::step]
+    return depth_values[:, ::step, ::step, ::step]
+
+
+# num_depth hypotheses per pixel around depth, spread apart (in intervals of depth_values, interpolated, so
+# inverse depth sampling is kept). The window is shifted to stay inside the range of depth_values.
+def narrow_depth_values(depth_values, depth, spread, num_depth):
+    # depth_values: [B, D] increasing
+    # depth, spread: [B, H, W]
+    # out: [B, num_depth, H, W]
+    batch, total = depth_values.shape
+    height, width = depth.shape[1], depth.shape[2]
+    with torch.no_grad():
+        # fractional index of depth in depth_values
+        flat_depth = depth.reshape(batch, -1).contiguous()
+        upper = torch.searchsorted(depth_values.contiguous(), flat_depth).clamp(1, total - 1)
+        lower_value, upper_value = torch.gather(depth_values, 1, upper - 1), torch.gather(depth_values, 1, upper)
+        center = (upper - 1).to(depth.dtype) + ((flat_depth - lower_value) / (upper_value - lower_value)).clamp(0, 1)
+        spread = spread.reshape(batch, 1, -1)
+        half = spread * (num_depth - 1) / 2
+        center = torch.max(torch.min(center.unsqueeze(1), (total - 1) - half), half)
+        offsets = torch.arange(num_depth, device=depth.device, dtype=depth.dtype).view(1, -1, 1) - (num_depth - 1) / 2
+        index = (center + offsets * spread).clamp(0, total - 1).view(batch, -1)  # [B, num_depth * H*W]
+        lower = index.floor().long().clamp(max=total - 2)
+        weight = index - lower.to(index.dtype)
+        values = torch.gather(depth_values, 1, lower) * (1 - weight) + torch.gather(depth_values, 1, lower + 1) * weight
+    return values.view(batch, num_depth, height, width)
+
+
 if __name__ == "__main__":
     # some testing code, just IGNORE it
     from datasets import find_dataset_def
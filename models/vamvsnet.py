@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from .module import *
 import sys
-from copy import deepcopy
+import math
 
 from .submodule import volumegatelight, volumegatelightgn
 # More scale feature map submodule
@@ -197,7 +197,7 @@ class UNetDS2BN(nn.Module):
         return conv10_2
 
 
-class RegNetUS0(nn.Module):
+class RegNetUS0(nn.Module, CheckpointStages):
     def __init__(self, origin_size=False):
         super(RegNetUS0, self).__init__()
         self.origin_size = origin_size
@@ -230,31 +230,37 @@ class RegNetUS0(nn.Module):
         
         self.prob = nn.Conv3d(8, 1, 1,bias=False)
 
-    def forward(self, x):
-        input_shape = x.shape
-
+    def encode(self, x):
         conv0 = self.conv0(x)
         conv1 = self.conv1(x)
         conv3 = self.conv3(conv1)
         conv5 = self.conv5(conv3)
+        return conv0, self.conv2(conv1), self.conv4(conv3), self.conv6(conv5)
+
+    def decode(self, conv0, conv2, conv4, conv6):
+        x = self.conv7(conv6) + conv4
+        x = self.conv9(x) + conv2
+        return self.conv11(x) + conv0
+
+    def forward(self, x):
+        input_shape = x.shape
 
-        x = self.conv7(self.conv6(conv5)) + self.conv4(conv3)
-        x = self.conv9(x) + self.conv2(conv1)
-        x = self.conv11(x) + conv0
+        conv0, conv2, conv4, conv6 = self.stage('encoder', self.encode, x)
+        x = self.stage('decoder', self.decode, conv0, conv2, conv4, conv6)
         
         if self.origin_size:
             x = F.interpolate(x, size=(input_shape[2], input_shape[3]*4, input_shape[4]*4), mode='trilinear', align_corners=True)
         x = self.prob(x)
         return x
 
-class RegNetUS0GN(nn.Module):
-    def __init__(self, origin_size=False):
+class RegNetUS0GN(nn.Module, CheckpointStages):
+    def __init__(self, origin_size=False, in_channels=32):
         super(RegNetUS0GN, self).__init__()
         self.origin_size = origin_size
 
-        self.conv0 = ConvGnReLU3D(32, 8)
+        self.conv0 = ConvGnReLU3D(in_channels, 8)
 
-        self.conv1 = ConvGnReLU3D(32, 16, stride=2)
+        self.conv1 = ConvGnReLU3D(in_channels, 16, stride=2)
         self.conv2 = ConvGnReLU3D(16, 16)
 
         self.conv3 = ConvGnReLU3D(16, 32, stride=2)
@@ -283,17 +289,23 @@ class RegNetUS0GN(nn.Module):
         
         self.prob = nn.Conv3d(8, 1, 1,bias=False)
 
-    def forward(self, x):
-        input_shape = x.shape
-
+    def encode(self, x):
         conv0 = self.conv0(x)
         conv1 = self.conv1(x)
         conv3 = self.conv3(conv1)
         conv5 = self.conv5(conv3)
+        return conv0, self.conv2(conv1), self.conv4(conv3), self.conv6(conv5)
+
+    def decode(self, conv0, conv2, conv4, conv6):
+        x = self.conv7(conv6) + conv4
+        x = self.conv9(x) + conv2
+        return self.conv11(x) + conv0
+
+    def forward(self, x):
+        input_shape = x.shape
 
-        x = self.conv7(self.conv6(conv5)) + self.conv4(conv3)
-        x = self.conv9(x) + self.conv2(conv1)
-        x = self.conv11(x) + conv0
+        conv0, conv2, conv4, conv6 = self.stage('encoder', self.encode, x)
+        x = self.stage('decoder', self.decode, conv0, conv2, conv4, conv6)
         
         if self.origin_size:
             #x = F.interpolate(x, size=(input_shape[2], input_shape[3]*4, input_shape[4]*4), mode='trilinear', align_corners=True)
@@ -302,10 +314,10 @@ class RegNetUS0GN(nn.Module):
         x = self.prob(x)
         return x
 
-class CostRegNet(nn.Module):
-    def __init__(self):
+class CostRegNet(nn.Module, CheckpointStages):
+    def __init__(self, in_channels=32):
         super(CostRegNet, self).__init__()
-        self.conv0 = ConvBnReLU3D(32, 8)
+        self.conv0 = ConvBnReLU3D(in_channels, 8)
 
         self.conv1 = ConvBnReLU3D(8, 16, stride=2)
         self.conv2 = ConvBnReLU3D(16, 16)
@@ -333,20 +345,50 @@ class CostRegNet(nn.Module):
 
         self.prob = nn.Conv3d(8, 1, 3, stride=1, padding=1)
 
-    def forward(self, x):
+    def encode(self, x):
         conv0 = self.conv0(x)
         conv2 = self.conv2(self.conv1(conv0))
         conv4 = self.conv4(self.conv3(conv2))
         x = self.conv6(self.conv5(conv4))
+        return conv0, conv2, conv4, x
+
+    def decode(self, conv0, conv2, conv4, x):
         x = conv4 + self.conv7(x)
         x = conv2 + self.conv9(x)
-        x = conv0 + self.conv11(x)
+        return conv0 + self.conv11(x)
+
+    def forward(self, x):
+        conv0, conv2, conv4, x = self.stage('encoder', self.encode, x)
+        x = self.stage('decoder', self.decode, conv0, conv2, conv4, x)
         x = self.prob(x)
         return x
 
+# Tiled inference: the 3D U-Nets downsample 3 times, tiles start and end on multiples of 8 feature pixels,
+# and their receptive field reaches 31 feature pixels (1+2+4+8 down, 8+4+2 up, CostRegNet adds 2).
+TILE_ALIGN = 8
+TILE_HALO = 32
+# peak memory of the steps 2-4 of a tile in [32, D, h, w] float volumes (about 3.4 measured for the 3D nets here)
+TILE_VOLUME_COPIES = 4
+
+
+# stages of the 3D regularization network recomputed in backward for each --checkpoint_3d setting
+CHECKPOINT_3D_STAGES = {'none': (), 'encoder': ('encoder',), 'decoder': ('decoder',), 'all': ('encoder', 'decoder')}
+
+# depth hypotheses per chunk of fused_depth_regression when depth_chunk is not set
+REGRESSION_CHUNK = 32
+
+
+# region (y0, x0, h, w) of the last two dimensions of x, with the coordinates multiplied by ratio
+def crop_region(x, region, ratio=1):
+    y0, x0, h, w = [int(v * ratio) for v in region]
+    return x[..., y0:y0 + h, x0:x0 + w]
+
+
 class MVSNet(nn.Module):
     def __init__(self, refine=True, fea_net='FeatureNet', cost_net='CostRegNet', refine_net='RefineNet',
-                 origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25):
+                 origin_size=False, cost_aggregation=0, dp_ratio=0.0, image_scale=0.25, batch_views=False, depth_chunk=0,
+                 tile_memory_mb=0, tile_halo=TILE_HALO, fused_regression=False,
+                 cascade_depths=0, lean_warping=False, checkpoint_3d='none', channels_last_3d=False, gwc_groups=8):
         super(MVSNet, self).__init__()
         self.refine = refine
         
@@ -357,10 +399,43 @@ class MVSNet(nn.Module):
         self.refine_net = refine_net
         self.dp_ratio = dp_ratio
         self.image_scale = image_scale
+        # fold the views into the batch for feature extraction and warp all source views in one grid_sample call
+        # (faster for small inputs, but the warped volumes of all source views are in memory at once)
+        self.batch_views = batch_views
+        # depth hypotheses per cost volume chunk in inference, 0 builds the whole volume at once
+        self.depth_chunk = depth_chunk
+        # memory budget (MB) of the spatially tiled inference, 0 processes the whole image at once
+        self.tile_memory_mb = tile_memory_mb
+        self.tile_halo = tile_halo
+        # depth and confidence from the cost volume in one pass over depth chunks, without the probability volume
+        self.fused_regression = fused_regression
+        # hypotheses per pass of the two stage inference (a multiple of 8), 0 evaluates all depth_values at once
+        self.cascade_depths = cascade_depths
+        # variance cost volume in training without keeping the warped volumes for backward (WarpedVariance)
+        self.lean_warping = lean_warping
+        # cost volumes and 3D regularization in the channels_last_3d memory format (NDHWC). The cost volume is built in
+        # NCDHW (grid_sample output, volumegates) and converted once.
+        self.channels_last_3d = channels_last_3d
+        self.volume_memory_format = torch.channels_last_3d if channels_last_3d else torch.contiguous_format
+        # channel groups of the group-wise correlation volume (cost_aggregation 100), its width instead of 32
+        self.gwc_groups = gwc_groups
         print('MVSNet model , refine: {}, refine_net: {},  fea_net: {}, cost_net: {}, origin_size: {}, image_scale: {}'.format(self.refine, 
                                     refine_net, fea_net, cost_net, self.origin_size, self.image_scale))
 
-        print('cost aggregation: ', self.cost_aggregation)
+        print('cost aggregation: ', self.cost_aggregation, 'batch views: ', self.batch_views, 'depth chunk: ', self.depth_chunk,
+              'tile memory: ', self.tile_memory_mb, 'fused regression: ', self.fused_regression,
+              'cascade depths: ', self.cascade_depths, 'lean warping: ', self.lean_warping,
+              'checkpoint 3d: ', checkpoint_3d, 'channels last 3d: ', self.channels_last_3d)
+        if self.cost_aggregation == 100:
+            print('group-wise correlation groups: ', self.gwc_groups)
+            if 'Coarse2Fine' in cost_net:
+                raise Exception('group-wise correlation is not supported by the Coarse2Fine networks')
+            if 32 % self.gwc_groups != 0:
+                raise Exception('gwc_groups must divide the 32 feature channels')
+        if self.cascade_depths > 0 and self.cascade_depths % 8 != 0:
+            raise Exception('cascade_depths must be a multiple of 8, got {}'.format(self.cascade_depths))
+        # channels of the cost volume
+        volume_channels = self.gwc_groups if self.cost_aggregation == 100 else 32
 
         if fea_net == 'FeatureNet':
             self.feature = FeatureNet()
@@ -372,15 +447,17 @@ class MVSNet(nn.Module):
             self.feature = FeatureNetHighGN()
             
         if cost_net == 'CostRegNet':
-            self.cost_regularization = CostRegNet()
+            self.cost_regularization = CostRegNet(volume_channels)
         elif cost_net == 'RegNetUS0GN':
-            self.cost_regularization = RegNetUS0GN(self.origin_size)
+            self.cost_regularization = RegNetUS0GN(self.origin_size, volume_channels)
         elif cost_net == 'RegNetUS0_Coarse2Fine':
             self.cost_regularization = RegNetUS0_Coarse2Fine(self.origin_size, self.dp_ratio, self.image_scale)
         elif cost_net == 'RegNetUS0_Coarse2FineGN':
             self.cost_regularization = RegNetUS0_Coarse2FineGN(self.origin_size, self.dp_ratio, self.image_scale)
 
         
+        self.cost_regularization.checkpoint_stages = CHECKPOINT_3D_STAGES[checkpoint_3d]
+
         if self.cost_aggregation == 91: #input 3D cost volume -> 3D Reweight map
             self.volumegate = volumegatelight(32, kernel_size=3, dilation=[1,3,5,7], bias=True)
             #self.volumegate = volumegatelightgn(32, kernel_size=3, dilation=[1,3,5,7], bias=True)
@@ -390,21 +467,245 @@ class MVSNet(nn.Module):
                 volumegatelight(32, kernel_size=3, dilation=[1,3,5,7], bias=True),
                 volumegatelight(64, kernel_size=3, dilation=[1,3,5,7], bias=True),
                 volumegatelight(64, kernel_size=3, dilation=[1,3,5,7], bias=True)]) 
+
+        if self.channels_last_3d:
+            # weights of the 3D convolutions in the layout of the cost volumes, no reorder per call
+            to_channels_last_3d(self.cost_regularization)
         
     def forward(self, imgs, proj_matrices, depth_values):
-        
-        imgs = torch.unbind(imgs, 1)
+        # step 1. feature extraction
+        # in: images; out: 32-channel feature maps (a list of 4 scales for the High feature nets)
+        # batch statistics of BatchNorm in training would change with the views in the batch, keep those per view
+        if self.batch_views and (not self.training or 'GN' in self.fea_net):
+            batch, num_views = imgs.shape[0], imgs.shape[1]
+            features = self.extract_features(imgs.flatten(0, 1))
+            if isinstance(features, (list, tuple)):
+                features = [feature.view(batch, num_views, *feature.shape[1:]).unbind(1) for feature in features]
+                features = list(map(list, zip(*features))) # 4 * V -> V * 4
+            else:
+                features = list(features.view(batch, num_views, *features.shape[1:]).unbind(1))
+        else:
+            features = [self.extract_features(img) for img in torch.unbind(imgs, 1)]
+        return self.forward_features(features, proj_matrices, depth_values)
+
+    # img: [B, 3, H, W]
+    def extract_features(self, img):
+        if img.dtype == torch.uint8:
+            # uint8 transport (--uint8_imgs): scale 0~255 to 0~1 on the compute device
+            img = img.float().div_(255.)
+        return self.feature(img)
+
+    # warped volume of each source view
+    def warp_src_volumes(self, warping, src_features, depth_values, scale=1):
+        if self.batch_views:
+            return torch.unbind(warping.warp_views(torch.stack(src_features, 1), depth_values, scale), 1)
+        # one at a time, only one warped volume is alive
+        return (warping.warp(src_fea, idx, depth_values, scale) for idx, src_fea in enumerate(src_features))
+
+    # cost volume of the depth hypotheses depth_values: [B, D] -> [B, C, D, H, W], aggregated by variance,
+    # by the reweighted squared differences to the reference view when a volumegate is given (91/95),
+    # or by group-wise correlation with the reference view (100, C = gwc_groups).
+    # In inference with depth_chunk > 0, the hypotheses are processed depth_chunk at a time and written into the
+    # output volume, only the sum/warped volumes of one chunk are alive instead of several [B, C, D, H, W] volumes.
+    # Every operation is per depth (the volumegates are 1x1x1 convs, BatchNorm in eval mode), so chunking does not
+    # change the result. Training always builds the whole volume, BatchNorm batch statistics need all depths.
+    def build_cost_volume(self, warping, ref_feature, src_features, depth_values, scale=1, volumegate=None):
+        num_depth = depth_values.shape[1]
+        if self.training or self.depth_chunk <= 0 or self.depth_chunk >= num_depth:
+            volume = self.aggregate_volume(warping, ref_feature, src_features, depth_values, scale, volumegate)
+            return volume.contiguous(memory_format=self.volume_memory_format)
+        volume = None
+        for start in range(0, num_depth, self.depth_chunk):
+            chunk = self.aggregate_volume(warping, ref_feature, src_features,
+                                          depth_values[:, start:start + self.depth_chunk], scale, volumegate)
+            if volume is None:
+                volume = torch.empty(chunk.shape[:2] + (num_depth,) + chunk.shape[3:], dtype=chunk.dtype,
+                                     device=chunk.device, memory_format=self.volume_memory_format)
+            # converted to the memory format of volume by the copy
+            volume[:, :, start:start + chunk.shape[2]] = chunk
+            del chunk
+        return volume
+
+    def aggregate_volume(self, warping, ref_feature, src_features, depth_values, scale=1, volumegate=None):
+        num_depth = depth_values.shape[1]
+        num_views = len(src_features) + 1
+        if self.cost_aggregation == 100:
+            return self.correlation_volume(warping, ref_feature, src_features, depth_values, scale)
+        if volumegate is None and self.training and self.lean_warping:
+            return WarpedVariance.apply(warping, depth_values, scale, ref_feature, *src_features)
+        ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
+        if volumegate is None:
+            volume_sum = ref_volume
+            volume_sq_sum = ref_volume ** 2
+            del ref_volume
+            # warpped features
+            for warped_volume in self.warp_src_volumes(warping, src_features, depth_values, scale):
+                if self.training:
+                    volume_sum = volume_sum + warped_volume
+                    volume_sq_sum = volume_sq_sum + warped_volume ** 2
+                else:
+                    # TODO: this is only a temporal solution to save memory, better way?
+                    volume_sum += warped_volume
+                    volume_sq_sum += warped_volume.pow_(2)  # the memory of warped_volume has been modified
+                del warped_volume
+            # aggregate multiple feature volumes by variance
+            return volume_sq_sum.div_(num_views).sub_(volume_sum.div_(num_views).pow_(2))
+
+        warp_volumes = None
+        # warpped features
+        for warped_volume in self.warp_src_volumes(warping, src_features, depth_values, scale):
+            warped_volume = (warped_volume - ref_volume).pow_(2) #B,C,D,H,W
+            reweight = volumegate(warped_volume) #B, 1, D, H, W
+            if warp_volumes is None:
+                warp_volumes = (reweight + 1) * warped_volume
+            else:
+                warp_volumes += (reweight + 1) * warped_volume
+        return warp_volumes / len(src_features)
+
+    # group-wise correlation volume (GwcNet) [B, G, D, H, W]: the mean over the channels of each of the G groups of
+    # the product of the reference and warped source features, averaged over the source views. The regularization
+    # network input is G channels instead of 32, the reference volume is broadcast instead of repeated over depth.
+    def correlation_volume(self, warping, ref_feature, src_features, depth_values, scale=1):
+        batch, channels = ref_feature.shape[0], ref_feature.shape[1]
+        ref_volume = ref_feature.unsqueeze(2) # B, C, 1, H, W
+        volume = None
+        for warped_volume in self.warp_src_volumes(warping, src_features, depth_values, scale):
+            if self.training:
+                correlation = warped_volume * ref_volume
+            else:
+                correlation = warped_volume.mul_(ref_volume)
+            del warped_volume
+            # B, C, D, H, W -> B, G, D, H, W
+            correlation = correlation.view(batch, self.gwc_groups, channels // self.gwc_groups,
+                                           *correlation.shape[2:]).mean(2)
+            if volume is None:
+                volume = correlation
+            elif self.training:
+                volume = volume + correlation
+            else:
+                volume += correlation
+            del correlation
+        return volume.div_(len(src_features))
+
+    # steps 2-4 from the features of each view, features: [ref_feature, src_feature1, ...]
+    def forward_features(self, features, proj_matrices, depth_values):
         proj_matrices = torch.unbind(proj_matrices, 1)
-        assert len(imgs) == len(proj_matrices), "Different number of images and projection matrices"
-        img_height, img_width = imgs[0].shape[2], imgs[0].shape[3]
+        assert len(features) == len(proj_matrices), "Different number of images and projection matrices"
+        # relative projections of each source view and scale, computed once
+        warping = WarpingContext(proj_matrices[0], proj_matrices[1:])
+        if self.cascade_depths > 0 and not self.training:
+            return self.forward_cascade(features, warping, depth_values)
+        return self.forward_stage(features, warping, depth_values)
+
+    def forward_stage(self, features, warping, depth_values):
+        if self.tile_memory_mb > 0 and not self.training:
+            return self.forward_tiled(features, warping, depth_values)
+        return self.forward_volumes(features, warping, depth_values)
+
+    # Two stage inference: a first pass over cascade_depths hypotheses spread over the whole depth range, then a
+    # second pass over cascade_depths hypotheses per pixel around the depth of the first pass (finest scale of the
+    # Coarse2Fine nets). The hypotheses of a pixel with first pass confidence 1 are the original depth interval
+    # apart, those of a pixel with confidence 0 keep the spacing of the first pass and still span the whole range.
+    # 2 * cascade_depths hypotheses per pixel instead of D, e.g. 96 instead of 192 with cascade_depths=48.
+    def forward_cascade(self, features, warping, depth_values):
+        num_depth = depth_values.shape[1]
+        if self.cascade_depths > num_depth:
+            raise Exception('cascade_depths {} is more than the {} depth values'.format(self.cascade_depths, num_depth))
+        coarse_index = torch.linspace(0, num_depth - 1, self.cascade_depths, device=depth_values.device).round().long()
+        outputs = self.forward_stage(features, warping, depth_values.index_select(1, coarse_index))
+        depth, confidence = outputs["depth"], outputs["photometric_confidence"]
+        if isinstance(depth, (list, tuple)):
+            depth, confidence = depth[0], confidence[0]
+        ref_feature = features[0][0] if isinstance(features[0], (list, tuple)) else features[0]
+        size = ref_feature.shape[2:]
+        if depth.shape[-2:] != size:
+            # origin_size, back to the feature map
+            depth = F.interpolate(depth.unsqueeze(1), size=size, mode='nearest').squeeze(1)
+            confidence = F.interpolate(confidence.unsqueeze(1), size=size, mode='nearest').squeeze(1)
+        coarse_spread = (num_depth - 1) / (self.cascade_depths - 1)
+        spread = 1 + (1 - confidence.clamp(0, 1)) * (coarse_spread - 1)
+        fine_depth_values = narrow_depth_values(depth_values, depth, spread, self.cascade_depths)
+        return self.forward_stage(features, warping, fine_depth_values)
+
+    # side of the square tiles of forward_tiled (without halo) on the scale 1 feature map
+    def tile_size(self, num_depth):
+        pixel_bytes = num_depth * 32 * 4 * TILE_VOLUME_COPIES
+        extent = int(math.sqrt(self.tile_memory_mb * 1024 * 1024 / pixel_bytes))
+        if extent < 2 * self.tile_halo + TILE_ALIGN:
+            # the smallest tile, TILE_ALIGN pixels with halo, would exceed the budget
+            min_memory_mb = int(math.ceil((2 * self.tile_halo + TILE_ALIGN) ** 2 * pixel_bytes / 1024 / 1024))
+            raise Exception('tile_memory_mb {} does not fit a tile with a halo of {} pixels at {} depth values, '
+                            'tile_memory_mb must be at least {}'.format(self.tile_memory_mb, self.tile_halo,
+                                                                       num_depth, min_memory_mb))
+        return (extent - 2 * self.tile_halo) // TILE_ALIGN * TILE_ALIGN
+
+    # Steps 2-4 tile by tile for inputs whose cost volume does not fit in memory (origin_size, Tanks&Temples).
+    # The reference feature map is split into square tiles sized from tile_memory_mb, each extended by tile_halo
+    # pixels (the receptive field of the 3D networks), the depth and confidence of the tile without halo are kept.
+    # Tiles are aligned to the stride of the 3D U-Nets, so the BatchNorm networks give the same result as the whole
+    # volume. GroupNorm statistics and the align_corners interpolations (Coarse2Fine, origin_size) are computed per
+    # tile, with those networks the result is close to but not identical with the whole volume.
+    def forward_tiled(self, features, warping, depth_values):
+        ref_features = features[0]
+        multi_scale = isinstance(ref_features, (list, tuple))
+        if not multi_scale:
+            ref_features = [ref_features]
+        height, width = ref_features[0].shape[2], ref_features[0].shape[3]
+        tile = self.tile_size(depth_values.shape[1])
+        outputs = {}
+        for y0 in range(0, height, tile):
+            for x0 in range(0, width, tile):
+                # tile with halo, clipped to the feature map
+                hy0, hx0 = max(0, y0 - self.tile_halo), max(0, x0 - self.tile_halo)
+                hy1, hx1 = min(height, y0 + tile + self.tile_halo), min(width, x0 + tile + self.tile_halo)
+                region = (hy0, hx0, hy1 - hy0, hx1 - hx0)
+                tile_ref_features = [crop_region(ref_feature, region, ref_feature.shape[3] / width)
+                                     for ref_feature in ref_features]
+                tile_features = [tile_ref_features if multi_scale else tile_ref_features[0]] + list(features[1:])
+                tile_depth_values = depth_values
+                if depth_values.dim() == 4 and depth_values.shape[2:] != (1, 1):
+                    tile_depth_values = crop_region(depth_values.expand(*depth_values.shape[:2], height, width), region)
+                tile_outputs = self.forward_volumes(tile_features, warping.tile(region), tile_depth_values)
+                # tile without halo, relative to the tile with halo
+                core = (y0 - hy0, x0 - hx0, min(tile, height - y0), min(tile, width - x0))
+                for key, values in tile_outputs.items():
+                    if not isinstance(values, (list, tuple)):
+                        values = [values]
+                    if key not in outputs:
+                        # output size relative to the feature map, e.g. x2 with origin_size, x0.5 at the coarser scales
+                        outputs[key] = [value.new_zeros(value.shape[:-2] + (int(height * value.shape[-1] / region[3]),
+                                        int(width * value.shape[-1] / region[3]))) for value in values]
+                    for output, value in zip(outputs[key], values):
+                        ratio = value.shape[-1] / region[3]
+                        crop_region(output, (y0, x0) + core[2:], ratio).copy_(crop_region(value, core, ratio))
+        if not multi_scale:
+            outputs = {key: values[0] for key, values in outputs.items()}
+        return outputs
+
+    # step 4. depth regression and photometric confidence, cost_reg: [B, D, H, W], depth_values: [B, D]
+    def regress_depth(self, cost_reg, depth_values):
+        if depth_values.dim() == 4 and depth_values.shape[-2:] not in (cost_reg.shape[-2:], (1, 1)):
+            # per pixel hypotheses of a volume upsampled by the origin_size networks, upsampled the same way
+            depth_values = F.interpolate(depth_values, size=cost_reg.shape[-2:], mode='bilinear', align_corners=True)
+        if self.fused_regression and not self.training:
+            return fused_depth_regression(cost_reg, depth_values, self.depth_chunk or REGRESSION_CHUNK)
+        num_depth = cost_reg.shape[1]
+        # cost volume need to mul by -1
+        prob_volume = F.softmax(-1*cost_reg, dim=1) # get prob volume
+        depth = depth_regression(prob_volume, depth_values=depth_values)
+
+        with torch.no_grad():
+            # photometric confidence
+            prob_volume_sum4 = 4 * F.avg_pool3d(F.pad(prob_volume.unsqueeze(1), pad=(0, 0, 0, 0, 1, 2)), (4, 1, 1), stride=1, padding=0).squeeze(1)
+            depth_index = depth_regression(prob_volume, depth_values=torch.arange(num_depth, device=prob_volume.device, dtype=torch.float)).long()
+            photometric_confidence = torch.gather(prob_volume_sum4, 1, depth_index.unsqueeze(1)).squeeze(1)
+        return depth, photometric_confidence
+
+    # steps 2-4, features[0] may be a region of the reference features with the matching WarpingContext.tile
+    def forward_volumes(self, features, warping, depth_values):
         num_depth = depth_values.shape[1]
-        num_views = len(imgs)
         if ('High' in self.fea_net) and ('Coarse2Fine' in self.cost_net) :
-            # step 1. feature extraction
-            # in: images; out: 32-channel feature maps
-            features = [self.feature(img) for img in imgs] #ref_num * 3
             ref_features, src_features_o = features[0], features[1:]
-            ref_proj_o, src_projs_o = proj_matrices[0], proj_matrices[1:]
             # proj_mat[:3, :4] = proj_mat[:3, :4]  * sample_scale
             
             sample_scale = [1, 0.5, 0.25, 0.125]
@@ -414,51 +715,12 @@ class MVSNet(nn.Module):
             src_features_o_transpose = list(map(list, zip(*(list(src_features_o))))) # N-1 * 4 -> 4 * N-1
             ii = 0
             for ref_feature, src_features, one_scale in zip(ref_features, src_features_o_transpose, sample_scale):
-                ref_proj = ref_proj_o.clone()
-                ref_proj[:, :3, :4] = ref_proj[:, :3, :4] * one_scale
-                src_projs = deepcopy(src_projs_o) # deep copy
-                for ti in range(len(src_projs)):
-                    src_projs[ti][:, :3, :4] = src_projs[ti][:, :3, :4] * one_scale
                 # step 2. differentiable homograph, build cost volume
-                new_num_depth = int(num_depth * one_scale)
-                new_index = torch.arange(0, 192, int(1/one_scale)).cuda()
-                new_depth_values=depth_values.index_select(1, new_index)
+                new_depth_values = subsample_depth_values(depth_values, int(1/one_scale))
                 new_depth_values_list.append(new_depth_values)
-                if self.cost_aggregation == 0:
-                    ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, new_num_depth, 1, 1)
-                    volume_sum = ref_volume
-                    volume_sq_sum = ref_volume ** 2
-                    del ref_volume
-                    for src_fea, src_proj in zip(src_features, src_projs):
-                        # warpped features
-                        warped_volume = homo_warping(src_fea, src_proj, ref_proj, new_depth_values)
-                        if self.training:
-                            volume_sum = volume_sum + warped_volume
-                            volume_sq_sum = volume_sq_sum + warped_volume ** 2
-                        else:
-                            # TODO: this is only a temporal solution to save memory, better way?
-                            volume_sum += warped_volume
-                            volume_sq_sum += warped_volume.pow_(2)  # the memory of warped_volume has been modified
-                        del warped_volume
-                    # aggregate multiple feature volumes by variance
-                    volume_variance = volume_sq_sum.div_(num_views).sub_(volume_sum.div_(num_views).pow_(2))
-                elif self.cost_aggregation == 95: # More efficient, do not need to save warp_volumes
-                    ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, new_num_depth, 1, 1)
-                    #warp_volumes = []
-                    warp_volumes = None
-                    for src_fea, src_proj in zip(src_features, src_projs):
-                        # warpped features
-                        warped_volume = homo_warping(src_fea, src_proj, ref_proj, new_depth_values)
-                        warped_volume = (warped_volume - ref_volume).pow_(2) #B,C,D,H,W
-                        B,C,D,H,W = warped_volume.shape
-
-                        reweight = self.volumegate[ii](warped_volume) #B, 1, D, H, W
-                        if warp_volumes is None:
-                            warp_volumes = (reweight + 1) * warped_volume
-                        else:
-                            warp_volumes += (reweight + 1) * warped_volume
-                    aggregate_volume = warp_volumes / len(src_features)
-                    volume_variance = aggregate_volume
+                volumegate = self.volumegate[ii] if self.cost_aggregation == 95 else None
+                volume_variance = self.build_cost_volume(warping, ref_feature, src_features, new_depth_values,
+                                                         one_scale, volumegate)
 
                 volume_variances.append(volume_variance)
                 ii += 1
@@ -471,15 +733,7 @@ class MVSNet(nn.Module):
             i = 0
             for cost_reg in cost_reg_list:
                 cost_reg = cost_reg.squeeze(1) # B, C, D, H, W
-                # cost volume need to mul by -1
-                prob_volume = F.softmax(-1*cost_reg, dim=1) # get prob volume
-                depth = depth_regression(prob_volume, depth_values=new_depth_values_list[i])
-                
-                with torch.no_grad():
-                    # photometric confidence
-                    prob_volume_sum4 = 4 * F.avg_pool3d(F.pad(prob_volume.unsqueeze(1), pad=(0, 0, 0, 0, 1, 2)), (4, 1, 1), stride=1, padding=0).squeeze(1)
-                    depth_index = depth_regression(prob_volume, depth_values=torch.arange(int(num_depth*sample_scale[i]), device=prob_volume.device, dtype=torch.float)).long()
-                    photometric_confidence = torch.gather(prob_volume_sum4, 1, depth_index.unsqueeze(1)).squeeze(1)
+                depth, photometric_confidence = self.regress_depth(cost_reg, new_depth_values_list[i])
                 depth_list.append(depth)
                 photometric_confidence_list.append(photometric_confidence)
                 i += 1
@@ -487,62 +741,17 @@ class MVSNet(nn.Module):
             return {"depth": depth_list, "photometric_confidence": photometric_confidence_list}
             
         else:
-            # step 1. feature extraction
-            # in: images; out: 32-channel feature maps
-            features = [self.feature(img) for img in imgs]
             ref_feature, src_features = features[0], features[1:]
-            ref_proj, src_projs = proj_matrices[0], proj_matrices[1:]
 
             # step 2. differentiable homograph, build cost volume
-            if self.cost_aggregation == 0:
-                ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
-                volume_sum = ref_volume
-                volume_sq_sum = ref_volume ** 2
-                del ref_volume
-                for src_fea, src_proj in zip(src_features, src_projs):
-                    # warpped features
-                    warped_volume = homo_warping(src_fea, src_proj, ref_proj, depth_values)
-                    if self.training:
-                        volume_sum = volume_sum + warped_volume
-                        volume_sq_sum = volume_sq_sum + warped_volume ** 2
-                    else:
-                        # TODO: this is only a temporal solution to save memory, better way?
-                        volume_sum += warped_volume
-                        volume_sq_sum += warped_volume.pow_(2)  # the memory of warped_volume has been modified
-                    del warped_volume
-                # aggregate multiple feature volumes by variance
-                volume_variance = volume_sq_sum.div_(num_views).sub_(volume_sum.div_(num_views).pow_(2))
-            
-            elif self.cost_aggregation == 91: # 1x1 element-wise reweight
-                ref_volume = ref_feature.unsqueeze(2).repeat(1, 1, num_depth, 1, 1)
-                warp_volumes = None
-                for src_fea, src_proj in zip(src_features, src_projs):
-                    # warpped features
-                    warped_volume = homo_warping(src_fea, src_proj, ref_proj, depth_values)
-                    warped_volume = (warped_volume - ref_volume).pow_(2) #B,C,D,H,W
-                    B,C,D,H,W = warped_volume.shape
-                    reweight = self.volumegate(warped_volume) #B, 1, D, H, W
-                    if warp_volumes is None:
-                        warp_volumes = (reweight + 1) * warped_volume
-                    else:
-                        warp_volumes += (reweight + 1) * warped_volume
-                    #del warped_volume
-                aggregate_volume = warp_volumes / len(src_features)
-                volume_variance = aggregate_volume
+            volumegate = self.volumegate if self.cost_aggregation == 91 else None
+            volume_variance = self.build_cost_volume(warping, ref_feature, src_features, depth_values, 1, volumegate)
 
             # step 3. cost volume regularization
             cost_reg = self.cost_regularization(volume_variance)
             cost_reg = cost_reg.squeeze(1) # B, C, D, H, W
-            # cost volume need to mul by -1
-            prob_volume = F.softmax(-1*cost_reg, dim=1) # get prob volume
-            depth = depth_regression(prob_volume, depth_values=depth_values)
-
-            with torch.no_grad():
-                # photometric confidence
-                prob_volume_sum4 = 4 * F.avg_pool3d(F.pad(prob_volume.unsqueeze(1), pad=(0, 0, 0, 0, 1, 2)), (4, 1, 1), stride=1, padding=0).squeeze(1)
-                depth_index = depth_regression(prob_volume, depth_values=torch.arange(num_depth, device=prob_volume.device, dtype=torch.float)).long()
-                photometric_confidence = torch.gather(prob_volume_sum4, 1, depth_index.unsqueeze(1)).squeeze(1)
-            
+            depth, photometric_confidence = self.regress_depth(cost_reg, depth_values)
+
             return {"depth": depth, "photometric_confidence": photometric_confidence}
             
 def get_propability_map(prob_volume, depth, depth_values):
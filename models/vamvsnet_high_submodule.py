@@ -98,7 +98,7 @@ class FeatureNetHighGN(nn.Module): #Original Paper Setting
         feature4 = self.feature4(x)
         return [feature1, feature2, feature3, feature4]
 
-class RegNetUS0_Coarse2Fine(nn.Module):
+class RegNetUS0_Coarse2Fine(nn.Module, CheckpointStages):
     def __init__(self, origin_size=False, dp_ratio=0.0, image_scale=0.25):
         super(RegNetUS0_Coarse2Fine, self).__init__()
         self.origin_size = origin_size
@@ -140,28 +140,35 @@ class RegNetUS0_Coarse2Fine(nn.Module):
         self.dropout4 = nn.Dropout3d(p=dp_ratio)
         #add Drop out
         
-    def forward(self, x_list):
-        x1, x2, x3, x4 = x_list # 32*192, 32*96, 64*48, 64*24
-        input_shape = x1.shape
-
+    def encode(self, x1):
         conv0 = self.conv0(x1)
         conv1 = self.conv1(x1)
         conv3 = self.conv3(conv1)
         conv5 = self.conv5(conv3)
+        return conv0, self.conv2(conv1), self.conv4(conv3), self.conv6(conv5)
 
-        x = torch.cat([self.conv6(conv5), x4], 1)
+    def decode(self, conv0, conv2, conv4, conv6, x1, x2, x3, x4):
+        x = torch.cat([conv6, x4], 1)
         prob4 = self.dropout4(self.prob4(x))
         #prob4 = self.prob4(x)
-        x = self.conv7(x) + self.conv4(conv3)
+        x = self.conv7(x) + conv4
         x = torch.cat([x, x3, F.interpolate(prob4, scale_factor=2, mode='trilinear', align_corners=True)], 1)
         prob3 = self.dropout3(self.prob3(x))
         #prob3 = self.prob3(x)
-        x = self.conv9(x) + self.conv2(conv1)
+        x = self.conv9(x) + conv2
         x = torch.cat([x, x2, F.interpolate(prob3, scale_factor=2, mode='trilinear', align_corners=True)], 1)
         prob2 = self.dropout2(self.prob2(x))
         #prob2 = self.prob2(x)
         x = self.conv11(x) + conv0
         x = torch.cat([x, x1, F.interpolate(prob2, scale_factor=2, mode='trilinear', align_corners=True)], 1)
+        return x, prob2, prob3, prob4
+
+    def forward(self, x_list):
+        x1, x2, x3, x4 = x_list # 32*192, 32*96, 64*48, 64*24
+        input_shape = x1.shape
+
+        conv0, conv2, conv4, conv6 = self.stage('encoder', self.encode, x1)
+        x, prob2, prob3, prob4 = self.stage('decoder', self.decode, conv0, conv2, conv4, conv6, x1, x2, x3, x4)
 
         if self.origin_size and self.image_scale == 0.50:
             x = F.interpolate(x, size=(input_shape[2], input_shape[3]*2, input_shape[4]*2), mode='trilinear', align_corners=True)
@@ -172,7 +179,7 @@ class RegNetUS0_Coarse2Fine(nn.Module):
         return [prob1, prob2, prob3, prob4]
 
 
-class RegNetUS0_Coarse2FineGN(nn.Module):
+class RegNetUS0_Coarse2FineGN(nn.Module, CheckpointStages):
     def __init__(self, origin_size=False, dp_ratio=0.0, image_scale=0.25):
         super(RegNetUS0_Coarse2FineGN, self).__init__()
         self.origin_size = origin_size
@@ -216,29 +223,35 @@ class RegNetUS0_Coarse2FineGN(nn.Module):
         #add Drop out
         
 
-    def forward(self, x_list):
-        x1, x2, x3, x4 = x_list # 32*192, 32*96, 64*48, 64*24
-        # print(x1.shape, x2.shape, x3.shape, x4.shape)
-        input_shape = x1.shape
-
+    def encode(self, x1):
         conv0 = self.conv0(x1)
         conv1 = self.conv1(x1)
         conv3 = self.conv3(conv1)
         conv5 = self.conv5(conv3)
+        return conv0, self.conv2(conv1), self.conv4(conv3), self.conv6(conv5)
 
-        x = torch.cat([self.conv6(conv5), x4], 1)
+    def decode(self, conv0, conv2, conv4, conv6, x1, x2, x3, x4):
+        x = torch.cat([conv6, x4], 1)
         prob4 = self.dropout4(self.prob4(x))
         #prob4 = self.prob4(x)
-        x = self.conv7(x) + self.conv4(conv3)
+        x = self.conv7(x) + conv4
         x = torch.cat([x, x3, F.interpolate(prob4, scale_factor=2, mode='trilinear', align_corners=True)], 1)
         prob3 = self.dropout3(self.prob3(x))
         #prob3 = self.prob3(x)
-        x = self.conv9(x) + self.conv2(conv1)
+        x = self.conv9(x) + conv2
         x = torch.cat([x, x2, F.interpolate(prob3, scale_factor=2, mode='trilinear', align_corners=True)], 1)
         prob2 = self.dropout2(self.prob2(x))
         #prob2 = self.prob2(x)
         x = self.conv11(x) + conv0
         x = torch.cat([x, x1, F.interpolate(prob2, scale_factor=2, mode='trilinear', align_corners=True)], 1)
+        return x, prob2, prob3, prob4
+
+    def forward(self, x_list):
+        x1, x2, x3, x4 = x_list # 32*192, 32*96, 64*48, 64*24
+        input_shape = x1.shape
+
+        conv0, conv2, conv4, conv6 = self.stage('encoder', self.encode, x1)
+        x, prob2, prob3, prob4 = self.stage('decoder', self.decode, conv0, conv2, conv4, conv6, x1, x2, x3, x4)
 
         if self.origin_size and self.image_scale == 0.50:
             x = F.interpolate(x, size=(input_shape[2], input_shape[3]*2, input_shape[4]*2), mode='trilinear', align_corners=True)
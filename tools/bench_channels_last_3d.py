@@ -0,0 +1,100 @@
+import argparse
+import copy
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import MVSNet
+
+# Per-layer CPU throughput of the 3D regularization network in the default NCDHW layout against channels_last_3d
+# (MVSNet(channels_last_3d=True), eval.py --channels_last_3d). The input shape of every layer is taken from a forward
+# pass on the meta device, so the DTU eval shapes (1600x1184 images, D=192) need no memory for that; each layer is
+# then timed alone on random inputs of its shape, in both layouts. The first layers of the whole DTU volume need
+# about 8 GB, --width 384 keeps the DTU depth and height (PyTorch picks the conv3d implementation by N*C*D*H).
+parser = argparse.ArgumentParser(description='Benchmark the 3D networks in NCDHW and channels_last_3d layout')
+parser.add_argument('--fea_net', default='FeatureNet', help='feature extractor network')
+parser.add_argument('--cost_net', default='CostRegNet', help='cost volume network')
+parser.add_argument('--numdepth', type=int, default=192, help='the number of depth values')
+parser.add_argument('--height', type=int, default=1184, help='image height')
+parser.add_argument('--width', type=int, default=1600, help='image width')
+parser.add_argument('--iters', type=int, default=3, help='timed calls per layer and layout')
+parser.add_argument('--threads', type=int, default=0, help='torch CPU threads, 0 keeps the default')
+
+
+# (name, input shape) of each call of a leaf module of the 3D regularization network, in call order
+def layer_shapes(model, args):
+    meta = copy.deepcopy(model).to('meta')
+    calls = []
+    for name, module in meta.cost_regularization.named_modules():
+        if len(list(module.children())) == 0:
+            module.register_forward_pre_hook(
+                lambda module, inputs, name=name: calls.append((name, tuple(inputs[0].shape))))
+    with torch.no_grad():
+        features = meta.feature(torch.empty(1, 3, args.height, args.width, device='meta'))
+        if not isinstance(features, (list, tuple)):
+            features = [features]
+        # depth hypotheses of each scale, subsample_depth_values(depth_values, 2 ** i)
+        volumes = [torch.empty(1, feature.shape[1], -(-args.numdepth // 2 ** i), feature.shape[2], feature.shape[3],
+                               device='meta') for i, feature in enumerate(features)]
+        meta.cost_regularization(volumes if len(volumes) > 1 else volumes[0])
+    return calls
+
+
+# multiply-adds of a convolution, None for the other layers
+def conv_macs(module, shape):
+    if not isinstance(module, nn.modules.conv._ConvNd):
+        return None
+    kernel = torch.Size(module.kernel_size).numel()
+    if module.transposed:
+        return torch.Size(shape).numel() * module.out_channels // module.groups * kernel
+    with torch.no_grad():
+        output_shape = copy.deepcopy(module).to('meta')(torch.empty(shape, device='meta')).shape
+    return output_shape.numel() * module.in_channels // module.groups * kernel
+
+
+def bench(module, x, iters):
+    with torch.no_grad():
+        module(x)
+        time_s = time.time()
+        for _ in range(iters):
+            module(x)
+    return (time.time() - time_s) / iters
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = MVSNet(refine=False, fea_net=args.fea_net, cost_net=args.cost_net).eval()
+    # same weights, layers as run by MVSNet(channels_last_3d=True)
+    model_ndhwc = MVSNet(refine=False, fea_net=args.fea_net, cost_net=args.cost_net, channels_last_3d=True).eval()
+    model_ndhwc.load_state_dict(model.state_dict())
+    modules = dict(model.cost_regularization.named_modules())
+    modules_ndhwc = dict(model_ndhwc.cost_regularization.named_modules())
+    calls = layer_shapes(model, args)
+    print('{} {}: {}x{}, D={}, {} threads'.format(args.fea_net, args.cost_net, args.width, args.height, args.numdepth,
+          torch.get_num_threads()))
+    print('{:24s} {:16s} {:26s} {:>10s} {:>10s} {:>7s} {:>14s}'.format(
+          'layer', 'type', 'input', 'NCDHW ms', 'NDHWC ms', 'speed', 'GFLOP/s'))
+    totals = [0.0, 0.0]
+    for name, shape in calls:
+        module = modules[name]
+        # one input alive at a time, the first layers take GBs at DTU eval shapes
+        x = torch.empty(shape).normal_()
+        time_ncdhw = bench(module, x, args.iters)
+        del x
+        x = torch.empty(shape, memory_format=torch.channels_last_3d).normal_()
+        time_ndhwc = bench(modules_ndhwc[name], x, args.iters)
+        del x
+        totals[0] += time_ncdhw
+        totals[1] += time_ndhwc
+        macs = conv_macs(module, shape)
+        flops = '' if macs is None else '{:6.1f} /{:6.1f}'.format(2 * macs / time_ncdhw / 1e9, 2 * macs / time_ndhwc / 1e9)
+        print('{:24s} {:16s} {:26s} {:10.1f} {:10.1f} {:6.2f}x {:>14s}'.format(
+              name, type(modules_ndhwc[name]).__name__, str(list(shape)), time_ncdhw * 1000, time_ndhwc * 1000,
+              time_ncdhw / time_ndhwc, flops))
+    print('{:24s} {:16s} {:26s} {:10.1f} {:10.1f} {:6.2f}x'.format('total', '', '', totals[0] * 1000, totals[1] * 1000,
+          totals[0] / totals[1]))
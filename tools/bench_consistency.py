@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.consistency import check_geometric_consistency_views, average_consistent_depth
+
+# Checks that the batched geometric consistency of the fusion (datasets/consistency.py) gives the same masks and
+# averaged depth as the per view loop it replaced, and times both, on synthetic depth maps of a tilted plane seen
+# by cameras around the reference view, with noise and holes so that part of the pixels are not consistent.
+# The defaults are the eval.py fusion of DTU (1/4 of 1600x1184, 10 source views), tools/filter_fusion.py upsamples
+# the depth maps to 1/2 and uses 6 source views (--height 592 --width 800 --num_src 6 --thresh_scale 0.5).
+parser = argparse.ArgumentParser(description='Check and benchmark the batched geometric consistency of the fusion')
+parser.add_argument('--height', type=int, default=296, help='depth map height')
+parser.add_argument('--width', type=int, default=400, help='depth map width')
+parser.add_argument('--num_src', type=int, default=10, help='source views per reference view')
+parser.add_argument('--thresh_scale', type=float, default=1.0, help='scale of the pixel and relative depth thresholds')
+parser.add_argument('--noise', type=float, default=0.005, help='relative depth noise')
+parser.add_argument('--iters', type=int, default=3, help='timed reference views')
+
+
+# the per view check of eval.py and tools/filter_fusion.py before batching, the reference of the comparison
+def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
+    width, height = depth_ref.shape[1], depth_ref.shape[0]
+    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
+    x_ref, y_ref = x_ref.reshape([-1]), y_ref.reshape([-1])
+    xyz_ref = np.matmul(np.linalg.inv(intrinsics_ref),
+                        np.vstack((x_ref, y_ref, np.ones_like(x_ref))) * depth_ref.reshape([-1]))
+    xyz_src = np.matmul(np.matmul(extrinsics_src, np.linalg.inv(extrinsics_ref)),
+                        np.vstack((xyz_ref, np.ones_like(x_ref))))[:3]
+    K_xyz_src = np.matmul(intrinsics_src, xyz_src)
+    xy_src = K_xyz_src[:2] / K_xyz_src[2:3]
+    x_src = xy_src[0].reshape([height, width]).astype(np.float32)
+    y_src = xy_src[1].reshape([height, width]).astype(np.float32)
+    sampled_depth_src = cv2.remap(depth_src, x_src, y_src, interpolation=cv2.INTER_LINEAR)
+    xyz_src = np.matmul(np.linalg.inv(intrinsics_src),
+                        np.vstack((xy_src, np.ones_like(x_ref))) * sampled_depth_src.reshape([-1]))
+    xyz_reprojected = np.matmul(np.matmul(extrinsics_ref, np.linalg.inv(extrinsics_src)),
+                                np.vstack((xyz_src, np.ones_like(x_ref))))[:3]
+    depth_reprojected = xyz_reprojected[2].reshape([height, width]).astype(np.float32)
+    K_xyz_reprojected = np.matmul(intrinsics_ref, xyz_reprojected)
+    xy_reprojected = K_xyz_reprojected[:2] / K_xyz_reprojected[2:3]
+    x_reprojected = xy_reprojected[0].reshape([height, width]).astype(np.float32)
+    y_reprojected = xy_reprojected[1].reshape([height, width]).astype(np.float32)
+    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
+
+
+def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src,
+                                dist_thresh, relative_depth_thresh):
+    width, height = depth_ref.shape[1], depth_ref.shape[0]
+    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
+    depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src, y2d_src = reproject_with_depth(
+        depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src)
+    dist = np.sqrt((x2d_reprojected - x_ref) ** 2 + (y2d_reprojected - y_ref) ** 2)
+    depth_diff = np.abs(depth_reprojected - depth_ref)
+    relative_depth_diff = depth_diff / depth_ref
+    mask = np.logical_and(dist < dist_thresh, relative_depth_diff < relative_depth_thresh)
+    depth_reprojected[~mask] = 0
+    return mask, depth_reprojected, x2d_src, y2d_src
+
+
+def filter_per_view(depth_ref, cameras_ref, depths_src, cameras_src, dist_thresh, relative_depth_thresh):
+    all_srcview_depth_ests = []
+    geo_mask_sum = 0
+    for depth_src, (intrinsics_src, extrinsics_src) in zip(depths_src, cameras_src):
+        geo_mask, depth_reprojected, _, _ = check_geometric_consistency(depth_ref, cameras_ref[0], cameras_ref[1],
+            depth_src, intrinsics_src, extrinsics_src, dist_thresh, relative_depth_thresh)
+        geo_mask_sum += geo_mask.astype(np.int32)
+        all_srcview_depth_ests.append(depth_reprojected)
+    depth_est_averaged = (sum(all_srcview_depth_ests) + depth_ref) / (geo_mask_sum + 1)
+    return depth_est_averaged, geo_mask_sum
+
+
+def filter_batched(depth_ref, cameras_ref, depths_src, cameras_src, dist_thresh, relative_depth_thresh):
+    masks, depths_reprojected, _, _ = check_geometric_consistency_views(depth_ref, cameras_ref[0], cameras_ref[1],
+        depths_src, np.array([camera[0] for camera in cameras_src]), np.array([camera[1] for camera in cameras_src]),
+        dist_thresh, relative_depth_thresh)
+    return average_consistent_depth(depth_ref, masks, depths_reprojected)
+
+
+# camera looking at the origin from a point on a sphere, float32 matrices like the cam files
+def make_camera(args, azimuth, elevation, distance=700.0):
+    center = distance * np.array([np.sin(azimuth) * np.cos(elevation), np.sin(elevation), -np.cos(azimuth) * np.cos(elevation)])
+    forward = -center / np.linalg.norm(center)
+    right = np.cross([0, 1, 0], forward)
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    rotation = np.stack([right, down, forward])
+    extrinsics = np.eye(4)
+    extrinsics[:3, :3] = rotation
+    extrinsics[:3, 3] = -rotation.dot(center)
+    focal = args.width * 0.9
+    intrinsics = np.array([[focal, 0, args.width / 2], [0, focal, args.height / 2], [0, 0, 1]])
+    return intrinsics.astype(np.float32), extrinsics.astype(np.float32)
+
+
+# depth of the plane n.X = 0 seen by the camera, with noise and holes
+def render_plane(args, camera, rng):
+    intrinsics, extrinsics = camera[0].astype(np.float64), camera[1].astype(np.float64)
+    normal = np.array([0.2, 0.3, -1.0]) / np.linalg.norm([0.2, 0.3, -1.0])
+    x, y = np.meshgrid(np.arange(args.width), np.arange(args.height))
+    rays = np.matmul(np.linalg.inv(intrinsics), np.stack([x.ravel(), y.ravel(), np.ones(x.size)]))
+    rotation, translation = extrinsics[:3, :3], extrinsics[:3, 3]
+    center = -rotation.T.dot(translation)
+    # X = center + z * R^T ray, n.X = 0
+    depth = -normal.dot(center) / normal.dot(np.matmul(rotation.T, rays))
+    depth = depth.reshape(args.height, args.width) * (1 + args.noise * rng.standard_normal((args.height, args.width)))
+    depth[rng.random((args.height, args.width)) < 0.05] = 0
+    return depth.astype(np.float32)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    dist_thresh, relative_depth_thresh = 1 * args.thresh_scale, 0.01 * args.thresh_scale
+    time_per_view, time_batched = 0.0, 0.0
+    identical = True
+    for it in range(args.iters + 1):
+        cameras_ref = make_camera(args, 0.05 * it, 0.0)
+        cameras_src = [make_camera(args, 0.05 * it + 0.1 * np.cos(i), 0.1 * np.sin(i)) for i in range(args.num_src)]
+        depth_ref = render_plane(args, cameras_ref, rng)
+        depths_src = [render_plane(args, camera, rng) for camera in cameras_src]
+
+        time_s = time.time()
+        depth_per_view, count_per_view = filter_per_view(depth_ref, cameras_ref, depths_src, cameras_src,
+                                                         dist_thresh, relative_depth_thresh)
+        time_m = time.time()
+        depth_batched, count_batched = filter_batched(depth_ref, cameras_ref, depths_src, cameras_src,
+                                                      dist_thresh, relative_depth_thresh)
+        time_e = time.time()
+        # the first reference view warms up
+        if it > 0:
+            time_per_view += time_m - time_s
+            time_batched += time_e - time_m
+        identical = identical and np.array_equal(count_per_view, count_batched) and \
+            np.array_equal(depth_per_view, depth_batched)
+        print('ref view {}: consistent source views per pixel {:.2f}, identical: {}'.format(
+              it, count_batched.mean(), identical))
+    print('{}x{}, {} source views: per view {:.3f} s, batched {:.3f} s ({:.2f}x)'.format(args.width, args.height,
+          args.num_src, time_per_view / args.iters, time_batched / args.iters, time_per_view / time_batched))
@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.dtu_yao_eval import MVSDataset
+
+# Decode time per pyramid level of the dtu_yao_eval images, full resolution decode + resize
+# against reduced resolution JPEG decode (--jpeg_draft), and the mean/max difference of the two.
+parser = argparse.ArgumentParser(description='Benchmark image decoding per pyramid level')
+parser.add_argument('--testpath', help='testing data path')
+parser.add_argument('--testlist', help='testing scan list')
+parser.add_argument('--num_images', type=int, default=20, help='images decoded per setting')
+parser.add_argument('--pyramid_resample', default='bilinear', choices=['bilinear', 'area'], help='downsampling of the pyramid levels')
+
+
+def bench(dataset, filenames):
+    imgs = []
+    time_s = time.time()
+    for filename in filenames:
+        imgs.append(dataset.decode_img(filename))
+    return (time.time() - time_s) / len(filenames), imgs
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    filenames = []
+    with open(args.testlist) as f:
+        scans = [line.rstrip() for line in f.readlines() if line.strip()]
+    for scan in scans:
+        image_folder = os.path.join(args.testpath, scan, 'images')
+        filenames += [os.path.join(image_folder, name) for name in sorted(os.listdir(image_folder))]
+    filenames = filenames[:args.num_images]
+
+    print('{} images, resample: {}'.format(len(filenames), args.pyramid_resample))
+    for pyramid in [0, 1, 2]:
+        full = MVSDataset(args.testpath, args.testlist, 'test', 5, pyramid=pyramid,
+                          pyramid_resample=args.pyramid_resample)
+        draft = MVSDataset(args.testpath, args.testlist, 'test', 5, pyramid=pyramid,
+                           pyramid_resample=args.pyramid_resample, jpeg_draft=True)
+        # warm up the file cache
+        bench(full, filenames)
+        full_time, full_imgs = bench(full, filenames)
+        draft_time, draft_imgs = bench(draft, filenames)
+        diff = np.concatenate([np.abs(a.astype(np.float32) - b).ravel() for a, b in zip(full_imgs, draft_imgs)])
+        print('pyramid {}: {}x{}, full decode {:.2f} ms, draft decode {:.2f} ms ({:.2f}x), diff mean {:.3f} max {:.0f}'.format(
+            pyramid, full_imgs[0].shape[1], full_imgs[0].shape[0], full_time * 1000, draft_time * 1000,
+            full_time / draft_time, diff.mean(), diff.max()))
@@ -0,0 +1,103 @@
+import argparse
+import ast
+import copy
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import MVSNet, fold_batchnorm
+from third_party.sync_batchnorm import convert_model
+
+# Checks that fold_batchnorm (eval.py --fold_bn) keeps the MVSNet outputs within tolerance and times the inference
+# before and after folding, on synthetic inputs with random BatchNorm statistics and affine parameters.
+parser = argparse.ArgumentParser(description='Check and benchmark the Conv-BatchNorm folding')
+parser.add_argument('--fea_net', default='FeatureNet', help='feature extractor network')
+parser.add_argument('--cost_net', default='CostRegNet', help='cost volume network')
+parser.add_argument('--cost_aggregation', type=int, default=0, help='cost aggregation method')
+parser.add_argument('--syncbn', help='True or False flag, input should be either "True" or "False". Convert the model to SyncBN before folding',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--view_num', type=int, default=3, help='views per sample')
+parser.add_argument('--numdepth', type=int, default=192, help='the number of depth values')
+parser.add_argument('--height', type=int, default=512, help='image height')
+parser.add_argument('--width', type=int, default=640, help='image width')
+parser.add_argument('--iters', type=int, default=3, help='timed forward passes')
+parser.add_argument('--tolerance', type=float, default=1e-2, help='allowed max abs depth difference')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='cpu or cuda')
+
+
+def make_inputs(args, device):
+    generator = torch.Generator().manual_seed(0)
+    imgs = torch.rand(1, args.view_num, 3, args.height, args.width, generator=generator)
+    # feature map intrinsics, cameras shifted along x
+    intrinsics = torch.tensor([[args.width / 4 * 0.9, 0, args.width / 8], [0, args.width / 4 * 0.9, args.height / 8], [0, 0, 1.]])
+    projs = []
+    for view in range(args.view_num):
+        proj = torch.eye(4)
+        proj[0, 3] = -20.0 * view
+        proj[:3, :4] = torch.matmul(intrinsics, proj[:3, :4])
+        projs.append(proj)
+    proj_matrices = torch.stack(projs).unsqueeze(0)
+    depth_values = torch.linspace(425, 935, args.numdepth).unsqueeze(0)
+    return imgs.to(device), proj_matrices.to(device), depth_values.to(device)
+
+
+# trained-like statistics, so that folding changes the weights
+def randomize_batchnorm(model):
+    generator = torch.Generator().manual_seed(1)
+    for m in model.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            m.running_mean.copy_(torch.randn(m.num_features, generator=generator) * 0.1)
+            m.running_var.copy_(torch.rand(m.num_features, generator=generator) + 0.5)
+            m.weight.data.copy_(torch.rand(m.num_features, generator=generator) + 0.5)
+            m.bias.data.copy_(torch.randn(m.num_features, generator=generator) * 0.1)
+
+
+# max abs difference of two outputs, the coarse-to-fine nets return a list of depth maps
+def max_diff(a, b):
+    if isinstance(a, (list, tuple)):
+        return max(max_diff(x, y) for x, y in zip(a, b))
+    return (a - b).abs().max().item()
+
+
+def count_batchnorm(model):
+    return sum(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules())
+
+
+def bench(model, inputs, iters, device):
+    outputs = model(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    time_s = time.time()
+    for _ in range(iters):
+        model(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return outputs, (time.time() - time_s) / iters
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = MVSNet(refine=False, fea_net=args.fea_net, cost_net=args.cost_net,
+                   cost_aggregation=args.cost_aggregation)
+    randomize_batchnorm(model)
+    if args.syncbn:
+        model = convert_model(model)
+    model = model.to(device).eval()
+    folded = fold_batchnorm(copy.deepcopy(model))
+    inputs = make_inputs(args, device)
+
+    with torch.no_grad():
+        outputs, time_bn = bench(model, inputs, args.iters, device)
+        outputs_folded, time_folded = bench(folded, inputs, args.iters, device)
+    depth_diff = max_diff(outputs['depth'], outputs_folded['depth'])
+    confidence_diff = max_diff(outputs['photometric_confidence'], outputs_folded['photometric_confidence'])
+    print('{} {} {}: {} views, {}x{}, D={}, {}'.format(args.fea_net, args.cost_net, args.cost_aggregation,
+          args.view_num, args.height, args.width, args.numdepth, args.device))
+    print('BatchNorm layers {} -> {}, max abs diff depth {:.2e} confidence {:.2e}, within tolerance: {}'.format(
+          count_batchnorm(model), count_batchnorm(folded), depth_diff, confidence_diff, depth_diff <= args.tolerance))
+    print('forward {:.3f} s, folded {:.3f} s ({:.2f}x)'.format(time_bn, time_folded, time_bn / time_folded))
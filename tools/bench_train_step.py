@@ -0,0 +1,96 @@
+import argparse
+import ast
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import MVSNet
+
+# Peak memory and time of MVSNet training steps (forward + backward) on synthetic inputs, one process per variant.
+# Variants are MVSNet keyword arguments, e.g.
+#   python tools/bench_train_step.py --variants "{}" "{'lean_warping': True}"
+# On CPU the peak is the growth of the max RSS during the steps, on CUDA torch.cuda.max_memory_allocated.
+parser = argparse.ArgumentParser(description='Benchmark MVSNet training steps')
+parser.add_argument('--fea_net', default='FeatureNet', help='feature extractor network')
+parser.add_argument('--cost_net', default='CostRegNet', help='cost volume network')
+parser.add_argument('--cost_aggregation', type=int, default=0, help='cost aggregation method')
+parser.add_argument('--batch_size', type=int, default=1, help='batch size')
+parser.add_argument('--view_num', type=int, default=3, help='views per sample')
+parser.add_argument('--numdepth', type=int, default=192, help='the number of depth values')
+parser.add_argument('--height', type=int, default=512, help='image height')
+parser.add_argument('--width', type=int, default=640, help='image width')
+parser.add_argument('--iters', type=int, default=3, help='timed steps')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='cpu or cuda')
+parser.add_argument('--variants', nargs='+', default=['{}'], help='MVSNet keyword arguments of each variant')
+
+
+def make_inputs(args, device):
+    generator = torch.Generator().manual_seed(0)
+    batch, num_views = args.batch_size, args.view_num
+    imgs = torch.rand(batch, num_views, 3, args.height, args.width, generator=generator)
+    # feature map intrinsics, cameras shifted along x
+    intrinsics = torch.tensor([[args.width / 4 * 0.9, 0, args.width / 8], [0, args.width / 4 * 0.9, args.height / 8], [0, 0, 1.]])
+    projs = []
+    for view in range(num_views):
+        proj = torch.eye(4)
+        proj[0, 3] = -20.0 * view
+        proj[:3, :4] = torch.matmul(intrinsics, proj[:3, :4])
+        projs.append(proj)
+    proj_matrices = torch.stack(projs).unsqueeze(0).repeat(batch, 1, 1, 1)
+    depth_values = torch.linspace(425, 935, args.numdepth).unsqueeze(0).repeat(batch, 1)
+    return imgs.to(device), proj_matrices.to(device), depth_values.to(device)
+
+
+def peak_mb(device, rss_start):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1024 / 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start) / 1024
+
+
+def run_variant(args, kwargs, queue):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = MVSNet(refine=False, fea_net=args.fea_net, cost_net=args.cost_net,
+                   cost_aggregation=args.cost_aggregation, **kwargs).to(device).train()
+    inputs = make_inputs(args, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(args.iters + 1):
+        time_s = time.time()
+        outputs = model(*inputs)
+        depths = outputs["depth"] if isinstance(outputs["depth"], list) else [outputs["depth"]]
+        loss = sum(depth.mean() for depth in depths)
+        model.zero_grad()
+        loss.backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.time() - time_s)
+        del outputs, depths, loss
+    # the first step includes the allocations of the parameter gradients
+    queue.put((peak_mb(device, rss_start), sum(times[1:]) / args.iters))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print('{} {} {}: {} x {} views, {}x{}, D={}, {}'.format(args.fea_net, args.cost_net, args.cost_aggregation,
+          args.batch_size, args.view_num, args.height, args.width, args.numdepth, args.device))
+    context = multiprocessing.get_context('spawn' if args.device == 'cuda' else 'fork')
+    results = []
+    for variant in args.variants:
+        kwargs = ast.literal_eval(variant)
+        queue = context.Queue()
+        process = context.Process(target=run_variant, args=(args, kwargs, queue))
+        process.start()
+        results.append((variant, ) + queue.get())
+        process.join()
+    base_peak, base_time = results[0][1], results[0][2]
+    for variant, peak, step_time in results:
+        print('{:40s} peak {:8.0f} MB ({:5.2f}x)  step {:6.2f} s ({:5.2f}x)'.format(
+            variant, peak, peak / base_peak, step_time, step_time / base_time))
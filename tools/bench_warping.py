@@ -0,0 +1,120 @@
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.module import WarpingContext
+
+# Microbenchmark of the cost volume warping of one coarse-to-fine forward pass (4 scales x source views):
+# the previous homo_warping (pixel grid, inverse and repeat on every call, deepcopy of the source
+# projections per scale) against WarpingContext.
+parser = argparse.ArgumentParser(description='Benchmark homo_warping against WarpingContext')
+parser.add_argument('--height', type=int, default=128, help='feature height at scale 1')
+parser.add_argument('--width', type=int, default=160, help='feature width at scale 1')
+parser.add_argument('--channels', type=int, default=16, help='feature channels')
+parser.add_argument('--num_depth', type=int, default=48, help='depth hypotheses at scale 1')
+parser.add_argument('--num_views', type=int, default=5, help='views per sample, including the reference view')
+parser.add_argument('--iters', type=int, default=10, help='timed iterations')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='cpu or cuda')
+
+
+# homo_warping before WarpingContext, kept here as the reference
+def homo_warping_reference(src_fea, src_proj, ref_proj, depth_values):
+    batch, channels = src_fea.shape[0], src_fea.shape[1]
+    num_depth = depth_values.shape[1]
+    height, width = src_fea.shape[2], src_fea.shape[3]
+
+    with torch.no_grad():
+        proj = torch.matmul(src_proj, torch.inverse(ref_proj))
+        rot = proj[:, :3, :3]  # [B,3,3]
+        trans = proj[:, :3, 3:4]  # [B,3,1]
+
+        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=src_fea.device),
+                               torch.arange(0, width, dtype=torch.float32, device=src_fea.device)])
+        y, x = y.contiguous(), x.contiguous()
+        y, x = y.view(height * width), x.view(height * width)
+        xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
+        xyz = torch.unsqueeze(xyz, 0).repeat(batch, 1, 1)  # [B, 3, H*W]
+        rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
+        rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, num_depth, 1) * depth_values.view(batch, 1, num_depth, 1)
+        proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1, 1)  # [B, 3, Ndepth, H*W]
+        proj_xyz[:, 2:3, :, :][proj_xyz[:, 2:3, :, :] == 0] += 0.0001
+        proj_xy = proj_xyz[:, :2, :, :] / proj_xyz[:, 2:3, :, :]  # [B, 2, Ndepth, H*W]
+        proj_x_normalized = proj_xy[:, 0, :, :] / ((width - 1) / 2) - 1
+        proj_y_normalized = proj_xy[:, 1, :, :] / ((height - 1) / 2) - 1
+        grid = torch.stack((proj_x_normalized, proj_y_normalized), dim=3)  # [B, Ndepth, H*W, 2]
+    warped_src_fea = F.grid_sample(src_fea, grid.view(batch, num_depth * height, width, 2), mode='bilinear',
+                                   padding_mode='zeros')
+    return warped_src_fea.view(batch, channels, num_depth, height, width).type(torch.float32)
+
+
+def make_inputs(args):
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(0)
+    scales = [1, 0.5, 0.25, 0.125]
+    features = [[torch.rand(1, args.channels, int(args.height * s), int(args.width * s), generator=generator).to(device)
+                 for s in scales] for _ in range(args.num_views - 1)]
+    intrinsics = torch.tensor([[args.width * 0.9, 0, args.width / 2], [0, args.width * 0.9, args.height / 2], [0, 0, 1.]])
+    projs = []
+    for view in range(args.num_views):
+        extrinsics = torch.eye(4)
+        extrinsics[0, 3] = -20.0 * view
+        proj = extrinsics.clone()
+        proj[:3, :4] = torch.matmul(intrinsics, extrinsics[:3, :4])
+        projs.append(proj.unsqueeze(0).to(device))
+    depth_values = torch.linspace(425, 935, args.num_depth, device=device).unsqueeze(0)
+    return scales, features, projs[0], projs[1:], depth_values
+
+
+def run_reference(scales, features, ref_proj_o, src_projs_o, depth_values):
+    volumes = []
+    for i, scale in enumerate(scales):
+        ref_proj = ref_proj_o.clone()
+        ref_proj[:, :3, :4] = ref_proj[:, :3, :4] * scale
+        src_projs = deepcopy(src_projs_o)
+        for src_proj in src_projs:
+            src_proj[:, :3, :4] = src_proj[:, :3, :4] * scale
+        new_depth_values = depth_values[:, ::int(1 / scale)]
+        for src_fea, src_proj in zip(features, src_projs):
+            volumes.append(homo_warping_reference(src_fea[i], src_proj, ref_proj, new_depth_values))
+    return volumes
+
+
+def run_context(scales, features, ref_proj_o, src_projs_o, depth_values):
+    volumes = []
+    warping = WarpingContext(ref_proj_o, src_projs_o)
+    for i, scale in enumerate(scales):
+        new_depth_values = depth_values[:, ::int(1 / scale)]
+        for idx, src_fea in enumerate(features):
+            volumes.append(warping.warp(src_fea[i], idx, new_depth_values, scale))
+    return volumes
+
+
+def bench(func, inputs, iters, device):
+    func(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    time_s = time.time()
+    for _ in range(iters):
+        func(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - time_s) / iters
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    inputs = make_inputs(args)
+    with torch.no_grad():
+        same = all(torch.equal(a, b) for a, b in zip(run_reference(*inputs), run_context(*inputs)))
+        reference_time = bench(run_reference, inputs, args.iters, device)
+        context_time = bench(run_context, inputs, args.iters, device)
+    print('{}: {}x{}x{}, D={}, {} views, identical: {}'.format(args.device, args.channels, args.height, args.width,
+                                                               args.num_depth, args.num_views, same))
+    print('homo_warping {:.2f} ms, WarpingContext {:.2f} ms ({:.2f}x)'.format(
+        reference_time * 1000, context_time * 1000, reference_time / context_time))
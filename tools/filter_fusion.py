@@ -16,6 +16,10 @@ from datasets import find_dataset_def
 from models import *
 from utils import *
 from datasets.data_io import read_pfm, save_pfm
+from datasets.depth_archive import DepthArchive, DepthArchiveWriter, open_depth_source
+from datasets.manifest import get_manifest
+from datasets.consistency import check_geometric_consistency_views, average_consistent_depth
+from datasets.fusion_cache import FusionCache
 import cv2
 from plyfile import PlyData, PlyElement
 from PIL import Image
@@ -50,6 +54,7 @@ parser.add_argument('--outdir_down8', default='/data1/wzz/3001', help='1/8 size
 parser.add_argument('--outdir_down16', default='/data1/wzz/3002', help='1/16 size output dir')
 
 parser.add_argument('--display', action='store_true', help='display depth images and masks')
+parser.add_argument('--fusion_cache_mb', type=int, default=1024, help='keep the upsampled depth maps and cameras of a scan in an LRU cache of this size (MB), 0 disables')
 
 
 
@@ -60,25 +65,27 @@ print("argv:", sys.argv[1:])
 print_args(args)
 
 
-# read intrinsics and extrinsics
-def read_camera_parameters(filename, scale, flag):
+# read intrinsics and extrinsics from the scan manifest
+def read_camera_parameters(manifest, view, scale, flag):
 
     if (flag):
         scale/=2
 
-    with open(filename) as f:
-        lines = f.readlines()
-        lines = [line.rstrip() for line in lines]
-    # extrinsics: line [1,5), 4x4 matrix
-    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-    # intrinsics: line [7-10), 3x3 matrix
-    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    intrinsics, extrinsics = manifest.camera(view)[:2]
     # TODO: assume the feature is 1/4 of the original image size
 
     intrinsics[:2, :] /= scale
     return intrinsics, extrinsics
 
 
+# read a depth or confidence map, upsampled to the fusion resolution
+def read_depth(depth_source, kind, view, flag):
+    data = depth_source.get('{}/{:0>8}'.format(kind, view))
+    if (flag):
+        data = cv2.pyrUp(data)
+    return data
+
+
 # read an image
 def read_img(filename):
     img = Image.open(filename)
@@ -99,104 +106,6 @@ def save_mask(filename, mask):
     Image.fromarray(mask).save(filename)
 
 
-# read a pair file, [(ref_view1, [src_view1-1, ...]), (ref_view2, [src_view2-1, ...]), ...]
-def read_pair_file(filename):
-    data = []
-    with open(filename) as f:
-        num_viewpoint = int(f.readline())
-        # 49 viewpoints
-        for view_idx in range(num_viewpoint):
-            ref_view = int(f.readline().rstrip())
-            src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
-            data.append((ref_view, src_views))
-    return data
-
-
-def read_score_file(filename):
-    data = []
-    with open(filename) as f:
-        num_viewpoint = int(f.readline())
-        # 49 viewpoints
-        for view_idx in range(num_viewpoint):
-            ref_view = int(f.readline().rstrip())
-            scores = [float(x) for x in f.readline().rstrip().split()[2::2]]
-            data.append(scores)
-    return data
-
-
-
-# project the reference point cloud into the source view, then project back
-def reproject_with_depth(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src):
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    ## step1. project reference pixels to the source view
-    # reference view x, y
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    x_ref, y_ref = x_ref.reshape([-1]), y_ref.reshape([-1])
-    # reference 3D space
-    xyz_ref = np.matmul(np.linalg.inv(intrinsics_ref),
-                        np.vstack((x_ref, y_ref, np.ones_like(x_ref))) * depth_ref.reshape([-1]))
-    # source 3D space
-    xyz_src = np.matmul(np.matmul(extrinsics_src, np.linalg.inv(extrinsics_ref)),
-                        np.vstack((xyz_ref, np.ones_like(x_ref))))[:3]
-    # source view x, y
-    K_xyz_src = np.matmul(intrinsics_src, xyz_src)
-    xy_src = K_xyz_src[:2] / K_xyz_src[2:3]
-
-    ## step2. reproject the source view points with source view depth estimation
-    # find the depth estimation of the source view
-    x_src = xy_src[0].reshape([height, width]).astype(np.float32)
-    y_src = xy_src[1].reshape([height, width]).astype(np.float32)
-    sampled_depth_src = cv2.remap(depth_src, x_src, y_src, interpolation=cv2.INTER_LINEAR)
-    # mask = sampled_depth_src > 0
-
-    # source 3D space
-    # NOTE that we should use sampled source-view depth_here to project back
-    xyz_src = np.matmul(np.linalg.inv(intrinsics_src),
-                        np.vstack((xy_src, np.ones_like(x_ref))) * sampled_depth_src.reshape([-1]))
-    # reference 3D space
-    xyz_reprojected = np.matmul(np.matmul(extrinsics_ref, np.linalg.inv(extrinsics_src)),
-                                np.vstack((xyz_src, np.ones_like(x_ref))))[:3]
-    # source view x, y, depth
-    depth_reprojected = xyz_reprojected[2].reshape([height, width]).astype(np.float32)
-    K_xyz_reprojected = np.matmul(intrinsics_ref, xyz_reprojected)
-    xy_reprojected = K_xyz_reprojected[:2] / K_xyz_reprojected[2:3]
-    x_reprojected = xy_reprojected[0].reshape([height, width]).astype(np.float32)
-    y_reprojected = xy_reprojected[1].reshape([height, width]).astype(np.float32)
-
-    return depth_reprojected, x_reprojected, y_reprojected, x_src, y_src
-
-
-def check_geometric_consistency(depth_ref, intrinsics_ref, extrinsics_ref, depth_src, intrinsics_src, extrinsics_src, flag):
-
-    t1=1
-    t2=0.01
-
-    width, height = depth_ref.shape[1], depth_ref.shape[0]
-    x_ref, y_ref = np.meshgrid(np.arange(0, width), np.arange(0, height))
-    
-    if (flag):
-        t1/=2
-        t2/=2
-
-    depth_reprojected, x2d_reprojected, y2d_reprojected, x2d_src, y2d_src = reproject_with_depth(depth_ref,
-                                                                                                 intrinsics_ref,
-                                                                                                 extrinsics_ref,
-                                                                                                 depth_src,
-                                                                                                 intrinsics_src,
-                                                                                                 extrinsics_src)
-    # check |p_reproj-p_1| < 1
-    dist = np.sqrt((x2d_reprojected - x_ref) ** 2 + (y2d_reprojected - y_ref) ** 2)
-
-    # check |d_reproj-d_1| / d_1 < 0.01
-    depth_diff = np.abs(depth_reprojected - depth_ref)
-    relative_depth_diff = depth_diff / depth_ref
-
-    mask = np.logical_and(dist < t1, relative_depth_diff < t2)
-    depth_reprojected[~mask] = 0
-
-    return mask, depth_reprojected, x2d_src, y2d_src
-
-
 def filter_depth(scan_folder, out_folder, plyfilename, scale):
     # the pair file
 
@@ -209,10 +118,16 @@ def filter_depth(scan_folder, out_folder, plyfilename, scale):
     vertexs = []
     vertex_colors = []
 
-    pair_data = read_pair_file(pair_file)
-    score_data = read_score_file(pair_file)
+    manifest = get_manifest(os.path.join(scan_folder, 'cams'), pair_file)
+    pair_data = manifest.pairs()
+    score_data = manifest.scores()
 
     nviews = len(pair_data)
+    # depth and confidence from archive.mvsa when prepare_folder found one, from pfm files otherwise
+    depth_source = open_depth_source(out_folder)
+    # each depth map is read and upsampled once per scan, not again as a source view of the other views
+    fusion_cache = FusionCache(args.fusion_cache_mb * 1024 * 1024)
+    archive_masks = {}
     # TODO: hardcode size
     # used_mask = [np.zeros([296, 400], dtype=np.bool) for _ in range(nviews)]
 
@@ -222,23 +137,16 @@ def filter_depth(scan_folder, out_folder, plyfilename, scale):
     for ref_view, src_views in pair_data:
 
         # load the camera parameters
-        ref_intrinsics, ref_extrinsics = read_camera_parameters(
-            os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(ref_view)),scale,flag)
+        ref_intrinsics, ref_extrinsics = fusion_cache.get(('cam', ref_view),
+                                                          lambda: read_camera_parameters(manifest, ref_view, scale, flag))
         # load the reference image
         ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)))
         # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(ref_view)))[0]
-
-        import cv2
+        ref_depth_est = fusion_cache.get(('depth_est', ref_view), lambda: read_depth(depth_source, 'depth_est', ref_view, flag))
 
-        if (flag):
-            ref_depth_est = cv2.pyrUp(ref_depth_est)
-
-        # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}.pfm'.format(ref_view)))[0]
-
-        if (flag):
-            confidence = cv2.pyrUp(confidence)
+        # load the photometric mask of the reference view, only read for the reference view
+        confidence = fusion_cache.get(('confidence', ref_view),
+                                      lambda: read_depth(depth_source, 'confidence', ref_view, flag), keep=False)
 
         photo_mask = confidence > 0.9
 
@@ -249,55 +157,47 @@ def filter_depth(scan_folder, out_folder, plyfilename, scale):
         # ref_depth_est=ref_depth_est * photo_mask
 
 
-        all_srcview_depth_ests = []
-        all_srcview_x = []
-        all_srcview_y = []
-        all_srcview_geomask = []
+        # the first 6 source views
+        src_views = src_views[:6]
+        # camera parameters of the source views
+        src_cameras = [fusion_cache.get(('cam', src_view), lambda: read_camera_parameters(manifest, src_view, scale, flag))
+                       for src_view in src_views]
+        # the estimated depths of the source views
+        src_depth_ests = [fusion_cache.get(('depth_est', src_view), lambda: read_depth(depth_source, 'depth_est', src_view, flag))
+                          for src_view in src_views]
 
-        # compute the geometric mask
-        geo_mask_sum = 0
+        # src_confidence = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}.pfm'.format(src_view)))[0]
 
-        ct=0
+        # src_mask=src_confidence>0.5
+        # src_mask=src_confidence>src_confidence.mean()
 
-        for src_view in src_views:
-            if (ct > 5):
-                break
-            ct = ct + 1
-            # camera parameters of the source view
-            src_intrinsics, src_extrinsics = read_camera_parameters(
-                os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)),scale,flag)
-            # the estimated depth of the source view
-            src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est/{:0>8}.pfm'.format(src_view)))[0]
+        # src_depth_est=src_depth_est*src_mask
 
-            if (flag):
-                src_depth_est = cv2.pyrUp(src_depth_est)
-
-            # src_confidence = read_pfm(os.path.join(out_folder, 'confidence/{:0>8}.pfm'.format(src_view)))[0]
-
-            # src_mask=src_confidence>0.5
-            # src_mask=src_confidence>src_confidence.mean()
-
-            # src_depth_est=src_depth_est*src_mask
-
-            geo_mask, depth_reprojected, x2d_src, y2d_src = check_geometric_consistency(ref_depth_est, ref_intrinsics,
-                                                                                        ref_extrinsics,
-                                                                                        src_depth_est,
-                                                                                        src_intrinsics, src_extrinsics, flag)
-            geo_mask_sum += geo_mask.astype(np.int32)
-            all_srcview_depth_ests.append(depth_reprojected)
-            all_srcview_x.append(x2d_src)
-            all_srcview_y.append(y2d_src)
-            all_srcview_geomask.append(geo_mask)
-
-        depth_est_averaged = (sum(all_srcview_depth_ests) + ref_depth_est) / (geo_mask_sum + 1)
+        # compute the geometric mask, all source views at once
+        t1 = 1
+        t2 = 0.01
+        if (flag):
+            t1 /= 2
+            t2 /= 2
+        all_srcview_geomask, all_srcview_depth_ests, all_srcview_x, all_srcview_y = check_geometric_consistency_views(
+            ref_depth_est, ref_intrinsics, ref_extrinsics, src_depth_ests,
+            np.array([camera[0] for camera in src_cameras]), np.array([camera[1] for camera in src_cameras]), t1, t2)
+        del src_depth_ests
+
+        depth_est_averaged, geo_mask_sum = average_consistent_depth(ref_depth_est, all_srcview_geomask, all_srcview_depth_ests)
         # at least 3 source views matched
         geo_mask = geo_mask_sum >= 3
         final_mask = np.logical_and(photo_mask, geo_mask)
 
-        os.makedirs(os.path.join(out_folder, "mask"), exist_ok=True)
-        save_mask(os.path.join(out_folder, "mask/{:0>8}_photo.png".format(ref_view)), photo_mask)
-        save_mask(os.path.join(out_folder, "mask/{:0>8}_geo.png".format(ref_view)), geo_mask)
-        save_mask(os.path.join(out_folder, "mask/{:0>8}_final.png".format(ref_view)), final_mask)
+        if isinstance(depth_source, DepthArchive):
+            archive_masks["mask/{:0>8}_photo".format(ref_view)] = photo_mask
+            archive_masks["mask/{:0>8}_geo".format(ref_view)] = geo_mask
+            archive_masks["mask/{:0>8}_final".format(ref_view)] = final_mask
+        else:
+            os.makedirs(os.path.join(out_folder, "mask"), exist_ok=True)
+            save_mask(os.path.join(out_folder, "mask/{:0>8}_photo.png".format(ref_view)), photo_mask)
+            save_mask(os.path.join(out_folder, "mask/{:0>8}_geo.png".format(ref_view)), geo_mask)
+            save_mask(os.path.join(out_folder, "mask/{:0>8}_final.png".format(ref_view)), final_mask)
 
         print("processing {}, ref-view{:0>2}, photo/geo/final-mask:{}/{}/{}".format(scan_folder, ref_view,
                                                                                     photo_mask.mean(),
@@ -336,6 +236,15 @@ def filter_depth(scan_folder, out_folder, plyfilename, scale):
             #     src_x = all_srcview_x[idx].astype(np.int)
             #     used_mask[src_view][src_y[src_mask], src_x[src_mask]] = True
 
+    depth_source.close()
+    print('fusion cache:', fusion_cache.stats())
+    fusion_cache.clear()
+    # masks are appended to the archive the depth maps were read from, mmp reads them from there
+    if archive_masks:
+        with DepthArchiveWriter(depth_source.filename) as writer:
+            for key, mask in archive_masks.items():
+                writer.put(key, mask)
+
     if (flag):
         vertexs = np.concatenate(vertexs, axis=0)
         vertex_colors = np.concatenate(vertex_colors, axis=0)
@@ -35,6 +35,7 @@ from models import *
 from utils import *
 import sys
 from datasets.data_io import read_pfm, save_pfm
+from datasets.depth_archive import DepthArchive, DepthArchiveWriter, open_depth_source
 import cv2
 from plyfile import PlyData, PlyElement
 from PIL import Image
@@ -43,14 +44,9 @@ from PIL import Image
 def multi_scale(depth_folder_down4, depth_folder_down8, depth_folder_down16, final_folder, test_list):
 
     depth_folder = depth_folder_down4
-    conf_folder = depth_folder
     output_folder = depth_folder
     depth2_folder = depth_folder_down8
-    conf2_folder = depth2_folder
-    mask2_folder = depth2_folder
     depth3_folder = depth_folder_down16
-    conf3_folder = depth3_folder
-    mask3_folder = depth3_folder
 
     if not os.path.exists(final_folder):
         os.mkdir(final_folder)
@@ -68,16 +64,6 @@ def multi_scale(depth_folder_down4, depth_folder_down8, depth_folder_down16, fin
 
         depth2_t = os.path.join(depth2_folder, scan)
         depth3_t = os.path.join(depth3_folder, scan)
-        conf_t = os.path.join(conf_folder, scan)
-        conf2_t = os.path.join(conf2_folder, scan)
-        conf3_t = os.path.join(conf3_folder, scan)
-
-
-        mask2_folder_t = os.path.join(mask2_folder, scan)
-        mask2_folder_t = os.path.join(mask2_folder_t, 'mask')
-
-        mask3_folder_t = os.path.join(mask3_folder, scan)
-        mask3_folder_t = os.path.join(mask3_folder_t, 'mask')
 
         output_t = os.path.join(output_folder, 'output')
 
@@ -91,12 +77,14 @@ def multi_scale(depth_folder_down4, depth_folder_down8, depth_folder_down16, fin
         output_t = os.path.join(output_t, scan)
         if not os.path.exists(output_t):
             os.mkdir(output_t)
-        sum_t = 0
-        shape = 0
-        for i in range(49):
-            print('process depth '+str(i))
-            depth_s = os.path.join(depth_t, 'depth_est')
-
+        # depth, confidence and masks come from archive.mvsa in each scan folder when present
+        source = open_depth_source(depth_t)
+        source2 = open_depth_source(depth2_t)
+        source3 = open_depth_source(depth3_t)
+        final_writer = None
+        if isinstance(source, DepthArchive):
+            final_writer = DepthArchiveWriter(os.path.join(final_t, 'archive.mvsa'))
+        else:
             final_d = os.path.join(final_t, 'depth_est')
             if not os.path.exists(final_d):
                 os.mkdir(final_d)
@@ -104,61 +92,34 @@ def multi_scale(depth_folder_down4, depth_folder_down8, depth_folder_down16, fin
             if not os.path.exists(final_c):
                 os.mkdir(final_c)
 
-            depth_s = os.path.join(depth_s, '%08d.pfm' % i)
-
-            depth2_s = os.path.join(depth2_t, 'depth_est')
-            depth2_s = os.path.join(depth2_s, '%08d.pfm' % i)
-
-            mask2_s = os.path.join(mask2_folder_t, '%08d_final.png' % i)
-
-            depth3_s = os.path.join(depth3_t, 'depth_est')
-            depth3_s = os.path.join(depth3_s, '%08d.pfm' % i)
-            mask3_s = os.path.join(mask3_folder_t, '%08d_final.png' % i)
-
-            conf_s = os.path.join(conf_t, 'confidence')
-            conf_s = os.path.join(conf_s, '%08d.pfm' % i)
-
-            final_d_s = os.path.join(final_d, '%08d.pfm' % i)
-
-            final_c_s = os.path.join(final_c, '%08d.pfm' % i)
-
-            conf2_s = os.path.join(conf2_t, 'confidence')
-            conf2_s = os.path.join(conf2_s, '%08d.pfm' % i)
+        sum_t = 0
+        shape = 0
+        for i in range(49):
+            print('process depth '+str(i))
 
-            conf3_s = os.path.join(conf3_t, 'confidence')
-            conf3_s = os.path.join(conf3_s, '%08d.pfm' % i)
-            
             output_s = os.path.join(output_t, 'error_map_%04d.png' % i)
 
-            mask2_img_t = cv2.imread(mask2_s)
-
-            mask2_img_t = cv2.cvtColor(mask2_img_t, cv2.COLOR_BGR2GRAY)
-
-            mask2_arr = np.array(mask2_img_t)
+            mask2_arr = source2.get('mask/%08d_final' % i).astype(np.uint8) * 255
 
             mask2_t = mask2_arr > 0
 
-            mask3_img_t = cv2.imread(mask3_s)
-
-            mask3_img_t = cv2.cvtColor(mask3_img_t, cv2.COLOR_BGR2GRAY)
-
-            mask3_arr = np.array(mask3_img_t)
+            mask3_arr = source3.get('mask/%08d_final' % i).astype(np.uint8) * 255
 
             mask3_arr = cv2.pyrUp(mask3_arr)
 
-            depth = read_pfm(depth_s)[0]
+            depth = source.get('depth_est/%08d' % i)
 
-            depth2 = read_pfm(depth2_s)[0]
+            depth2 = source2.get('depth_est/%08d' % i)
 
-            depth3 = read_pfm(depth3_s)[0]
+            depth3 = source3.get('depth_est/%08d' % i)
 
             depth3 = cv2.pyrUp(depth3)
 
-            confidence = read_pfm(conf_s)[0]
+            confidence = source.get('confidence/%08d' % i)
 
-            confidence2 = read_pfm(conf2_s)[0]
+            confidence2 = source2.get('confidence/%08d' % i)
 
-            confidence3 = read_pfm(conf3_s)[0]
+            confidence3 = source3.get('confidence/%08d' % i)
 
             confidence3 = cv2.pyrUp(confidence3)
 
@@ -185,7 +146,17 @@ def multi_scale(depth_folder_down4, depth_folder_down8, depth_folder_down16, fin
             depth[mask3] = depth2[mask3]
             confidence[mask3] = confidence2[mask3]
 
-            save_pfm(final_d_s, depth)
+            if final_writer is not None:
+                final_writer.put('depth_est/%08d' % i, depth)
+                final_writer.put('confidence/%08d' % i, confidence)
+                continue
+
+            save_pfm(os.path.join(final_d, '%08d.pfm' % i), depth)
+
+            save_pfm(os.path.join(final_c, '%08d.pfm' % i), confidence)
 
-            save_pfm(final_c_s, confidence)
+        for one_source in [source, source2, source3]:
+            one_source.close()
+        if final_writer is not None:
+            final_writer.close()
 
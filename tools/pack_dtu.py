@@ -0,0 +1,93 @@
+import argparse
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.data_io import read_pfm
+from datasets.dtu_yao_shard import IMGS_NAME, DEPTHS_NAME, shard_folder
+from datasets.manifest import get_manifest
+
+# Pack the DTU training set (Rectified images and Depths) into the memory-mapped shards read by
+# datasets/dtu_yao_shard.py. Images are stored decoded as uint8, depth as float16 by default.
+# float16 keeps ~0.25-0.5mm steps in the DTU depth range (425-935mm), use --depth_dtype=float32 for exact depth.
+parser = argparse.ArgumentParser(description='Pack the DTU training set into memory-mapped shards')
+parser.add_argument('--datapath', help='DTU training datapath (MVS_TRAINING)')
+parser.add_argument('--listfile', default=None, help='scans to pack, all scans in Rectified if not set')
+parser.add_argument('--shard_path', default=None, help='output folder, default: datapath/Shards')
+parser.add_argument('--depth_dtype', default='float16', choices=['float16', 'float32'], help='depth storage type')
+parser.add_argument('--num_workers', type=int, default=8, help='decoding threads')
+parser.add_argument('--overwrite', action='store_true', help='repack scans that already have a shard')
+
+NUM_LIGHTS = 7
+
+
+def list_scans(datapath, listfile):
+    if listfile is not None:
+        with open(listfile) as f:
+            return [line.rstrip() for line in f.readlines() if line.strip()]
+    return sorted(name[:-len('_train')] for name in os.listdir(os.path.join(datapath, 'Rectified'))
+                  if name.endswith('_train'))
+
+
+def img_filename(datapath, scan, vid, light_idx):
+    # NOTE that the id in image file names is from 1 to 49 (not 0~48)
+    return os.path.join(datapath, 'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
+
+
+def depth_filename(datapath, scan, vid):
+    return os.path.join(datapath, 'Depths/{}_train/depth_map_{:0>4}.pfm'.format(scan, vid))
+
+
+def pack_scan(datapath, scan, view_ids, shard_path, depth_dtype, executor):
+    folder = shard_folder(shard_path, scan)
+    # written to a temporary folder first, a scan is either fully packed or not at all
+    tmp_folder = folder + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    # shards are indexed by view id, views without a file stay zero
+    num_views = int(view_ids.max()) + 1
+    img_h, img_w = np.array(Image.open(img_filename(datapath, scan, view_ids[0], 0))).shape[:2]
+    depth_h, depth_w = read_pfm(depth_filename(datapath, scan, view_ids[0]), mmap=True)[0].shape
+    imgs = np.lib.format.open_memmap(os.path.join(tmp_folder, IMGS_NAME), mode='w+', dtype=np.uint8,
+                                     shape=(num_views, NUM_LIGHTS, img_h, img_w, 3))
+    depths = np.lib.format.open_memmap(os.path.join(tmp_folder, DEPTHS_NAME), mode='w+', dtype=depth_dtype,
+                                       shape=(num_views, depth_h, depth_w))
+
+    def pack_img(vid, light_idx):
+        imgs[vid, light_idx] = np.array(Image.open(img_filename(datapath, scan, vid, light_idx)))
+
+    def pack_depth(vid):
+        depths[vid] = read_pfm(depth_filename(datapath, scan, vid), mmap=True)[0]
+
+    futures = [executor.submit(pack_img, vid, light_idx) for vid in view_ids for light_idx in range(NUM_LIGHTS)]
+    futures += [executor.submit(pack_depth, vid) for vid in view_ids]
+    for future in futures:
+        future.result()
+    imgs.flush()
+    depths.flush()
+    del imgs, depths
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    shard_path = args.shard_path if args.shard_path is not None else os.path.join(args.datapath, 'Shards')
+    # all scans share the same cameras and pair file
+    manifest = get_manifest(os.path.join(args.datapath, 'Cameras/train'), os.path.join(args.datapath, 'Cameras/pair.txt'))
+    scans = list_scans(args.datapath, args.listfile)
+    with ThreadPoolExecutor(max_workers=max(1, args.num_workers)) as executor:
+        for i, scan in enumerate(scans):
+            if os.path.exists(os.path.join(shard_folder(shard_path, scan), IMGS_NAME)) and not args.overwrite:
+                print('skip {}, already packed'.format(scan))
+                continue
+            pack_scan(args.datapath, scan, manifest.view_ids, shard_path, args.depth_dtype, executor)
+            print('packed {} ({}/{})'.format(scan, i + 1, len(scans)))
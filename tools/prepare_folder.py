@@ -37,3 +37,9 @@ for sub_folder in sub_folders:
             os.makedirs(output_s)
         output_s = os.path.join(output_s, 'confidence')
         os.system('cp -r ' + input_s + ' ' + output_s)
+
+        # eval.py --archive=True writes one archive per scan and pyramid level instead of the pfm folders
+        input_s = os.path.join(input, 'archive_%d.mvsa' % i)
+        if os.path.exists(input_s):
+            output_s = os.path.join(result, '%d' % i, sub_folder, 'archive.mvsa')
+            os.system('cp ' + input_s + ' ' + output_s)
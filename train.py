@@ -19,6 +19,7 @@ import sys
 import datetime
 import ast
 from datasets.data_io import *
+from datasets.output_sink import OutputSink
 
 from third_party.sync_batchnorm import patch_replication_callback
 from third_party.sync_batchnorm import convert_model
@@ -51,7 +52,8 @@ parser.add_argument('--syncbn', help='True or False flag, input should be either
     type=ast.literal_eval, default=False)
 
 parser.add_argument('--light_idx', type=int, default=3, help='select while in test')
-parser.add_argument('--cost_aggregation', type=int, default=0, help='cost aggregation method, default: 0')
+parser.add_argument('--cost_aggregation', type=int, default=0, help='cost aggregation method, default: 0, 100: group-wise correlation')
+parser.add_argument('--gwc_groups', type=int, default=8, help='channel groups of the group-wise correlation cost volume (cost_aggregation 100)')
 parser.add_argument('--view_num', type=int, default=3, help='training view num setting')
 
 parser.add_argument('--image_scale', type=float, default=0.25, help='pred depth map scale') # 0.5
@@ -87,6 +89,15 @@ parser.add_argument('--resume', action='store_true', help='continue to train the
 parser.add_argument('--summary_freq', type=int, default=20, help='print and summary frequency')
 parser.add_argument('--save_freq', type=int, default=1, help='save checkpoint frequency')
 parser.add_argument('--seed', type=int, default=1, metavar='S', help='random seed')
+parser.add_argument('--num_writers', type=int, default=4, help='background threads writing depth/confidence files, 0 writes synchronously')
+parser.add_argument('--img_cache_mb', type=int, default=0, help='decoded images shared by the data loader workers of each dataset (MB), 0 disables the cache')
+parser.add_argument('--uint8_imgs', help='True or False flag, input should be either "True" or "False". Load images as uint8 and scale them on the GPU',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--batch_views', help='True or False flag, input should be either "True" or "False". Extract features and warp all views in batched calls',
+    type=ast.literal_eval, default=False)
+parser.add_argument('--checkpoint_3d', default='none', choices=['none', 'encoder', 'decoder', 'all'], help='recompute these stages of the 3D regularization network in backward instead of keeping their activations')
+parser.add_argument('--lean_warping', help='True or False flag, input should be either "True" or "False". Recompute the warped volumes of the variance cost volume in backward instead of keeping them',
+    type=ast.literal_eval, default=False)
 
 
 # parse arguments and check
@@ -126,13 +137,15 @@ if SAVE_DEPTH:
     if not os.path.exists(save_dir):
         print('save dir', save_dir)
         os.makedirs(save_dir)
+    # writes outputs in the background while the next sample is processed
+    output_sink = OutputSink(args.num_writers)
 
 # dataset, dataloader
 # args.origin_size only load origin size depth, not modify Camera.txt
 MVSDataset = find_dataset_def(args.dataset)
-train_dataset = MVSDataset(args.trainpath, args.trainlist, "train", args.view_num, args.numdepth, args.interval_scale, args.inverse_depth, args.origin_size, -1, args.image_scale) # Training with False, Test with inverse_depth
-val_dataset = MVSDataset(args.trainpath, args.vallist, "val", 5, args.numdepth, args.interval_scale, args.inverse_depth, args.origin_size, args.light_idx, args.image_scale) #view_num = 5, light_idx = 3
-test_dataset = MVSDataset(args.testpath, args.testlist, "test", 5, args.numdepth, args.interval_scale, args.inverse_depth, args.origin_size, args.light_idx, args.image_scale) # use 3
+train_dataset = MVSDataset(args.trainpath, args.trainlist, "train", args.view_num, args.numdepth, args.interval_scale, args.inverse_depth, args.origin_size, -1, args.image_scale, img_cache_mb=args.img_cache_mb, uint8_imgs=args.uint8_imgs) # Training with False, Test with inverse_depth
+val_dataset = MVSDataset(args.trainpath, args.vallist, "val", 5, args.numdepth, args.interval_scale, args.inverse_depth, args.origin_size, args.light_idx, args.image_scale, img_cache_mb=args.img_cache_mb, uint8_imgs=args.uint8_imgs) #view_num = 5, light_idx = 3
+test_dataset = MVSDataset(args.testpath, args.testlist, "test", 5, args.numdepth, args.interval_scale, args.inverse_depth, args.origin_size, args.light_idx, args.image_scale, img_cache_mb=args.img_cache_mb, uint8_imgs=args.uint8_imgs) # use 3
 TrainImgLoader = DataLoader(train_dataset, args.batch_size, shuffle=True, num_workers=8, drop_last=True)
 ValImgLoader = DataLoader(val_dataset, args.batch_size, shuffle=False, num_workers=4, drop_last=False)
 TestImgLoader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_workers=4, drop_last=False)
@@ -142,7 +155,8 @@ TestImgLoader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_wor
 if args.model == 'mvsnet':
     print('use MVSNet')
     model = MVSNet(refine=args.refine, fea_net=args.fea_net, cost_net=args.cost_net,
-             refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation, dp_ratio=args.dp_ratio, image_scale=args.image_scale)
+             refine_net=args.refine_net, origin_size=args.origin_size, cost_aggregation=args.cost_aggregation, dp_ratio=args.dp_ratio, batch_views=args.batch_views, image_scale=args.image_scale,
+             lean_warping=args.lean_warping, checkpoint_3d=args.checkpoint_3d, gwc_groups=args.gwc_groups)
 else: 
     print('input pre-defined model')
 
@@ -310,15 +324,11 @@ def test():
             for j in range(0, len(depth_name)):
                 name_split = str.split(depth_name[j], '/')
                 sub_dir = os.path.join(save_dir, name_split[-2])
-                if not os.path.exists(sub_dir):
-                    print('make dir: ', sub_dir)
-                    os.makedirs(sub_dir)
                 save_depth_path = os.path.join(sub_dir, 'init_'+name_split[-1])
-                save_depth_png_path = os.path.join(sub_dir, 'init_'+name_split[-1][:-3]+'png')
                 save_prob_path = os.path.join(sub_dir, 'prob_'+name_split[-1])
 
-                save_pfm(save_depth_path, depth_est[j].detach().cpu().numpy())
-                save_pfm(save_prob_path, prob_map_est[j].detach().cpu().numpy())
+                output_sink.save_pfm(save_depth_path, depth_est[j].detach().cpu().numpy())
+                output_sink.save_pfm(save_prob_path, prob_map_est[j].detach().cpu().numpy())
                 
         if 'High' in args.fea_net and 'Coarse2Fine' in args.cost_net :
             print('Iter {}/{}, test loss = {:.3f}, time = {:3f}, ame = {:3f}, thres2mm = {:3f}, thres4mm = {:3f}, thres8mm = {:3f}'.format(batch_idx, len(TestImgLoader), loss,
@@ -332,6 +342,8 @@ def test():
 
         if batch_idx % 100 == 0:
             print("Iter {}/{}, test results = {}".format(batch_idx, len(TestImgLoader), avg_test_scalars.mean()))
+    if SAVE_DEPTH:
+        output_sink.flush()
     print("avg_test_scalars:", avg_test_scalars.mean())
 
 def val():
@@ -358,21 +370,18 @@ def val():
             for j in range(0, len(depth_name)):
                 name_split = str.split(depth_name[j], '/')
                 sub_dir = os.path.join(save_dir, name_split[-2])
-                if not os.path.exists(sub_dir):
-                    print('make dir: ', sub_dir)
-                    os.makedirs(sub_dir)
                 save_depth_path = os.path.join(sub_dir, 'init_'+name_split[-1])
-                save_depth_png_path = os.path.join(sub_dir, 'init_'+name_split[-1][:-3]+'png')
-                
                 save_prob_path = os.path.join(sub_dir, 'prob_'+name_split[-1])
 
-                save_pfm(save_depth_path, depth_est[j].detach().cpu().numpy())
-                save_pfm(save_prob_path, prob_map_est[j].detach().cpu().numpy())
+                output_sink.save_pfm(save_depth_path, depth_est[j].detach().cpu().numpy())
+                output_sink.save_pfm(save_prob_path, prob_map_est[j].detach().cpu().numpy())
                 
         del scalar_outputs, image_outputs
 
         if batch_idx % 100 == 0:
             print("Iter {}/{}, test results = {}".format(batch_idx, len(ValImgLoader), avg_test_scalars.mean()))
+    if SAVE_DEPTH:
+        output_sink.flush()
     print("avg_val_scalars:", avg_test_scalars.mean())
 
 def evaluate():
@@ -676,7 +685,7 @@ def test_load_sample(sample, detailed_summary=True):
         sub_dir = os.path.join(save_dir, name_split[-2])
         depth_path = os.path.join(sub_dir, 'init_'+name_split[-1])
         print('load est depth map: ', depth_path)
-        depth_est_list.append(np.array(read_pfm(depth_path)[0], dtype=np.float32))
+        depth_est_list.append(read_pfm(depth_path, mmap=True, contiguous=True)[0])
     depth_est = torch.from_numpy(np.stack(depth_est_list, axis=0)).cuda()
     
     if args.loss == 'mvsnet_loss_divby_interval':
@@ -87,6 +87,8 @@ def save_images(logger, mode, images_dict, global_step):
             raise NotImplementedError("invalid img shape {}:{} in save_images".format(name, img.shape))
         if len(img.shape) == 3:
             img = img[:, np.newaxis, :, :]
+        if img.dtype == np.uint8:
+            img = img.astype(np.float32) / 255.
         img = torch.from_numpy(img[:1])
         return vutils.make_grid(img, padding=0, nrow=1, normalize=True, scale_each=True)
 